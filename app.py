@@ -1,11 +1,198 @@
-from flask import Flask, jsonify, request, send_from_directory
+import atexit
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+from contextlib import nullcontext
+
+from flask import Flask, Response, g, jsonify, request, send_from_directory, stream_with_context
 from flask_cors import CORS
-from juego import SimuladorComercio
+from compartido import MemoriaMercado
+from juego import Jugador, RelojMercado, SesionJugador, SimuladorComercio, cantidad_valida
+import metricas
+from persistencia import Persistencia
+from pronostico import PERCENTILES, Pronosticador
+
+log = metricas.configurar_logging(os.environ.get('KEYO_LOG', 'INFO').upper()).getChild('app')
 
 app = Flask(__name__, static_folder='.')
-CORS(app)
+# Las páginas usan la API con rutas relativas (mismo origen); otros orígenes
+# permitidos, con cookies, en KEYO_ORIGENES=http://a,http://b
+ORIGENES = os.environ.get('KEYO_ORIGENES', 'http://localhost:5000,http://127.0.0.1:5000').split(',')
+CORS(app, origins=ORIGENES, supports_credentials=True)
+
+# El proceso forkserver del pool de pronósticos importa este módulo como
+# __mp_main__: ahí no se restaura, ni se comparte, ni se graba nada
+AUXILIAR = __name__ == '__mp_main__'
+
+# Con KEYO_COMPARTIDO=nombre varios procesos del servidor comparten un mismo
+# mercado en memoria compartida. Solo el mercado: cada jugador (y sus órdenes
+# limitadas y su puesto en el ranking) vive en el proceso que lo creó, así que
+# el balanceador debe mandar cada sesión siempre al mismo proceso. Cada proceso
+# lleva su propio historial, con los turnos y comercios que lee del bloque
+NOMBRE_COMPARTIDO = None if AUXILIAR else os.environ.get('KEYO_COMPARTIDO')
+
+# Con KEYO_DATOS=directorio el mundo sobrevive a los reinicios: se restaura de
+# la última instantánea más su registro, y se guarda otra cada N turnos
+DIRECTORIO_DATOS = None if AUXILIAR else os.environ.get('KEYO_DATOS')
+if DIRECTORIO_DATOS and NOMBRE_COMPARTIDO:
+    # El registro de un proceso no puede rehacer un mercado que también mueven los demás
+    raise RuntimeError("KEYO_DATOS y KEYO_COMPARTIDO no se pueden usar a la vez")
+persistencia = Persistencia(DIRECTORIO_DATOS)
+INSTANTANEA_CADA = int(os.environ.get('KEYO_INSTANTANEA_TURNOS', 50))
+simulador = persistencia.restaurar() or SimuladorComercio()
+persistencia.guardar(simulador)
+if persistencia.activa:
+    simulador.mercado.diario = persistencia
+# Serializa los turnos con las instantáneas
+turno_lock = threading.Lock()
+# El historial por región cuesta O(recursos x regiones) por turno y en memoria: solo si se pide
+if os.environ.get('KEYO_HISTORIAL_REGIONAL'):
+    simulador.mercado.historial.activar_regional()
+
+memoria_mercado = MemoriaMercado(NOMBRE_COMPARTIDO, simulador) if NOMBRE_COMPARTIDO else None
+if memoria_mercado is not None:
+    atexit.register(memoria_mercado.cerrar)
+
+# Pronósticos Monte Carlo en KEYO_PRONOSTICO_PROCESOS procesos (0: en este)
+procesos_pronostico = os.environ.get('KEYO_PRONOSTICO_PROCESOS')
+pronosticador = Pronosticador(int(procesos_pronostico) if procesos_pronostico else None)
+atexit.register(pronosticador.cerrar)
+
+def escritura_mercado(regional=False):
+    """Contexto para las operaciones que modifican el mercado
+
+    Con memoria compartida toma el lock entre procesos, trae el estado al día y
+    lo publica al salir. Se toma antes que el lock de la sesión.
+    """
+    if memoria_mercado is None:
+        return nullcontext()
+    return memoria_mercado.escritura(regional)
+
+@app.before_request
+def sincronizar_mercado():
+    """Trae los cambios del mercado hechos por otros procesos (sin bloquear)"""
+    if memoria_mercado is not None:
+        memoria_mercado.leer()
 
-simulador = SimuladorComercio()
+SESION_COOKIE = 'keyo_sesion'
+
+# ============================================
+# SESIONES DE JUGADOR
+# ============================================
+
+def sesion_actual(crear=True):
+    """Obtiene la sesión (jugador + lock) del cliente, creando una si no tiene
+
+    Solo las operaciones que cambian algo crean jugadores. Las lecturas
+    (crear=False) de un cliente sin sesión reciben un invitado que no se
+    registra: así no llenan el registro ni desalojan a jugadores reales.
+    """
+    sesion_id = request.cookies.get(SESION_COOKIE, '')
+    valida = len(sesion_id) == 32 and sesion_id.isalnum()
+    if not crear:
+        sesion = simulador.jugadores.buscar(sesion_id) if valida else None
+        return sesion or SesionJugador(None, Jugador("Invitado"))
+    if not valida:
+        sesion_id = simulador.jugadores.nuevo_id()
+        g.nueva_sesion = sesion_id
+    return simulador.jugadores.obtener(sesion_id)
+
+# ============================================
+# PETICIONES CONDICIONALES (ETag / 304)
+# ============================================
+
+def no_modificado(etag, por_jugador=False):
+    """Respuesta 304 para un cliente que ya tiene la versión actual"""
+    respuesta = app.response_class(status=304)
+    respuesta.set_etag(etag)
+    if por_jugador:
+        respuesta.vary.add('Cookie')
+    return respuesta
+
+# Las versiones vuelven a empezar en cada arranque: sin una época en el ETag,
+# un cliente podría recibir un 304 con una copia de antes de reiniciar. Con
+# memoria compartida la del mercado es la del bloque, igual en todos los procesos
+ARRANQUE = secrets.token_hex(4)
+EPOCA_MERCADO = f'{memoria_mercado.epoca:x}' if memoria_mercado is not None else ARRANQUE
+
+def etag_mercado(version):
+    """ETag de las vistas que dependen solo del mercado"""
+    return f'm{EPOCA_MERCADO}.{version}'
+
+def etag_jugador(jugador):
+    """ETag de las vistas que dependen del jugador y de los precios del mercado"""
+    # El jugador vive en este proceso: su versión es de este arranque
+    return f'j{ARRANQUE}.{jugador.version}-{etag_mercado(simulador.mercado.version)}'
+
+@app.after_request
+def guardar_sesion(response):
+    """Envía la cookie de sesión a los clientes nuevos"""
+    sesion_id = g.get('nueva_sesion')
+    if sesion_id:
+        response.set_cookie(SESION_COOKIE, sesion_id, httponly=True, samesite='Lax')
+    return response
+
+# ============================================
+# INSTRUMENTACIÓN
+# ============================================
+
+@app.before_request
+def iniciar_cronometro():
+    g.inicio_peticion = time.perf_counter()
+
+@app.after_request
+def medir_peticion(response):
+    """Latencia y recuento por ruta, método y estado"""
+    if request.url_rule is None or not request.path.startswith('/api/'):
+        return response
+    segundos = time.perf_counter() - g.inicio_peticion
+    ruta = request.url_rule.rule
+    metricas.registro.observar('keyo_peticion_segundos', segundos, 'Latencia de las peticiones a la API',
+                               ruta=ruta, metodo=request.method)
+    metricas.registro.incrementar('keyo_peticiones_total', 1, 'Peticiones a la API por estado',
+                                  ruta=ruta, metodo=request.method, estado=response.status_code)
+    return response
+
+@app.route('/metrics')
+def exponer_metricas():
+    """Métricas en formato de texto de Prometheus"""
+    cuerpo = metricas.registro.exponer()
+    return Response(cuerpo, mimetype='text/plain; version=0.0.4')
+
+# ============================================
+# GRABACIÓN DE TRÁFICO
+# ============================================
+
+# Con KEYO_GRABAR=ruta.jsonl cada llamada a /api se añade a ese fichero,
+# para reproducirla después con benchmarks/repetir.py
+GRABAR_TRAFICO = None if AUXILIAR else os.environ.get('KEYO_GRABAR')
+grabacion_lock = threading.Lock()
+grabacion_inicio = time.time()
+grabacion = open(GRABAR_TRAFICO, 'a', encoding='utf-8') if GRABAR_TRAFICO else None
+
+@app.after_request
+def grabar_peticion(response):
+    """Añade la petición a la grabación de tráfico, si está activa"""
+    if grabacion is None or not request.path.startswith('/api/') or request.url_rule is None:
+        return response
+    registro = {
+        't': round(time.time() - grabacion_inicio, 4),
+        'sesion': request.cookies.get(SESION_COOKIE) or g.get('nueva_sesion'),
+        'metodo': request.method,
+        'ruta': request.full_path.rstrip('?'),
+        'regla': request.url_rule.rule,
+        'cuerpo': request.get_json(silent=True),
+        'estado': response.status_code,
+        'ms': round((time.perf_counter() - g.inicio_peticion) * 1000, 3)
+    }
+    linea = json.dumps(registro, ensure_ascii=False) + '\n'
+    with grabacion_lock:
+        grabacion.write(linea)
+        grabacion.flush()
+    return response
 
 # ============================================
 # RUTAS HTML
@@ -19,38 +206,19 @@ def index():
 def static_files(path):
     return send_from_directory('.', path)
 
-@app.route('/api/mercado', methods=['GET'])
-def obtener_mercado():
-    """Obtiene recursos, opcionalmente filtrados por ubicación"""
-    ubicacion = request.args.get('ubicacion', '')
-    orden = request.args.get('orden', 'precio')  # precio, demanda, oferta
-    
-    print(f"Obteniendo mercado - Ubicación: '{ubicacion}' - Orden: {orden}")
-    
+# Vistas del mercado ya serializadas: {(ubicacion, orden, version): bytes JSON}
+vistas_mercado = {}
+vistas_mercado_lock = threading.Lock()
+
+def construir_vista_mercado(ubicacion, orden, foto):
+    """Lista de recursos del mercado lista para serializar, leída de una foto"""
     # Filtrar por ubicación
     if ubicacion and ubicacion != "":
-        recursos = simulador.mercado.obtener_recursos_por_ubicacion(ubicacion)
-        print(f"Encontrados {len(recursos)} recursos en {ubicacion}")
+        recursos = simulador.mercado.obtener_recursos_por_ubicacion(ubicacion, foto)
+        log.debug("Encontrados %d recursos en %s", len(recursos), ubicacion)
     else:
         # Sin filtro: mostrar precios PROMEDIO de todas las regiones
-        recursos = []
-        for recurso_base in simulador.mercado.recursos.values():
-            import copy
-            recurso_promedio = copy.copy(recurso_base)
-            
-            # Calcular precio promedio de todas las regiones
-            if recurso_base.precios_regionales:
-                precio_total = sum(recurso_base.precios_regionales.values())
-                recurso_promedio.precio_actual = precio_total / len(recurso_base.precios_regionales)
-                
-                # Stock promedio
-                stock_total = sum(recurso_base.stocks_regionales.values())
-                recurso_promedio.stock = int(stock_total / len(recurso_base.stocks_regionales))
-            else:
-                recurso_promedio.precio_actual = recurso_base.precio_base
-                recurso_promedio.stock = 100
-            
-            recursos.append(recurso_promedio)
+        recursos = simulador.mercado.obtener_recursos_promedio(foto)
     
     # Ordenar según criterio
     if orden == 'demanda':
@@ -75,7 +243,41 @@ def obtener_mercado():
             'cambio_porcentaje': round(((recurso.precio_actual - recurso.precio_base) / recurso.precio_base) * 100, 1)
         })
     
-    return jsonify(resultado)
+    return resultado
+
+@app.route('/api/mercado', methods=['GET'])
+def obtener_mercado():
+    """Obtiene recursos, opcionalmente filtrados por ubicación"""
+    ubicacion = request.args.get('ubicacion', '')
+    orden = request.args.get('orden', 'precio')  # precio, demanda, oferta
+    if orden not in ('demanda', 'oferta'):
+        orden = 'precio'
+    
+    log.debug("Obteniendo mercado ubicacion=%r orden=%s", ubicacion, orden)
+    
+    # Una foto inmutable: la respuesta nunca mezcla estados de un turno o comercio a medias
+    foto = simulador.mercado.foto
+    etag = etag_mercado(foto.version)
+    if request.if_none_match.contains(etag):
+        return no_modificado(etag)
+    
+    clave = (ubicacion, orden, foto.version)
+    cuerpo = vistas_mercado.get(clave)
+    if cuerpo is None:
+        cuerpo = app.json.dumps(construir_vista_mercado(ubicacion, orden, foto)).encode()
+        # Solo se cachean ubicaciones conocidas; las vistas de versiones viejas se descartan
+        if not ubicacion or ubicacion in simulador.mercado.estado.id_ubicacion:
+            with vistas_mercado_lock:
+                version = next(iter(vistas_mercado))[2] if vistas_mercado else foto.version
+                # Una petición que leyó una foto anterior no borra las vistas de la nueva
+                if version < foto.version:
+                    vistas_mercado.clear()
+                if version <= foto.version:
+                    vistas_mercado[clave] = cuerpo
+    
+    respuesta = app.response_class(cuerpo, mimetype='application/json')
+    respuesta.set_etag(etag)
+    return respuesta
 
 @app.route('/api/comprar', methods=['POST'])
 def comprar_recurso():
@@ -85,48 +287,58 @@ def comprar_recurso():
     cantidad = data.get('cantidad', 1)
     
     # Buscar recurso (case-insensitive)
-    recurso = None
-    for nombre, r in simulador.mercado.recursos.items():
-        if nombre.lower() == recurso_nombre.lower():
-            recurso = r
-            break
+    recurso = simulador.mercado.buscar_recurso(recurso_nombre)
     
     if not recurso:
-        print(f"❌ Recurso no encontrado: '{recurso_nombre}'")
-        print(f"📋 Recursos disponibles: {list(simulador.mercado.recursos.keys())}")
+        log.warning("Recurso no encontrado: %r", recurso_nombre)
         return jsonify({
             'error': 'Recurso no encontrado', 
             'exito': False,
             'mensaje': f'El recurso "{recurso_nombre}" no existe en el mercado'
         }), 404
+    if not cantidad_valida(cantidad):
+        return jsonify({'exito': False, 'mensaje': 'Cantidad inválida'}), 400
     
-    # Validaciones previas
-    costo_total = recurso.precio_actual * cantidad
-    peso_total = recurso.peso * cantidad
-    
-    if simulador.jugador.dinero < costo_total:
-        return jsonify({
-            'exito': False,
-            'mensaje': f'💰 DINERO INSUFICIENTE\n\nNecesitas: ${round(costo_total):,}\nTienes: ${round(simulador.jugador.dinero):,}\nTe faltan: ${round(costo_total - simulador.jugador.dinero):,}'
-        })
-    
-    if simulador.jugador.capacidad_usada + peso_total > simulador.jugador.capacidad_max:
-        capacidad_disponible = simulador.jugador.capacidad_max - simulador.jugador.capacidad_usada
+    sesion = sesion_actual()
+    with escritura_mercado(), sesion.lock:
+        jugador = sesion.jugador
+        
+        # Validaciones previas (orientativas: la compra vuelve a comprobarlo bajo el lock del recurso)
+        costo_total = recurso.precio_actual * cantidad
+        peso_total = recurso.peso * cantidad
+        
+        if recurso.stock < cantidad:
+            return jsonify({
+                'exito': False,
+                'mensaje': f'📦 STOCK INSUFICIENTE\n\nPedido: {cantidad}\nDisponible: {recurso.stock}'
+            })
+        
+        if jugador.dinero < costo_total:
+            return jsonify({
+                'exito': False,
+                'mensaje': f'💰 DINERO INSUFICIENTE\n\nNecesitas: ${round(costo_total):,}\nTienes: ${round(jugador.dinero):,}\nTe faltan: ${round(costo_total - jugador.dinero):,}'
+            })
+        
+        if jugador.capacidad_usada + peso_total > jugador.capacidad_max:
+            capacidad_disponible = jugador.capacidad_max - jugador.capacidad_usada
+            return jsonify({
+                'exito': False,
+                'mensaje': f'🎒 INVENTARIO LLENO\n\nPeso necesario: {peso_total}kg\nCapacidad disponible: {round(capacidad_disponible, 1)}kg\nTe faltan: {round(peso_total - capacidad_disponible, 1)}kg de espacio\n\n💡 Vende algunos recursos para liberar espacio'
+            })
+        
+        exito = jugador.comprar_recurso(recurso, cantidad, simulador.mercado,
+                                        al_confirmar=lambda: persistencia.registrar_comercio(sesion, [recurso]))
+        if exito:
+            publicar_comercio(sesion, [recurso])
+        
         return jsonify({
-            'exito': False,
-            'mensaje': f'🎒 INVENTARIO LLENO\n\nPeso necesario: {peso_total}kg\nCapacidad disponible: {round(capacidad_disponible, 1)}kg\nTe faltan: {round(peso_total - capacidad_disponible, 1)}kg de espacio\n\n💡 Vende algunos recursos para liberar espacio'
+            'exito': exito,
+            'dinero': jugador.dinero,
+            'inventario': jugador.inventario,
+            'capacidad_usada': jugador.capacidad_usada,
+            'capacidad_max': jugador.capacidad_max,
+            'mensaje': f'✅ COMPRA EXITOSA\n\nCompraste: {cantidad}x {recurso_nombre}\nGastaste: ${round(costo_total):,}\nDinero restante: ${round(jugador.dinero):,}' if exito else 'No se pudo completar la compra'
         })
-    
-    exito = simulador.jugador.comprar_recurso(recurso, cantidad, simulador.mercado)
-    
-    return jsonify({
-        'exito': exito,
-        'dinero': simulador.jugador.dinero,
-        'inventario': simulador.jugador.inventario,
-        'capacidad_usada': simulador.jugador.capacidad_usada,
-        'capacidad_max': simulador.jugador.capacidad_max,
-        'mensaje': f'✅ COMPRA EXITOSA\n\nCompraste: {cantidad}x {recurso_nombre}\nGastaste: ${round(costo_total):,}\nDinero restante: ${round(simulador.jugador.dinero):,}' if exito else 'No se pudo completar la compra'
-    })
 
 @app.route('/api/vender', methods=['POST'])
 def vender_recurso():
@@ -136,31 +348,233 @@ def vender_recurso():
     cantidad = data.get('cantidad', 1)
     
     # Buscar el nombre correcto del recurso (case-insensitive)
-    nombre_correcto = None
-    for nombre in simulador.mercado.recursos.keys():
-        if nombre.lower() == recurso_nombre.lower():
-            nombre_correcto = nombre
-            break
+    recurso = simulador.mercado.buscar_recurso(recurso_nombre)
+    nombre_correcto = recurso.nombre if recurso else None
     
     if not nombre_correcto:
         return jsonify({'error': 'Recurso no encontrado', 'exito': False}), 404
+    if not cantidad_valida(cantidad):
+        return jsonify({'exito': False, 'mensaje': 'Cantidad inválida'}), 400
+    
+    sesion = sesion_actual()
+    with escritura_mercado(), sesion.lock:
+        jugador = sesion.jugador
+        exito = jugador.vender_recurso(nombre_correcto, cantidad, simulador.mercado,
+                                       al_confirmar=lambda: persistencia.registrar_comercio(sesion, [recurso]))
+        if exito:
+            publicar_comercio(sesion, [recurso])
+        
+        return jsonify({
+            'exito': exito,
+            'dinero': jugador.dinero,
+            'inventario': jugador.inventario,
+            'capacidad_usada': jugador.capacidad_usada,
+            'mensaje': f'Vendiste {cantidad}x {recurso_nombre}' if exito else 'No se pudo completar la venta'
+        })
+
+@app.route('/api/ordenes', methods=['POST'])
+def ejecutar_ordenes():
+    """Ejecuta una cesta de compras y ventas de forma atómica"""
+    data = request.json or {}
+    lista = data.get('ordenes', []) if isinstance(data, dict) else None
+    if not isinstance(lista, list) or not all(isinstance(orden, dict) for orden in lista):
+        return jsonify({'exito': False, 'mensaje': 'Se espera {"ordenes": [{"tipo", "recurso", "cantidad"}, ...]}'}), 400
+    ordenes = []
+    for orden in lista:
+        tipo = orden.get('tipo')
+        recurso = simulador.mercado.buscar_recurso(str(orden.get('recurso', '')))
+        cantidad = orden.get('cantidad', 1)
+        if tipo not in ('comprar', 'vender'):
+            return jsonify({'exito': False, 'mensaje': f'Tipo de orden inválido: {tipo}'}), 400
+        if not recurso:
+            return jsonify({
+                'error': 'Recurso no encontrado',
+                'exito': False,
+                'mensaje': f'El recurso "{orden.get("recurso")}" no existe en el mercado'
+            }), 404
+        if not cantidad_valida(cantidad):
+            return jsonify({'exito': False, 'mensaje': f'Cantidad inválida para {recurso.nombre}'}), 400
+        ordenes.append((tipo, recurso, cantidad))
+    
+    if not ordenes:
+        return jsonify({'exito': False, 'mensaje': 'No hay órdenes'}), 400
+    
+    sesion = sesion_actual()
+    with escritura_mercado(), sesion.lock:
+        jugador = sesion.jugador
+        afectados = list({recurso.nombre: recurso for _, recurso, _ in ordenes}.values())
+        exito, mensaje, detalles = jugador.ejecutar_ordenes(
+            ordenes, simulador.mercado, al_confirmar=lambda: persistencia.registrar_comercio(sesion, afectados))
+        if exito:
+            publicar_comercio(sesion, afectados)
+        
+        return jsonify({
+            'exito': exito,
+            'mensaje': mensaje,
+            'ordenes': detalles,
+            'dinero': jugador.dinero,
+            'inventario': jugador.inventario,
+            'capacidad_usada': jugador.capacidad_usada,
+            'capacidad_max': jugador.capacidad_max
+        })
+
+# ============================================
+# ÓRDENES LIMITADAS
+# ============================================
+
+@app.route('/api/ordenes_limite', methods=['POST'])
+def colocar_orden_limite():
+    """Coloca una orden limitada; se casa en el siguiente turno"""
+    data = request.json or {}
+    recurso = simulador.mercado.buscar_recurso(str(data.get('recurso', '')))
+    if not recurso:
+        return jsonify({'error': 'Recurso no encontrado', 'exito': False}), 404
+    columna = simulador.mercado.estado.id_ubicacion.get(data.get('ubicacion'))
+    if columna is None:
+        return jsonify({'error': 'Ubicación no encontrada', 'exito': False}), 404
     
-    exito = simulador.jugador.vender_recurso(nombre_correcto, cantidad, simulador.mercado)
+    lado = data.get('lado')
+    precio = data.get('precio')
+    cantidad = data.get('cantidad', 1)
+    if lado not in ('compra', 'venta'):
+        return jsonify({'exito': False, 'mensaje': f'Lado inválido: {lado}'}), 400
+    if not isinstance(precio, (int, float)) or isinstance(precio, bool) or precio <= 0:
+        return jsonify({'exito': False, 'mensaje': 'Precio inválido'}), 400
+    if not cantidad_valida(cantidad):
+        return jsonify({'exito': False, 'mensaje': 'Cantidad inválida'}), 400
     
+    sesion = sesion_actual()
+    with sesion.lock:
+        exito, mensaje, orden = simulador.mercado.ordenes.colocar(
+            sesion, recurso, columna, lado, float(precio), cantidad)
+        return jsonify({
+            'exito': exito,
+            'mensaje': mensaje,
+            'orden_id': orden.id if orden else None,
+            'dinero': sesion.jugador.dinero,
+            'inventario': sesion.jugador.inventario
+        })
+
+@app.route('/api/ordenes_limite/<int:orden_id>', methods=['DELETE'])
+def cancelar_orden_limite(orden_id):
+    """Cancela una orden limitada propia"""
+    sesion = sesion_actual(crear=False)
+    with sesion.lock:
+        exito = simulador.mercado.ordenes.cancelar(sesion, orden_id)
+        if not exito:
+            return jsonify({'exito': False, 'mensaje': 'Orden no encontrada'}), 404
+        return jsonify({
+            'exito': True,
+            'mensaje': f'Orden {orden_id} cancelada',
+            'dinero': sesion.jugador.dinero,
+            'inventario': sesion.jugador.inventario
+        })
+
+@app.route('/api/libro', methods=['GET'])
+def obtener_libro():
+    """Mejores niveles del libro de órdenes de un recurso en una ubicación"""
+    recurso = simulador.mercado.buscar_recurso(request.args.get('recurso', ''))
+    columna = simulador.mercado.estado.id_ubicacion.get(request.args.get('ubicacion'))
+    if not recurso or columna is None:
+        return jsonify({'error': 'Recurso o ubicación no encontrados', 'exito': False}), 404
+    
+    with simulador.mercado.ordenes.lock:
+        profundidad = simulador.mercado.ordenes.libro(recurso, columna).profundidad()
     return jsonify({
-        'exito': exito,
-        'dinero': simulador.jugador.dinero,
-        'inventario': simulador.jugador.inventario,
-        'capacidad_usada': simulador.jugador.capacidad_usada,
-        'mensaje': f'Vendiste {cantidad}x {recurso_nombre}' if exito else 'No se pudo completar la venta'
+        'recurso': recurso.nombre,
+        'ubicacion': request.args.get('ubicacion'),
+        'compras': [{'precio': p, 'cantidad': c} for p, c in profundidad['compras']],
+        'ventas': [{'precio': p, 'cantidad': c} for p, c in profundidad['ventas']]
+    })
+
+# ============================================
+# STREAM DE EVENTOS (SSE)
+# ============================================
+
+def publicar_comercio(sesion, recursos):
+    """Publica los recursos afectados por una operación y el nuevo estado del jugador"""
+    jugador = sesion.jugador
+    simulador.eventos.publicar('comercio', {
+        'version': simulador.mercado.version,
+        'recursos': [simulador.mercado.delta_recurso(recurso) for recurso in recursos],
+        'regiones': []
+    }, sesion.sesion_id, {
+        'dinero': jugador.dinero,
+        'capacidad_usada': jugador.capacidad_usada,
+        'inventario': {recurso.nombre: jugador.inventario.get(recurso.nombre, 0) for recurso in recursos}
     })
 
+@app.route('/api/stream', methods=['GET'])
+def stream_eventos():
+    """Envía los cambios del mercado en cuanto ocurren (Server-Sent Events)"""
+    suscriptor = simulador.eventos.suscribir(sesion_actual(crear=False).sesion_id)
+    
+    def eventos():
+        try:
+            yield f"event: hola\ndata: {{\"version\": {simulador.mercado.version}}}\n\n"
+            while not suscriptor.descartado:
+                try:
+                    yield suscriptor.cola.get(timeout=15)
+                except queue.Empty:
+                    yield ": ping\n\n"  # Mantiene viva la conexión
+        finally:
+            simulador.eventos.desuscribir(suscriptor)
+    
+    respuesta = Response(stream_with_context(eventos()), mimetype='text/event-stream')
+    respuesta.headers['Cache-Control'] = 'no-cache'
+    return respuesta
+
+def ejecutar_turno():
+    """Un turno completo; lo llama el hilo del reloj. Devuelve las ejecuciones"""
+    previa = simulador.mercado.instantanea() if simulador.eventos.suscriptores else None
+    # Con memoria compartida solo el propietario avanza el mercado; los demás
+    # procesos casan sus propios libros de órdenes, y reclaman la propiedad en
+    # cada turno por si el propietario terminó
+    n_turnos = 1 if memoria_mercado is None or memoria_mercado.reclamar() else 0
+    with turno_lock, escritura_mercado(regional=True):
+        # El turno y el casamiento se registran ellos mismos (ver Mercado.diario)
+        if n_turnos:
+            simulador.mercado.simular_mercado(n_turnos)
+            simulador.turno += n_turnos
+        ejecuciones = simulador.mercado.ordenes.casar()
+        # Sin turno nuevo no hay instantánea: se repetiría la del último múltiplo
+        if n_turnos and simulador.turno % INSTANTANEA_CADA == 0:
+            persistencia.guardar(simulador)
+    if previa is not None:
+        cambios = simulador.mercado.cambios_desde(previa)
+        simulador.eventos.publicar('turno', dict(cambios, turno=simulador.turno,
+                                                 version=simulador.mercado.version))
+    return len(ejecuciones)
+
+# Los turnos corren en su propio hilo cada KEYO_TURNO_SEGUNDOS (0: solo a
+# petición), en cada proceso
+reloj = RelojMercado(ejecutar_turno, float(os.environ.get('KEYO_TURNO_SEGUNDOS', 30)))
+
+@app.before_request
+def iniciar_reloj():
+    """Arranca el reloj con la primera petición (no en el proceso vigía del recargador)"""
+    reloj.iniciar()
+
 @app.route('/api/simular_turno', methods=['POST'])
 def simular_turno():
-    """Avanza un turno"""
-    simulador.mercado.simular_mercado()
-    simulador.turno += 1
-    return jsonify({'turno': simulador.turno, 'mensaje': 'Mercado actualizado'})
+    """Pide un turno: se junta con el siguiente del reloj (?esperar=1 espera a que ocurra)
+
+    Con memoria compartida solo el proceso propietario avanza el mercado; en
+    los demás la petición no haría avanzar nada y responde 409.
+    """
+    if memoria_mercado is not None and not memoria_mercado.reclamar():
+        return jsonify({
+            'exito': False,
+            'turno': simulador.turno,
+            'mensaje': 'Este proceso no avanza el mercado compartido; el turno lo decide el reloj del propietario'
+        }), 409
+    esperar = request.args.get('esperar', '').lower() in ('1', 'true', 'si')
+    turno = simulador.turno
+    siguiente = reloj.solicitar(esperar=esperar, timeout=max(reloj.periodo, reloj.intervalo_minimo) + 5)
+    respuesta = {'turno': simulador.turno, 'turno_siguiente': turno + 1, 'mensaje': 'Turno solicitado'}
+    if esperar and reloj.completados >= siguiente:
+        respuesta.update(ejecuciones=reloj.resultado, mensaje='Mercado actualizado')
+    return jsonify(respuesta)
 
 # ============================================
 # API INVENTARIO
@@ -169,26 +583,64 @@ def simular_turno():
 @app.route('/api/jugador', methods=['GET'])
 def obtener_jugador():
     """Estado del jugador"""
-    # Calcular valor de recursos
-    valor_recursos = 0
-    for nombre, cantidad in simulador.jugador.inventario.items():
-        if nombre in simulador.mercado.recursos:
-            valor_recursos += simulador.mercado.recursos[nombre].precio_actual * cantidad
+    sesion = sesion_actual(crear=False)
+    with sesion.lock:
+        jugador = sesion.jugador
+        etag = etag_jugador(jugador)
+        if request.if_none_match.contains(etag):
+            return no_modificado(etag, por_jugador=True)
+        
+        # El patrimonio lo mantiene el ranking; con el lock tomado está al día.
+        # Un invitado no está en el ranking: solo tiene su dinero inicial.
+        # La posición no va aquí: cambia con los demás jugadores y el ETag no
+        # la cubre (está en /api/ranking)
+        _, propia = simulador.ranking.consultar(0, sesion.sesion_id)
+        patrimonio = propia[1].patrimonio if propia else jugador.dinero
+        dinero = jugador.dinero + jugador.dinero_retenido
+        
+        respuesta = jsonify({
+            'nombre': jugador.nombre,
+            'dinero': jugador.dinero,
+            'inventario': jugador.inventario,
+            'dinero_retenido': jugador.dinero_retenido,
+            'inventario_retenido': jugador.retenido,
+            'capacidad_max': jugador.capacidad_max,
+            'capacidad_usada': jugador.capacidad_usada,
+            'valor_recursos': round(patrimonio - dinero, 2),
+            'patrimonio_total': round(patrimonio, 2)
+        })
+    
+    respuesta.set_etag(etag)
+    respuesta.vary.add('Cookie')
+    return respuesta
+
+@app.route('/api/ranking', methods=['GET'])
+def obtener_ranking():
+    """Los N jugadores con más patrimonio y la posición del jugador actual"""
+    n = max(1, min(request.args.get('n', 10, type=int), 100))
+    sesion = sesion_actual(crear=False)
+    primeros, propia = simulador.ranking.consultar(n, sesion.sesion_id)
+    
+    def fila(posicion, entrada):
+        return {'posicion': posicion, 'nombre': entrada.jugador.nombre, 'patrimonio': round(entrada.patrimonio, 2)}
     
     return jsonify({
-        'nombre': simulador.jugador.nombre,
-        'dinero': simulador.jugador.dinero,
-        'inventario': simulador.jugador.inventario,
-        'capacidad_max': simulador.jugador.capacidad_max,
-        'capacidad_usada': simulador.jugador.capacidad_usada,
-        'valor_recursos': round(valor_recursos, 2),
-        'patrimonio_total': round(simulador.jugador.dinero + valor_recursos, 2)
+        'exito': True,
+        'jugadores': len(simulador.ranking),
+        'ranking': [fila(*par) for par in primeros],
+        'jugador': fila(*propia) if propia else None
     })
 
 @app.route('/api/optimizar_inventario', methods=['GET'])
 def optimizar_inventario():
     """Optimiza inventario con DP"""
-    recomendaciones = simulador.jugador.optimizar_inventario_mochila(simulador.mercado)
+    sesion = sesion_actual(crear=False)
+    with sesion.lock:
+        etag = etag_jugador(sesion.jugador)
+        if request.if_none_match.contains(etag):
+            return no_modificado(etag, por_jugador=True)
+        ubicacion = request.args.get('ubicacion') or None
+        recomendaciones, exacta = sesion.jugador.optimizar_inventario_mochila(simulador.mercado, ubicacion)
     
     resultado = []
     for recurso, cantidad in recomendaciones:
@@ -201,53 +653,147 @@ def optimizar_inventario():
             'peso_total': recurso.peso * cantidad
         })
     
-    return jsonify(resultado)
+    respuesta = jsonify(resultado)
+    # El cuerpo sigue siendo la lista; si la búsqueda se cortó por presupuesto se avisa aquí
+    respuesta.headers['X-Solucion'] = 'exacta' if exacta else 'aproximada'
+    respuesta.set_etag(etag)
+    respuesta.vary.add('Cookie')
+    return respuesta
 
 @app.route('/api/estadisticas', methods=['GET'])
 def obtener_estadisticas():
     """Obtiene estadísticas del mercado"""
-    recursos = list(simulador.mercado.recursos.values())
-    
-    # Calcular estadísticas generales
-    precio_promedio = sum(r.precio_actual for r in recursos) / len(recursos)
-    demanda_promedio = sum(r.demanda for r in recursos) / len(recursos)
-    oferta_promedio = sum(r.oferta for r in recursos) / len(recursos)
+    ubicacion = request.args.get('ubicacion') or None
+    etag = f'{etag_mercado(simulador.mercado.version)}-t{simulador.turno}'
+    if request.if_none_match.contains(etag):
+        return no_modificado(etag)
     
-    # Recursos más valiosos
-    mas_valiosos = sorted(recursos, key=lambda r: r.precio_actual, reverse=True)[:5]
+    estadisticas = simulador.mercado.obtener_estadisticas(5, ubicacion)
     
-    # Recursos con mayor demanda
-    mayor_demanda = sorted(recursos, key=lambda r: r.demanda, reverse=True)[:5]
-    
-    return jsonify({
-        'precio_promedio': round(precio_promedio, 2),
-        'demanda_promedio': round(demanda_promedio, 2),
-        'oferta_promedio': round(oferta_promedio, 2),
+    resultado = {
+        'precio_promedio': round(estadisticas['precio_promedio'], 2),
+        'demanda_promedio': round(estadisticas['demanda_promedio'], 2),
+        'oferta_promedio': round(estadisticas['oferta_promedio'], 2),
         'turno_actual': simulador.turno,
         'recursos_mas_valiosos': [
-            {'nombre': r.nombre, 'precio': round(r.precio_actual, 2)} 
-            for r in mas_valiosos
+            {'nombre': r.nombre, 'precio': round(precio, 2)} 
+            for r, precio in estadisticas['mas_valiosos']
         ],
         'recursos_mayor_demanda': [
-            {'nombre': r.nombre, 'demanda': r.demanda} 
-            for r in mayor_demanda
+            {'nombre': r.nombre, 'demanda': demanda} 
+            for r, demanda in estadisticas['mayor_demanda']
         ]
+    }
+    if 'stock_total' in estadisticas:
+        resultado['ubicacion'] = ubicacion
+        resultado['stock_total'] = estadisticas['stock_total']
+    
+    respuesta = jsonify(resultado)
+    respuesta.set_etag(etag)
+    return respuesta
+
+@app.route('/api/historial', methods=['GET'])
+def obtener_historial():
+    """Velas OHLC de un recurso (global o en una ubicación) en una ventana de turnos"""
+    recurso = simulador.mercado.buscar_recurso(request.args.get('recurso', ''))
+    if not recurso:
+        return jsonify({'error': 'Recurso no encontrado', 'exito': False}), 404
+    
+    ubicacion = request.args.get('ubicacion') or None
+    columna = None
+    if ubicacion:
+        columna = simulador.mercado.estado.id_ubicacion.get(ubicacion)
+        if columna is None:
+            return jsonify({'error': 'Ubicación no encontrada', 'exito': False}), 404
+    
+    # El historial lo lleva cada proceso: su ETag es de este arranque
+    etag = f'h{ARRANQUE}.{simulador.mercado.version}'
+    if request.if_none_match.contains(etag):
+        return no_modificado(etag)
+    
+    turnos = request.args.get('turnos', 100, type=int)
+    puntos = request.args.get('puntos', 50, type=int)
+    velas = simulador.mercado.historial.consultar(recurso.indice, columna, turnos, puntos)
+    if velas is None:
+        return jsonify({'error': 'Historial regional desactivado (KEYO_HISTORIAL_REGIONAL=1)', 'exito': False}), 404
+    
+    respuesta = jsonify({
+        'recurso': recurso.nombre,
+        'ubicacion': ubicacion,
+        'velas': velas
+    })
+    respuesta.set_etag(etag)
+    return respuesta
+
+# Bandas ya calculadas: {(version, turnos, trayectorias, semilla): bandas},
+# solo de la última versión y como mucho MAX_PRONOSTICOS (se descartan las más viejas)
+pronosticos = {}
+pronosticos_lock = threading.Lock()
+MAX_PRONOSTICOS = 32
+
+@app.route('/api/pronostico', methods=['GET'])
+def pronosticar_precios():
+    """Bandas de percentiles del precio de cada recurso en los próximos turnos"""
+    nombre = request.args.get('recurso')
+    recurso = simulador.mercado.buscar_recurso(nombre) if nombre else None
+    if nombre and not recurso:
+        return jsonify({'error': 'Recurso no encontrado', 'exito': False}), 404
+    
+    foto = simulador.mercado.foto
+    etag = etag_mercado(foto.version)
+    if request.if_none_match.contains(etag):
+        return no_modificado(etag)
+    
+    turnos = max(1, min(request.args.get('turnos', 10, type=int), 100))
+    trayectorias = max(1, min(request.args.get('trayectorias', 1000, type=int), 20000))
+    # Sin semilla, la de la versión: el mismo mercado da siempre el mismo pronóstico
+    semilla = request.args.get('semilla', foto.version, type=int)
+    
+    clave = (foto.version, turnos, trayectorias, semilla)
+    bandas = pronosticos.get(clave)
+    if bandas is None:
+        bandas = pronosticador.pronosticar(simulador.mercado, turnos, trayectorias, semilla, foto=foto)
+        with pronosticos_lock:
+            if pronosticos and next(iter(pronosticos))[0] != foto.version:
+                pronosticos.clear()
+            while len(pronosticos) >= MAX_PRONOSTICOS:
+                del pronosticos[next(iter(pronosticos))]
+            pronosticos[clave] = bandas
+    
+    recursos = [recurso] if recurso else simulador.mercado.por_indice[:len(bandas)]
+    respuesta = jsonify({
+        'exito': True,
+        'turnos': turnos,
+        'trayectorias': trayectorias,
+        'semilla': semilla,
+        'percentiles': list(PERCENTILES),
+        'recursos': [{
+            'nombre': r.nombre,
+            'precio_actual': foto.precio_actual[r.indice],
+            'bandas': {f'p{p}': [round(precio, 2) for precio in serie]
+                       for p, serie in bandas[r.indice].items()}
+        } for r in recursos]
     })
+    respuesta.set_etag(etag)
+    return respuesta
 # ============================================
 # API RUTAS
 # ============================================
 
 @app.route('/api/calcular_ruta', methods=['POST'])
 def calcular_ruta():
-    """Calcula ruta óptima con Dijkstra"""
+    """Calcula ruta óptima (A* con hitos sobre el mapa en CSR)"""
     data = request.json
     origen = data['origen']
     destino = data['destino']
     
-    print(f"🔍 Calculando ruta: {origen} → {destino}")
-    print(f"📦 Inventario actual: {simulador.jugador.inventario}")
+    sesion = sesion_actual(crear=False)
+    with sesion.lock:
+        inventario = dict(sesion.jugador.inventario)
     
-    distancia, costo, camino = simulador.grafo.dijkstra(origen, destino)
+    log.debug("Calculando ruta %s -> %s inventario=%s", origen, destino, inventario)
+    
+    distancia, costo, camino = simulador.grafo.ruta(origen, destino)
     
     if camino:
         # Calcular tiempo (1 minuto por cada 10 km)
@@ -257,23 +803,12 @@ def calcular_ruta():
         ganancia = 0
         detalles_ganancia = []
         
-        print(f"💰 Analizando recursos para vender en {destino}...")
-        
         # Revisar cada recurso en el inventario
-        for nombre_recurso, cantidad in simulador.jugador.inventario.items():
-            print(f"  🔎 Revisando: {nombre_recurso} x{cantidad}")
-            
+        for nombre_recurso, cantidad in inventario.items():
             # Buscar recurso (case-insensitive)
-            recurso = None
-            for nombre, r in simulador.mercado.recursos.items():
-                if nombre.lower() == nombre_recurso.lower():
-                    recurso = r
-                    break
+            recurso = simulador.mercado.buscar_recurso(nombre_recurso)
             
             if recurso:
-                print(f"    📍 Ubicación del recurso: {recurso.ubicacion}")
-                print(f"    🎯 Destino: {destino}")
-                
                 # Si el recurso se vende bien en el destino (ubicación coincide)
                 if recurso.ubicacion.lower() == destino.lower():
                     # Precio de venta con 10% de comisión
@@ -287,19 +822,13 @@ def calcular_ruta():
                         'precio_unitario': round(precio_venta, 2),
                         'ganancia_total': round(ganancia_recurso, 2)
                     })
-                    
-                    print(f"    ✅ VENDIBLE: ${round(ganancia_recurso, 2)}")
-                else:
-                    print(f"    ❌ No vendible en {destino}")
             else:
-                print(f"    ⚠️ Recurso no encontrado en mercado")
+                log.debug("Recurso del inventario no encontrado en el mercado: %s", nombre_recurso)
         
         # Restar el costo del viaje
         ganancia_neta = round(ganancia - costo, 2)
         
-        print(f"📊 Ganancia bruta: ${ganancia}")
-        print(f"💸 Costo viaje: ${costo}")
-        print(f"💰 Ganancia neta: ${ganancia_neta}")
+        log.debug("Ruta %s -> %s bruta=%.2f costo=%s neta=%s", origen, destino, ganancia, costo, ganancia_neta)
         
         # Determinar nivel de riesgo
         if distancia < 200:
@@ -326,6 +855,48 @@ def calcular_ruta():
             'mensaje': 'No hay ruta disponible'
         }), 404
 
+@app.route('/api/arbitraje', methods=['GET'])
+def escanear_arbitraje():
+    """Mejores combinaciones (región de compra, región de venta, recurso)"""
+    k = max(1, min(request.args.get('k', 10, type=int), 100))
+    sesion = sesion_actual(crear=False)
+    with sesion.lock:
+        jugador = sesion.jugador
+        capacidad = jugador.capacidad_max - jugador.capacidad_usada
+        dinero = jugador.dinero
+    
+    oportunidades = simulador.mercado.escanear_arbitraje(simulador.grafo, capacidad, dinero, k)
+    for oportunidad in oportunidades:
+        for campo in ('precio_compra', 'precio_venta', 'ganancia_neta'):
+            oportunidad[campo] = round(oportunidad[campo], 2)
+    
+    return jsonify({'exito': True, 'oportunidades': oportunidades})
+
+@app.route('/api/planificar_ruta', methods=['POST'])
+def planificar_ruta():
+    """Itinerario de varias paradas comprando y vendiendo en cada ciudad"""
+    data = request.json or {}
+    if not isinstance(data, dict):
+        return jsonify({'exito': False, 'mensaje': 'Se espera un objeto JSON'}), 400
+    origen = data.get('origen')
+    try:
+        max_paradas = max(1, min(int(data.get('max_paradas', 4)), 8))
+        tiempo_ms = max(1, min(int(data.get('tiempo_ms', 50)), 1000))
+    except (TypeError, ValueError, OverflowError):
+        return jsonify({'exito': False, 'mensaje': 'max_paradas y tiempo_ms deben ser números'}), 400
+    
+    sesion = sesion_actual(crear=False)
+    with sesion.lock:
+        jugador = sesion.jugador
+        capacidad = jugador.capacidad_max - jugador.capacidad_usada
+        dinero = jugador.dinero
+    
+    plan = simulador.planificador.planificar(origen, capacidad, dinero, max_paradas, tiempo_ms)
+    if plan is None:
+        return jsonify({'exito': False, 'mensaje': f'Ciudad desconocida: {origen}'}), 404
+    
+    return jsonify(dict(plan, exito=True))
+
 if __name__ == '__main__':
     print("\n" + "="*60)
     print("🚀 SERVIDOR MARKET KEYO")
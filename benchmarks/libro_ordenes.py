@@ -0,0 +1,50 @@
+"""Rendimiento del libro de órdenes: inserción, cancelación y casado por lotes
+
+Uso: python benchmarks/libro_ordenes.py [n_ordenes]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from juego import LibroOrdenes, Orden
+
+
+def medir(n_ordenes=200_000, tamano_lote=1000, semilla=42):
+    rng = random.Random(semilla)
+    libro = LibroOrdenes()
+    # Órdenes preparadas de antemano: solo se mide el libro
+    ordenes = [
+        Orden(i, None, 'compra' if rng.random() < 0.5 else 'venta', None, 0,
+              round(rng.gauss(100, 2), 1), rng.randint(1, 20), i)
+        for i in range(n_ordenes)
+    ]
+    cancelar = set(rng.sample(range(n_ordenes), n_ordenes // 10))
+    
+    ejecuciones = 0
+    inicio = time.perf_counter()
+    for i, orden in enumerate(ordenes):
+        libro.agregar(orden)
+        if i in cancelar:
+            libro.cancelar(i)
+        if i % tamano_lote == tamano_lote - 1:
+            ejecuciones += len(libro.casar())
+    ejecuciones += len(libro.casar())
+    segundos = time.perf_counter() - inicio
+    
+    return {
+        'ordenes': n_ordenes,
+        'cancelaciones': len(cancelar),
+        'ejecuciones': ejecuciones,
+        'segundos': round(segundos, 4),
+        'ordenes_por_segundo': round(n_ordenes / segundos)
+    }
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    resultado = medir(n)
+    for clave, valor in resultado.items():
+        print(f"{clave}: {valor}")
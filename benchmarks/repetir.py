@@ -0,0 +1,174 @@
+"""Prueba de carga: reproduce tráfico grabado contra la API
+
+El tráfico se graba arrancando el servidor con KEYO_GRABAR=trafico.jsonl.
+Cada sesión grabada se reproduce en orden con su propio cliente (y su propia
+cookie); las sesiones se reparten entre los hilos.
+
+Uso: python benchmarks/repetir.py trafico.jsonl [--concurrencia N]
+         [--repeticiones N] [--url http://localhost:5000] [--informe salida.json]
+
+Sin --url las peticiones pasan por app.test_client() en el mismo proceso.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from metricas import percentil
+
+# El stream SSE no termina nunca: no tiene sentido reproducirlo
+RUTAS_EXCLUIDAS = ('/api/stream',)
+
+
+def cargar(ruta):
+    """Agrupa la grabación por sesión, manteniendo el orden de cada una"""
+    sesiones = defaultdict(list)
+    sueltas = []  # Peticiones sin cookie: cada una es independiente
+    with open(ruta, encoding='utf-8') as f:
+        for linea in f:
+            linea = linea.strip()
+            if not linea:
+                continue
+            registro = json.loads(linea)
+            if registro['regla'] in RUTAS_EXCLUIDAS:
+                continue
+            if registro.get('sesion'):
+                sesiones[registro['sesion']].append(registro)
+            else:
+                sueltas.append([registro])
+    return list(sesiones.values()) + sueltas
+
+
+class ClientePrueba:
+    """Cliente en proceso sobre app.test_client(); guarda la cookie de sesión"""
+
+    def __init__(self, app):
+        self.cliente = app.test_client()
+
+    def enviar(self, metodo, ruta, cuerpo):
+        respuesta = self.cliente.open(ruta, method=metodo, json=cuerpo)
+        return respuesta.status_code
+
+
+class ClienteHTTP:
+    """Cliente contra un servidor real, con su propio tarro de cookies"""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def enviar(self, metodo, ruta, cuerpo):
+        datos = json.dumps(cuerpo).encode('utf-8') if cuerpo is not None else None
+        peticion = urllib.request.Request(self.url + ruta, data=datos, method=metodo)
+        if datos is not None:
+            peticion.add_header('Content-Type', 'application/json')
+        try:
+            with self.opener.open(peticion) as respuesta:
+                respuesta.read()
+                return respuesta.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+
+def repetir(sesiones, crear_cliente, concurrencia=4, repeticiones=1):
+    """Reproduce las sesiones y devuelve las latencias por ruta"""
+    pendientes = queue.Queue()
+    for _ in range(repeticiones):
+        for sesion in sesiones:
+            pendientes.put(sesion)
+
+    latencias = defaultdict(list)
+    errores = defaultdict(int)
+    lock = threading.Lock()
+
+    def trabajador():
+        while True:
+            try:
+                sesion = pendientes.get_nowait()
+            except queue.Empty:
+                return
+            cliente = crear_cliente()
+            for registro in sesion:
+                clave = f"{registro['metodo']} {registro['regla']}"
+                inicio = time.perf_counter()
+                try:
+                    estado = cliente.enviar(registro['metodo'], registro['ruta'], registro.get('cuerpo'))
+                except OSError:
+                    estado = None
+                ms = (time.perf_counter() - inicio) * 1000
+                with lock:
+                    latencias[clave].append(ms)
+                    if estado is None or estado >= 500:
+                        errores[clave] += 1
+
+    inicio = time.perf_counter()
+    hilos = [threading.Thread(target=trabajador) for _ in range(concurrencia)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    segundos = time.perf_counter() - inicio
+
+    total = sum(len(v) for v in latencias.values())
+    rutas = {}
+    for clave, valores in sorted(latencias.items()):
+        valores.sort()
+        rutas[clave] = {
+            'peticiones': len(valores),
+            'errores': errores[clave],
+            'p50_ms': round(percentil(valores, 50), 3),
+            'p95_ms': round(percentil(valores, 95), 3),
+            'p99_ms': round(percentil(valores, 99), 3),
+            'max_ms': round(valores[-1], 3)
+        }
+    return {
+        'peticiones': total,
+        'segundos': round(segundos, 3),
+        'peticiones_por_segundo': round(total / segundos, 1) if segundos > 0 else 0.0,
+        'concurrencia': concurrencia,
+        'rutas': rutas
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('grabacion')
+    parser.add_argument('--concurrencia', type=int, default=4)
+    parser.add_argument('--repeticiones', type=int, default=1)
+    parser.add_argument('--url', help='servidor a probar; sin él se usa app.test_client()')
+    parser.add_argument('--informe', help='fichero JSON donde guardar el resultado')
+    args = parser.parse_args()
+
+    sesiones = cargar(args.grabacion)
+    if args.url:
+        crear_cliente = lambda: ClienteHTTP(args.url)
+    else:
+        from app import app
+        crear_cliente = lambda: ClientePrueba(app)
+
+    resultado = repetir(sesiones, crear_cliente, args.concurrencia, args.repeticiones)
+
+    print(f"{resultado['peticiones']} peticiones en {resultado['segundos']} s "
+          f"({resultado['peticiones_por_segundo']} pet/s, concurrencia {resultado['concurrencia']})")
+    print(f"{'ruta':40} {'n':>6} {'err':>4} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for clave, r in resultado['rutas'].items():
+        print(f"{clave:40} {r['peticiones']:>6} {r['errores']:>4} "
+              f"{r['p50_ms']:>9} {r['p95_ms']:>9} {r['p99_ms']:>9}")
+
+    if args.informe:
+        with open(args.informe, 'w', encoding='utf-8') as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
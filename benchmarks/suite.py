@@ -0,0 +1,165 @@
+"""Micro-benchmarks de los algoritmos del núcleo sobre mundos generados
+
+Mide dijkstra, simular_mercado, obtener_recursos_por_ubicacion y la mochila
+para varios tamaños de mundo, y el rendimiento del pronóstico Monte Carlo con
+uno y con todos los núcleos, y escribe un informe JSON.
+
+Comprueba además el coste del historial de precios: la memoria por recurso y
+lo que encarece el turno. Si alguna comprobación falla termina con código 1.
+
+Uso: python benchmarks/suite.py [informe.json] [--rapido] [--grande]
+"""
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from juego import HistorialPrecios, Jugador, SimuladorComercio
+import libro_ordenes
+from pronostico import Pronosticador
+
+# (ciudades, recursos)
+TAMANOS = [(10, 8), (100, 50), (1000, 200)]
+TAMANO_GRANDE = (5000, 500)
+DENSIDAD = 2.0
+SEMILLA = 7
+# Límites del historial: bytes por recurso y turno con historial / turno sin él
+MAX_BYTES_HISTORIAL_RECURSO = 80_000
+MAX_SOBRECOSTE_HISTORIAL = 1.25
+
+
+def cronometrar(funcion, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    return {
+        'mediana_ms': round(statistics.median(tiempos), 4),
+        'min_ms': round(min(tiempos), 4),
+        'repeticiones': repeticiones
+    }
+
+
+def medir_mundo(n_ciudades, n_recursos, repeticiones):
+    inicio = time.perf_counter()
+    sim = SimuladorComercio.generar(n_ciudades, n_recursos, DENSIDAD, SEMILLA)
+    generacion_ms = (time.perf_counter() - inicio) * 1000
+
+    mercado, grafo = sim.mercado, sim.grafo
+    rng = random.Random(SEMILLA)
+    ciudades = sorted(grafo.ciudades)
+    pares = [(rng.choice(ciudades), rng.choice(ciudades)) for _ in range(repeticiones)]
+    ubicaciones = [rng.choice(mercado.estado.ubicaciones) for _ in range(repeticiones)]
+    jugador = Jugador("Benchmark")
+
+    def dijkstra():
+        # Sin caché de rutas: se mide el algoritmo, no el diccionario
+        grafo.rutas.clear()
+        grafo.dijkstra(*pares[rng.randrange(len(pares))])
+
+    def a_estrella():
+        grafo.csr.a_estrella(*pares[rng.randrange(len(pares))])
+
+    def por_ubicacion():
+        mercado.obtener_recursos_por_ubicacion(ubicaciones[rng.randrange(len(ubicaciones))])
+
+    def mochila():
+        mercado.optimizador.cache.clear()
+        jugador.optimizar_inventario_mochila(mercado)
+
+    grafo.csr  # Construir CSR e hitos fuera de la medición
+    turno = cronometrar(mercado.simular_mercado, repeticiones)
+    mercado.historial = HistorialPrecios(mercado.estado)
+    turno_historial = cronometrar(mercado.simular_mercado, repeticiones)
+    historial_bytes = mercado.historial.memoria()
+    mercado.historial = None
+    return {
+        'ciudades': n_ciudades,
+        'recursos': n_recursos,
+        'rutas': sum(len(destinos) for destinos in grafo.grafo.values()) // 2,
+        'generacion_ms': round(generacion_ms, 2),
+        'dijkstra': cronometrar(dijkstra, repeticiones),
+        'a_estrella': cronometrar(a_estrella, repeticiones),
+        'simular_mercado': turno,
+        'simular_mercado_historial': turno_historial,
+        'historial_bytes': historial_bytes,
+        'obtener_recursos_por_ubicacion': cronometrar(por_ubicacion, repeticiones),
+        'optimizar_inventario_mochila': cronometrar(mochila, max(1, repeticiones // 4))
+    }
+
+
+def medir_pronostico(rapido=False):
+    """Trayectorias por segundo con 1 proceso y con uno por núcleo"""
+    mercado = SimuladorComercio.generar(*TAMANOS[0], DENSIDAD, SEMILLA).mercado
+    trayectorias, turnos = (800, 10) if rapido else (4000, 20)
+    resultado = {'trayectorias': trayectorias, 'turnos': turnos, 'procesos': {}}
+    for procesos in sorted({1, os.cpu_count() or 1}):
+        pronosticador = Pronosticador(procesos)
+        pronosticador.pronosticar(mercado, 1, procesos * 100, SEMILLA)  # Arranque del pool fuera de la medición
+        inicio = time.perf_counter()
+        pronosticador.pronosticar(mercado, turnos, trayectorias, SEMILLA)
+        segundos = time.perf_counter() - inicio
+        pronosticador.cerrar()
+        resultado['procesos'][procesos] = round(trayectorias / segundos, 1)
+        print(f"pronostico, {procesos} procesos: {resultado['procesos'][procesos]} trayectorias/s")
+    return resultado
+
+
+def comprobar_historial(mundo):
+    """Fallos de las comprobaciones del historial en un mundo medido"""
+    fallos = []
+    por_recurso = mundo['historial_bytes'] / mundo['recursos']
+    if por_recurso > MAX_BYTES_HISTORIAL_RECURSO:
+        fallos.append(f"historial: {por_recurso:.0f} bytes por recurso (máximo {MAX_BYTES_HISTORIAL_RECURSO})")
+    # Con turnos de menos de 1 ms el cociente es sobre todo ruido
+    base = mundo['simular_mercado']['mediana_ms']
+    sobrecoste = mundo['simular_mercado_historial']['mediana_ms'] / base
+    if base >= 1 and sobrecoste > MAX_SOBRECOSTE_HISTORIAL:
+        fallos.append(f"historial: el turno cuesta {sobrecoste:.2f}x (máximo {MAX_SOBRECOSTE_HISTORIAL}x)")
+    return fallos
+
+
+def ejecutar(rapido=False, grande=False):
+    tamanos = TAMANOS + ([TAMANO_GRANDE] if grande else [])
+    repeticiones = 5 if rapido else 20
+    mundos = []
+    fallos = []
+    for n_ciudades, n_recursos in tamanos:
+        resultado = medir_mundo(n_ciudades, n_recursos, repeticiones)
+        mundos.append(resultado)
+        print(f"{n_ciudades} ciudades, {n_recursos} recursos:")
+        for clave, valor in resultado.items():
+            if isinstance(valor, dict):
+                print(f"  {clave}: {valor['mediana_ms']} ms")
+        print(f"  historial: {resultado['historial_bytes'] / 2 ** 20:.1f} MiB")
+        fallos.extend(f"{n_ciudades}x{n_recursos} {fallo}" for fallo in comprobar_historial(resultado))
+
+    return {
+        'fecha': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'semilla': SEMILLA,
+        'densidad': DENSIDAD,
+        'mundos': mundos,
+        'libro_ordenes': libro_ordenes.medir(20_000 if rapido else 200_000),
+        'pronostico': medir_pronostico(rapido),
+        'fallos': fallos
+    }
+
+
+if __name__ == '__main__':
+    argumentos = [a for a in sys.argv[1:] if not a.startswith('--')]
+    informe = ejecutar(rapido='--rapido' in sys.argv, grande='--grande' in sys.argv)
+    ruta = argumentos[0] if argumentos else 'benchmark.json'
+    with open(ruta, 'w', encoding='utf-8') as f:
+        json.dump(informe, f, indent=2, ensure_ascii=False)
+    print(f"Informe guardado en {ruta}")
+    for fallo in informe['fallos']:
+        print(f"FALLO {fallo}")
+    sys.exit(1 if informe['fallos'] else 0)
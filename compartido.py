@@ -0,0 +1,258 @@
+"""Estado numérico del mercado en memoria compartida entre procesos
+
+Cada proceso trabaja sobre su propio EstadoMercado y lo sincroniza con un
+bloque de multiprocessing.shared_memory:
+
+    cabecera  CABECERA (secuencia, version_global, version_regional,
+              version_mercado, turno, n_recursos, n_regiones, epoca)
+    arreglos  GLOBALES y luego REGIONALES, bytes crudos
+
+La lectura no toma ningún lock: es un seqlock. El escritor deja la secuencia
+impar mientras copia y la vuelve a hacer par al terminar; el lector copia y
+repite si la secuencia era impar o cambió entretanto. Las escrituras (comercios
+y turnos) se serializan entre procesos con un cerrojo de fichero.
+
+Solo se comparte el mercado: jugadores, órdenes limitadas, ranking e
+historial siguen siendo de cada proceso, así que las sesiones deben ir
+siempre al mismo. El historial de cada proceso registra lo que lee del bloque:
+un turno nuevo abre vela y los comercios ajenos entran en la vela abierta, con
+la resolución de las lecturas (cada petición), no la de cada comercio.
+
+La época es un número al azar fijado al crear el bloque: las versiones vuelven
+a empezar con cada bloque nuevo, y la época distingue las de uno y otro.
+
+Uno de los procesos es el propietario: el único que avanza los turnos. Lo es
+mientras tenga el flock exclusivo de {nombre}.propietario; si termina, el
+sistema lo suelta y otro proceso lo reclama en su siguiente turno. Cada
+proceso conectado tiene además un flock compartido sobre {nombre}.procesos:
+el bloque lo borra el último en cerrar (el que consigue el flock exclusivo),
+y uno que sigue existiendo sin nadie conectado es de una ejecución anterior
+que terminó sin cerrarlo. En Windows el sistema libera el bloque con el
+último proceso, así que allí solo se usa el del propietario.
+"""
+import os
+import random
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+CABECERA = struct.Struct('<8Q')
+SECUENCIA, VERSION_GLOBAL, VERSION_REGIONAL, VERSION_MERCADO, TURNO, N_RECURSOS, N_REGIONES, EPOCA = range(8)
+GLOBALES = (('precio_base', 'd'), ('precio_actual', 'd'), ('demanda', 'l'), ('oferta', 'l'), ('stock', 'l'))
+REGIONALES = (('precios_regionales', 'd'), ('stocks_regionales', 'l'))
+
+
+def _intentar_lock(fichero, exclusivo=True):
+    """Toma el lock del fichero sin esperar; devuelve si lo consiguió"""
+    try:
+        if fcntl is not None:
+            fcntl.flock(fichero.fileno(), (fcntl.LOCK_EX if exclusivo else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+        else:
+            fichero.seek(0)
+            msvcrt.locking(fichero.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+
+class CerrojoArchivo:
+    """Lock entre procesos sobre un fichero, y entre hilos del mismo proceso"""
+
+    def __init__(self, ruta):
+        self.hilos = threading.Lock()
+        self.fichero = open(ruta, 'a+b')
+
+    def __enter__(self):
+        self.hilos.acquire()
+        if fcntl is not None:
+            fcntl.flock(self.fichero.fileno(), fcntl.LOCK_EX)
+        else:
+            self.fichero.seek(0)
+            msvcrt.locking(self.fichero.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *excepcion):
+        if fcntl is not None:
+            fcntl.flock(self.fichero.fileno(), fcntl.LOCK_UN)
+        else:
+            self.fichero.seek(0)
+            msvcrt.locking(self.fichero.fileno(), msvcrt.LK_UNLCK, 1)
+        self.hilos.release()
+
+
+class MemoriaMercado:
+    """Bloque compartido con el estado de un Mercado y su turno"""
+
+    def __init__(self, nombre, simulador):
+        self.simulador = simulador
+        estado = simulador.mercado.estado
+        self.n_recursos, self.n_regiones = len(estado), estado.n_regiones
+
+        # Desplazamientos de cada arreglo dentro del bloque
+        self.posiciones = {}
+        posicion = CABECERA.size
+        for campo, tipo in GLOBALES + REGIONALES:
+            n_bytes = len(getattr(estado, campo)) * array(tipo).itemsize
+            self.posiciones[campo] = (posicion, n_bytes)
+            posicion += n_bytes
+
+        self.version_global = 0
+        self.version_regional = 0
+        ruta = os.path.join(tempfile.gettempdir(), nombre)
+        self.lock = CerrojoArchivo(f'{ruta}.lock')
+        self.fichero_propietario = open(f'{ruta}.propietario', 'a+b')
+        self.procesos = open(f'{ruta}.procesos', 'a+b') if fcntl is not None else None
+        self.propietario = False
+        # Bajo self.lock: nadie se conecta ni cierra mientras se decide crear o borrar
+        with self.lock:
+            if self.procesos is not None and _intentar_lock(self.procesos):
+                self._borrar_huerfano(nombre)
+            try:
+                self.memoria = shared_memory.SharedMemory(nombre, create=True, size=posicion)
+            except FileExistsError:
+                self.memoria = shared_memory.SharedMemory(nombre)
+            if self.procesos is not None:
+                # Nadie lo borra por su cuenta al salir (ni siquiera el resource
+                # tracker de quien lo creó): lo hace el último en cerrar
+                resource_tracker.unregister(self.memoria._name, 'shared_memory')
+                fcntl.flock(self.procesos.fileno(), fcntl.LOCK_SH)
+
+            cabecera = CABECERA.unpack_from(self.memoria.buf, 0)
+            if cabecera[VERSION_GLOBAL] == 0:
+                # Bloque recién creado: este proceso aporta el estado inicial
+                epoca = random.SystemRandom().getrandbits(63) or 1
+                CABECERA.pack_into(self.memoria.buf, 0, 0, 0, 0, 0, 0, self.n_recursos, self.n_regiones, epoca)
+                self.publicar(regional=True)
+            elif (cabecera[N_RECURSOS], cabecera[N_REGIONES]) != (self.n_recursos, self.n_regiones):
+                raise ValueError(f"El bloque '{nombre}' es de un mundo de otra forma")
+            self.epoca = self._cabecera(EPOCA)
+            self.leer()
+        self.reclamar()
+
+    @staticmethod
+    def _borrar_huerfano(nombre):
+        """Borra el bloque de una ejecución anterior, si quedó; con nadie conectado"""
+        try:
+            huerfano = shared_memory.SharedMemory(nombre)
+        except FileNotFoundError:
+            return
+        huerfano.close()
+        huerfano.unlink()
+
+    def reclamar(self):
+        """Intenta ser el propietario (el que avanza el mercado); devuelve si lo es"""
+        if not self.propietario:
+            self.propietario = _intentar_lock(self.fichero_propietario)
+        return self.propietario
+
+    def _cabecera(self, campo):
+        return struct.unpack_from('<Q', self.memoria.buf, campo * 8)[0]
+
+    def _fijar(self, campo, valor):
+        struct.pack_into('<Q', self.memoria.buf, campo * 8, valor)
+
+    def leer(self):
+        """Trae el estado compartido si cambió; no bloquea (seqlock). Devuelve si cambió"""
+        buf = self.memoria.buf
+        while True:
+            secuencia = self._cabecera(SECUENCIA)
+            if secuencia % 2:
+                time.sleep(0)  # Escritura en curso
+                continue
+            _, version_global, version_regional, version_mercado, turno, _, _, _ = CABECERA.unpack_from(buf, 0)
+            if version_global == self.version_global and version_regional == self.version_regional:
+                return False
+            campos = GLOBALES if version_global != self.version_global else ()
+            if version_regional != self.version_regional:
+                campos += REGIONALES
+            copias = {}
+            for campo, tipo in campos:
+                inicio, n_bytes = self.posiciones[campo]
+                copias[campo] = valores = array(tipo)
+                valores.frombytes(buf[inicio:inicio + n_bytes])
+            if self._cabecera(SECUENCIA) == secuencia:
+                break
+
+        mercado = self.simulador.mercado
+        estado = mercado.estado
+        historial = mercado.historial
+        # La primera lectura solo sincroniza: los turnos anteriores no son de este proceso
+        turnos = turno - self.simulador.turno if self.version_global else 0
+        # Con todos los locks de recursos: ni comercios locales a medias ni fotos mezcladas
+        regional = version_regional != self.version_regional
+        with mercado.bloquear(regional=regional):
+            for campo, valores in copias.items():
+                getattr(estado, campo)[:] = valores
+            if version_global != self.version_global:
+                estado.estadisticas.reconstruir_global()
+            if regional:
+                estado.estadisticas.reconstruir_regional()
+            if historial is not None and self.version_global:
+                if turnos > 0:
+                    historial.registrar_turno(turnos)
+                elif version_global != self.version_global:
+                    historial.registrar_todos()
+            if mercado.version == version_mercado:
+                mercado.publicar_foto(regional=regional)  # Al salir solo se publica si cambia la versión
+            mercado.version = version_mercado
+        self.version_global, self.version_regional = version_global, version_regional
+        self.simulador.turno = turno
+        if historial is not None and turnos > 0:
+            historial.registrar_turno_regional(turnos, mercado.foto)
+        return True
+
+    def publicar(self, regional=False):
+        """Copia el estado local al bloque; se llama con self.lock tomado"""
+        buf = self.memoria.buf
+        estado = self.simulador.mercado.estado
+        self._fijar(SECUENCIA, self._cabecera(SECUENCIA) + 1)  # Impar: escribiendo
+        for campo, _ in GLOBALES + (REGIONALES if regional else ()):
+            inicio, n_bytes = self.posiciones[campo]
+            buf[inicio:inicio + n_bytes] = memoryview(getattr(estado, campo)).cast('B')
+        self.version_global = self._cabecera(VERSION_GLOBAL) + 1
+        self._fijar(VERSION_GLOBAL, self.version_global)
+        if regional:
+            self.version_regional = self._cabecera(VERSION_REGIONAL) + 1
+            self._fijar(VERSION_REGIONAL, self.version_regional)
+        self._fijar(VERSION_MERCADO, self.simulador.mercado.version)
+        self._fijar(TURNO, self.simulador.turno)
+        self._fijar(SECUENCIA, self._cabecera(SECUENCIA) + 1)
+
+    @contextmanager
+    def escritura(self, regional=False):
+        """Contexto para modificar el mercado: lock, estado al día y publicación al salir
+
+        Si dentro no cambió la versión del mercado (operación rechazada) no se publica.
+        """
+        with self.lock:
+            self.leer()
+            version = self.simulador.mercado.version
+            yield
+            if self.simulador.mercado.version != version:
+                self.publicar(regional)
+
+    def cerrar(self):
+        """Se desconecta del bloque, y lo borra si es el último proceso conectado"""
+        with self.lock:
+            ultimo = self.procesos is not None and _intentar_lock(self.procesos)
+            self.memoria.close()
+            if ultimo:
+                # unlink lo da de baja en el resource tracker: antes hay que darlo de alta
+                resource_tracker.register(self.memoria._name, 'shared_memory')
+                self.memoria.unlink()
+            if self.procesos is not None:
+                self.procesos.close()
+        # Cerrar el fichero suelta la propiedad
+        self.fichero_propietario.close()
+        self.propietario = False
+
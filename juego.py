@@ -1,99 +1,1175 @@
+from array import array
+from bisect import bisect_left, bisect_right, insort
+import functools
 import heapq
-from collections import defaultdict
+import itertools
+import json
+import logging
+from collections import defaultdict, OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
+from operator import neg
+import queue
 import random
+import threading
 import time
+import uuid
+
+from metricas import cronometrado
+
+log = logging.getLogger('keyo.juego')
+
+class GrafoCSR:
+    """Adyacencia inmutable y sin aristas repetidas en formato CSR
+
+    Los vecinos de la ciudad i son destinos[inicio[i]:inicio[i + 1]], con sus
+    distancias y costos en las mismas posiciones. Los pesos se comparan como
+    (costo, distancia), igual que GrafoCiudades.dijkstra.
+    """
+
+    N_HITOS = 4
+
+    def __init__(self, grafo):
+        self.ciudades = sorted(grafo.ciudades)
+        self.id_ciudad = {ciudad: i for i, ciudad in enumerate(self.ciudades)}
+        self.inicio = array('l', [0])
+        self.destinos = array('l')
+        self.distancias = array('d')
+        self.costos = array('d')
+        
+        for ciudad in self.ciudades:
+            # Entre aristas repetidas se queda la más barata
+            vecinos = {}
+            for destino, distancia, costo in grafo.grafo.get(ciudad, ()):
+                j = self.id_ciudad[destino]
+                if j not in vecinos or (costo, distancia) < vecinos[j]:
+                    vecinos[j] = (costo, distancia)
+            for j in sorted(vecinos):
+                costo, distancia = vecinos[j]
+                self.destinos.append(j)
+                self.costos.append(costo)
+                self.distancias.append(distancia)
+            self.inicio.append(len(self.destinos))
+        self.hitos = None
+
+    def _camino(self, previos, inicio, fin):
+        camino = []
+        nodo = fin
+        while nodo != -1:
+            camino.append(self.ciudades[nodo])
+            nodo = previos.get(nodo, -1) if nodo != inicio else -1
+        camino.reverse()
+        return camino
+
+    def _costos_desde(self, origen):
+        """Costo mínimo desde un origen a todas las ciudades (para los hitos)"""
+        costos = [float('inf')] * len(self.ciudades)
+        costos[origen] = 0
+        cola = [(0, origen)]
+        while cola:
+            costo, u = heapq.heappop(cola)
+            if costo > costos[u]:
+                continue
+            for k in range(self.inicio[u], self.inicio[u + 1]):
+                v = self.destinos[k]
+                nuevo = costo + self.costos[k]
+                if nuevo < costos[v]:
+                    costos[v] = nuevo
+                    heapq.heappush(cola, (nuevo, v))
+        return costos
+
+    def _preparar_hitos(self):
+        """Elige hitos alejados entre sí y guarda sus costos a todas las ciudades"""
+        self.hitos = []
+        if not self.ciudades:
+            return
+        # Cada hito nuevo es la ciudad más lejana a los ya elegidos
+        lejanos = None
+        siguiente = 0
+        for _ in range(min(self.N_HITOS, len(self.ciudades))):
+            costos = self._costos_desde(siguiente)
+            self.hitos.append(costos)
+            lejanos = costos if lejanos is None else [min(a, b) for a, b in zip(lejanos, costos)]
+            siguiente = max((c, i) for i, c in enumerate(lejanos) if c != float('inf'))[1]
+
+    @cronometrado('a_estrella')
+    def a_estrella(self, inicio, fin):
+        """A* sobre costos con heurística de hitos (ALT); mismo resultado que dijkstra"""
+        s, t = self.id_ciudad.get(inicio), self.id_ciudad.get(fin)
+        if s is None or t is None:
+            return (0, 0, [inicio]) if inicio == fin else (None, None, None)
+        if self.hitos is None:
+            self._preparar_hitos()
+        
+        inf = float('inf')
+        hitos_t = [(costos, costos[t]) for costos in self.hitos if costos[t] != inf]
+        
+        def h(v):
+            mejor = 0
+            for costos, hasta_t in hitos_t:
+                cota = abs(hasta_t - costos[v]) if costos[v] != inf else inf
+                if cota > mejor:
+                    mejor = cota
+            return mejor
+        
+        etiquetas = {s: (0, 0)}  # (costo, distancia)
+        previos = {}
+        cola = [(h(s), 0, 0, s)]
+        cerrados = set()
+        while cola:
+            _, dist, costo, u = heapq.heappop(cola)
+            if u in cerrados:
+                continue
+            cerrados.add(u)
+            if u == t:
+                return dist, costo, self._camino(previos, s, t)
+            for k in range(self.inicio[u], self.inicio[u + 1]):
+                v = self.destinos[k]
+                if v in cerrados:
+                    continue
+                etiqueta = (costo + self.costos[k], dist + self.distancias[k])
+                if etiqueta < etiquetas.get(v, (inf, inf)):
+                    etiquetas[v] = etiqueta
+                    previos[v] = u
+                    heapq.heappush(cola, (etiqueta[0] + h(v), etiqueta[1], etiqueta[0], v))
+        return None, None, None
+
+    def dijkstra_bidireccional(self, inicio, fin):
+        """Dijkstra desde ambos extremos a la vez; para cuando los frentes no pueden mejorar"""
+        s, t = self.id_ciudad.get(inicio), self.id_ciudad.get(fin)
+        if s is None or t is None:
+            return (0, 0, [inicio]) if inicio == fin else (None, None, None)
+        if s == t:
+            return 0, 0, [inicio]
+        
+        inf = (float('inf'), float('inf'))
+        etiquetas = ({s: (0, 0)}, {t: (0, 0)})
+        previos = ({}, {})
+        colas = ([((0, 0), s)], [((0, 0), t)])
+        cerrados = (set(), set())
+        mejor, encuentro = inf, None
+        
+        while colas[0] and colas[1]:
+            tope_f, tope_b = colas[0][0][0], colas[1][0][0]
+            if (tope_f[0] + tope_b[0], tope_f[1] + tope_b[1]) >= mejor:
+                break
+            lado = 0 if tope_f <= tope_b else 1
+            etiqueta_u, u = heapq.heappop(colas[lado])
+            if u in cerrados[lado]:
+                continue
+            cerrados[lado].add(u)
+            propias, otras = etiquetas[lado], etiquetas[1 - lado]
+            for k in range(self.inicio[u], self.inicio[u + 1]):
+                v = self.destinos[k]
+                etiqueta = (etiqueta_u[0] + self.costos[k], etiqueta_u[1] + self.distancias[k])
+                if etiqueta < propias.get(v, inf):
+                    propias[v] = etiqueta
+                    previos[lado][v] = u
+                    heapq.heappush(colas[lado], (etiqueta, v))
+                if v in otras:
+                    total = (propias[v][0] + otras[v][0], propias[v][1] + otras[v][1])
+                    if total < mejor:
+                        mejor, encuentro = total, v
+        
+        if encuentro is None:
+            return None, None, None
+        camino = self._camino(previos[0], s, encuentro)
+        nodo = encuentro
+        while nodo != t:
+            nodo = previos[1][nodo]
+            camino.append(self.ciudades[nodo])
+        return mejor[1], mejor[0], camino
+
 
 class GrafoCiudades:
+    MAX_MATRICES = 4
+    MAX_ORIGENES = 64   # Tablas de Dijkstra por origen en la caché LRU
+    MAX_PARES = 4096    # Rutas de A* por par (inicio, fin) en la caché LRU
+
     def __init__(self):
         self.grafo = defaultdict(list)
         self.ciudades = set()
+        self.matrices_costos = {}  # {tupla de ciudades: matriz de costos}, como mucho MAX_MATRICES
+        # Cachés LRU: un mismo origen o par no se calcula dos veces mientras siga en ellas
+        self.rutas = OrderedDict()       # {origen: (distancias, costos, predecesores)}
+        self.rutas_pares = OrderedDict()  # {(inicio, fin): (distancia, costo, camino)}
+        self.lock_rutas = threading.Lock()
+        self._csr = None
     
     def agregar_ruta(self, origen, destino, distancia, costo):
         self.grafo[origen].append((destino, distancia, costo))
         self.grafo[destino].append((origen, distancia, costo))
         self.ciudades.add(origen)
         self.ciudades.add(destino)
+        # El mapa cambió: las rutas ya calculadas dejan de ser válidas
+        with self.lock_rutas:
+            self.rutas.clear()
+            self.rutas_pares.clear()
+        self.matrices_costos = {}
+        self._csr = None
+
+    @property
+    def csr(self):
+        """Versión CSR del mapa, construida la primera vez que se usa"""
+        if self._csr is None:
+            self._csr = GrafoCSR(self)
+        return self._csr
     
-    #Algoritmo para encontrar la ruta optima entre ciudades
-    def dijkstra(self, inicio, fin):
-        distancias = {ciudad: float('inf') for ciudad in self.ciudades}
-        costos = {ciudad: float('inf') for ciudad in self.ciudades}
-        distancias[inicio] = 0
-        costos[inicio] = 0
+    def _dijkstra_desde(self, inicio):
+        """Dijkstra completo desde un origen, guardando solo predecesores"""
+        costos = {inicio: 0}
+        distancias = {inicio: 0}
+        predecesores = {inicio: None}
         
-        # Cola de prioridad: (costo_acumulado, distancia_acumulada, ciudad, camino)
-        cola = [(0, 0, inicio, [inicio])]
+        # Cola de prioridad: (costo_acumulado, distancia_acumulada, ciudad)
+        cola = [(0, 0, inicio)]
         visitados = set()
         
         while cola:
-            costo_actual, dist_actual, ciudad_actual, camino = heapq.heappop(cola)
+            costo_actual, dist_actual, ciudad_actual = heapq.heappop(cola)
             
             if ciudad_actual in visitados:
                 continue
             
             visitados.add(ciudad_actual)
             
-            # Si llegamos al destino
-            if ciudad_actual == fin:
-                return dist_actual, costo_actual, camino
-            
             # Explorar vecinos
-            for vecino, distancia, costo in self.grafo[ciudad_actual]:
+            for vecino, distancia, costo in self.grafo.get(ciudad_actual, ()):
                 if vecino not in visitados:
                     nuevo_costo = costo_actual + costo
                     nueva_dist = dist_actual + distancia
                     
-                    if nuevo_costo < costos[vecino]:
+                    if (nuevo_costo, nueva_dist) < (costos.get(vecino, float('inf')), distancias.get(vecino, float('inf'))):
                         costos[vecino] = nuevo_costo
                         distancias[vecino] = nueva_dist
-                        nuevo_camino = camino + [vecino]
-                        heapq.heappush(cola, (nuevo_costo, nueva_dist, vecino, nuevo_camino))
+                        predecesores[vecino] = ciudad_actual
+                        heapq.heappush(cola, (nuevo_costo, nueva_dist, vecino))
         
-        return None, None, None  # No hay ruta
+        return distancias, costos, predecesores
+
+    def _cache(self, cache, clave, calcular, maximo):
+        """Valor de una caché LRU, calculado (fuera del lock) si no está"""
+        with self.lock_rutas:
+            valor = cache.get(clave)
+            if valor is not None:
+                cache.move_to_end(clave)
+                return valor
+        valor = calcular()
+        with self.lock_rutas:
+            cache[clave] = valor
+            while len(cache) > maximo:
+                cache.popitem(last=False)
+        return valor
+
+    def rutas_desde(self, inicio):
+        """Tabla de Dijkstra de un origen, de la caché LRU o calculada"""
+        return self._cache(self.rutas, inicio, lambda: self._dijkstra_desde(inicio), self.MAX_ORIGENES)
+    
+    def matriz_costos(self, ciudades):
+        """Costo mínimo de viaje entre cada par de ciudades (inf si no hay ruta)
+
+        Una pasada de Dijkstra sobre el CSR por ciudad pedida; solo se guardan
+        las últimas MAX_MATRICES matrices.
+        """
+        clave = tuple(ciudades)
+        matriz = self.matrices_costos.get(clave)
+        if matriz is None:
+            csr = self.csr
+            ids = [csr.id_ciudad.get(ciudad) for ciudad in ciudades]
+            matriz = []
+            for origen, s in zip(ciudades, ids):
+                costos = csr._costos_desde(s) if s is not None else None
+                matriz.append([
+                    0 if destino == origen else costos[t] if costos is not None and t is not None else float('inf')
+                    for destino, t in zip(ciudades, ids)
+                ])
+            if len(self.matrices_costos) >= self.MAX_MATRICES:
+                self.matrices_costos.clear()
+            self.matrices_costos[clave] = matriz
+        return matriz
+    
+    def ruta(self, inicio, fin):
+        """Ruta óptima entre dos ciudades: (distancia, costo, camino), o Nones si no hay
+
+        A* con hitos sobre el CSR: mismo resultado que dijkstra, explorando solo
+        la parte del mapa que puede mejorar la ruta. Cada par se guarda en una
+        caché LRU de MAX_PARES rutas.
+        """
+        return self._cache(self.rutas_pares, (inicio, fin), lambda: self.csr.a_estrella(inicio, fin), self.MAX_PARES)
+    
+    #Algoritmo para encontrar la ruta optima entre ciudades
+    @cronometrado('dijkstra')
+    def dijkstra(self, inicio, fin):
+        """Ruta óptima desde la tabla de Dijkstra del origen (caché LRU de MAX_ORIGENES tablas)"""
+        distancias, costos, predecesores = self.rutas_desde(inicio)
+        
+        if fin not in predecesores:
+            return None, None, None  # No hay ruta
+        
+        # Reconstruir el camino siguiendo los predecesores
+        camino = []
+        ciudad = fin
+        while ciudad is not None:
+            camino.append(ciudad)
+            ciudad = predecesores[ciudad]
+        camino.reverse()
+        
+        return distancias[fin], costos[fin], camino
+
+UBICACIONES = [
+    "Torre Keio",
+    "Anillos de Datos",
+    "Bosque del Firmware",
+    "Minas de Silicio",
+    "Montaña",
+    "Refinería de Códigos",
+    "Puerto Cache",
+    "Valle Binario",
+    "Nodo Central"
+]
+
+
+class EstadisticasMercado:
+    """Sumas y órdenes por precio/demanda mantenidos al mutar el estado del mercado"""
+
+    def __init__(self, estado):
+        self.estado = estado
+        # Los comercios de recursos distintos pueden mutar las listas a la vez
+        self.lock = threading.Lock()
+        self.reconstruir()
+
+    def reconstruir(self):
+        """Recalcula todo desde los arreglos"""
+        self.reconstruir_global()
+        self.reconstruir_regional()
+
+    def reconstruir_global(self):
+        """Recalcula sumas y órdenes globales (tras un turno completo)"""
+        e = self.estado
+        # Listas ordenadas de (-valor, indice): el top-K son los primeros K elementos
+        orden_precio = sorted((-p, i) for i, p in enumerate(e.precio_actual))
+        orden_demanda = sorted((-d, i) for i, d in enumerate(e.demanda))
+        with self.lock:
+            self.suma_precio = sum(e.precio_actual)
+            self.suma_demanda = sum(e.demanda)
+            self.suma_oferta = sum(e.oferta)
+            self.orden_precio = orden_precio
+            self.orden_demanda = orden_demanda
+
+    def reconstruir_regional(self, sumas=None):
+        """Recalcula las sumas por región; los órdenes se rehacen al consultarlos
+
+        sumas, si se da, es (suma de precios, suma de stocks) por región ya
+        calculada fuera de los locks (ver DifusionRegional.calcular).
+        """
+        e = self.estado
+        n = e.n_regiones
+        if sumas is not None:
+            suma_precio_regional, suma_stock_regional = sumas
+        else:
+            # Columna a columna: cada región es una rebanada con todos los recursos
+            suma_precio_regional = [sum(e.precios_regionales[columna::n]) for columna in range(n)]
+            suma_stock_regional = [sum(e.stocks_regionales[columna::n]) for columna in range(n)]
+        with self.lock:
+            self.suma_precio_regional = suma_precio_regional
+            self.suma_stock_regional = suma_stock_regional
+            # Tras un turno cambian todas las celdas: ordenar cada región ahora
+            # costaría más que el turno, y solo se consultan unas pocas
+            self.orden_regional = [None] * n
+
+    def orden_de_region(self, columna):
+        """Lista (-precio, indice) de una región, construida si hace falta; con self.lock tomado"""
+        orden = self.orden_regional[columna]
+        if orden is None:
+            e = self.estado
+            precios = e.precios_regionales[columna::e.n_regiones]
+            orden = self.orden_regional[columna] = sorted(zip(map(neg, precios), range(len(precios))))
+        return orden
+
+    def _mover(self, orden, i, viejo, nuevo):
+        del orden[bisect_left(orden, (-viejo, i))]
+        insort(orden, (-nuevo, i))
+
+    def agregar_fila(self, i):
+        e = self.estado
+        with self.lock:
+            self.suma_precio += e.precio_actual[i]
+            self.suma_demanda += e.demanda[i]
+            self.suma_oferta += e.oferta[i]
+            insort(self.orden_precio, (-e.precio_actual[i], i))
+            insort(self.orden_demanda, (-e.demanda[i], i))
+            for orden in self.orden_regional:
+                if orden is not None:
+                    insort(orden, (-0.0, i))
+
+    def cambio_precio(self, i, viejo, nuevo):
+        with self.lock:
+            self.suma_precio += nuevo - viejo
+            self._mover(self.orden_precio, i, viejo, nuevo)
+
+    def cambio_demanda(self, i, viejo, nuevo):
+        with self.lock:
+            self.suma_demanda += nuevo - viejo
+            self._mover(self.orden_demanda, i, viejo, nuevo)
+
+    def cambio_oferta(self, i, viejo, nuevo):
+        with self.lock:
+            self.suma_oferta += nuevo - viejo
+
+    def cambio_regional(self, campo, celda, viejo, nuevo):
+        """Se llama con self.lock tomado, junto con la escritura de la celda"""
+        n = self.estado.n_regiones
+        columna = celda % n
+        if campo == 'precios':
+            self.suma_precio_regional[columna] += nuevo - viejo
+            if self.orden_regional[columna] is not None:
+                self._mover(self.orden_regional[columna], celda // n, viejo, nuevo)
+        else:
+            self.suma_stock_regional[columna] += nuevo - viejo
+
+
+class EstadoMercado:
+    """Estado numérico del mercado como arreglos contiguos, un índice por recurso"""
+
+    def __init__(self, ubicaciones=(), estadisticas=True):
+        """estadisticas=False omite sumas y órdenes (estados desechables como los del pronóstico)"""
+        self.precio_base = array('d')
+        self.precio_actual = array('d')
+        self.demanda = array('l')
+        self.oferta = array('l')
+        self.stock = array('l')
+
+        # Ubicaciones internadas: cada una es una columna de las matrices regionales
+        self.ubicaciones = list(ubicaciones)
+        self.id_ubicacion = {ubicacion: i for i, ubicacion in enumerate(self.ubicaciones)}
+        # Matrices recurso x región aplanadas por filas: [indice * n_regiones + columna]
+        self.precios_regionales = array('d')
+        self.stocks_regionales = array('l')
+        self.estadisticas = EstadisticasMercado(self) if estadisticas else None
+
+    def __len__(self):
+        return len(self.precio_base)
+
+    @property
+    def n_regiones(self):
+        return len(self.ubicaciones)
+
+    def agregar(self, precio_base, precio_actual, demanda, oferta, stock):
+        """Añade una fila al estado y devuelve su índice"""
+        self.precio_base.append(precio_base)
+        self.precio_actual.append(precio_actual)
+        self.demanda.append(demanda)
+        self.oferta.append(oferta)
+        self.stock.append(stock)
+        self.precios_regionales.extend(array('d', [0.0]) * self.n_regiones)
+        self.stocks_regionales.extend(array('l', [0]) * self.n_regiones)
+        indice = len(self.precio_base) - 1
+        self.estadisticas.agregar_fila(indice)
+        return indice
+
+    def fijar_precio(self, i, valor):
+        self.estadisticas.cambio_precio(i, self.precio_actual[i], valor)
+        self.precio_actual[i] = valor
+
+    def fijar_demanda(self, i, valor):
+        self.estadisticas.cambio_demanda(i, self.demanda[i], valor)
+        self.demanda[i] = valor
+
+    def fijar_oferta(self, i, valor):
+        self.estadisticas.cambio_oferta(i, self.oferta[i], valor)
+        self.oferta[i] = valor
+
+    def fijar_regional(self, campo, celda, valor):
+        matriz = self.precios_regionales if campo == 'precios' else self.stocks_regionales
+        # Celda y estadísticas a la vez: un orden construido entretanto no verá la celda a medias
+        with self.estadisticas.lock:
+            self.estadisticas.cambio_regional(campo, celda, matriz[celda], valor)
+            matriz[celda] = valor
+
+    def fila_regional(self, campo, indice):
+        """Valores de un recurso en todas las regiones (campo: 'precios' o 'stocks')"""
+        matriz = self.precios_regionales if campo == 'precios' else self.stocks_regionales
+        inicio = indice * self.n_regiones
+        return matriz[inicio:inicio + self.n_regiones]
+
+    def actualizar_precios(self, indices=None, rng=random, ruido=None):
+        """Recalcula precio = precio_base * (demanda/oferta) con ruido y límites
+
+        ruido, si se da, son los factores ya sorteados de la pasada completa.
+        """
+        uniform = rng.uniform
+        if indices is None:
+            if ruido is None:
+                ruido = [uniform(0.9, 1.1) for _ in range(len(self))]
+            # Una sola pasada sobre los arreglos completos
+            nuevos = [
+                max(b * 0.3, min(round(b * (d / max(o, 1)) * r, 2), b * 3))
+                for b, d, o, r in zip(self.precio_base, self.demanda, self.oferta, ruido)
+            ]
+            self.precio_actual[:] = array('d', nuevos)
+            if self.estadisticas is not None:
+                self.estadisticas.reconstruir_global()
+            return
+        for i in indices:
+            b = self.precio_base[i]
+            precio = round(b * (self.demanda[i] / max(self.oferta[i], 1)) * uniform(0.9, 1.1), 2)
+            self.fijar_precio(i, max(b * 0.3, min(precio, b * 3)))
+
+    def sortear_turno(self, n_turnos=1, rng=random):
+        """Sorteos de n turnos sin tocar el estado, para hacerlos fuera de los locks
+
+        Devuelve ([(pasos de demanda, pasos de oferta)] por turno, ruido de precios).
+        """
+        aleatorio = rng.random
+        n = len(self)
+        pasos = [
+            ([int(aleatorio() * 31) - 15 for _ in range(n)], [int(aleatorio() * 31) - 15 for _ in range(n)])
+            for _ in range(n_turnos)
+        ]
+        return pasos, [rng.uniform(0.9, 1.1) for _ in range(n)]
+
+    def avanzar(self, n_turnos=1, rng=random, sorteo=None):
+        """Avanza n turnos de oferta/demanda y reajusta precios una sola vez"""
+        pasos, ruido = sorteo if sorteo is not None else self.sortear_turno(n_turnos, rng)
+        demanda = list(self.demanda)
+        oferta = list(self.oferta)
+        for pasos_demanda, pasos_oferta in pasos:
+            demanda = [max(10, min(100, d + p)) for d, p in zip(demanda, pasos_demanda)]
+            oferta = [max(10, min(100, o + p)) for o, p in zip(oferta, pasos_oferta)]
+        self.demanda[:] = array('l', demanda)
+        self.oferta[:] = array('l', oferta)
+        # El precio solo depende del estado final, no hace falta calcularlo en cada turno
+        self.actualizar_precios(ruido=ruido)
+
+
+class TablaVelas:
+    """Velas OHLC de S series en buffers circulares, a varias resoluciones
+
+    Por nivel y campo hay un array plano [posición * S + serie]: las velas de
+    todas las series en una misma posición forman un tramo contiguo, así que
+    abrir o agregar velas son asignaciones de tramos y no bucles por serie.
+
+    Cada turno solo se escribe el nivel 0. Cuando una vela se cierra se agrega
+    a la del nivel siguiente, de modo que la vela abierta de un nivel L > 0
+    guarda solo sus sub-velas ya cerradas; al leerla se le suma la abierta.
+    Los campos de `ultimos` (demanda, oferta) guardan el último valor.
+    """
+
+    PRECIO = ('apertura', 'maximo', 'minimo', 'cierre')
+
+    def __init__(self, factor, niveles, capacidad, ultimos=()):
+        self.factor = factor
+        self.capacidad = capacidad
+        self.ultimos = tuple(ultimos)
+        self.campos = self.PRECIO + self.ultimos
+        self.n_series = 0
+        self.turno = 0
+        self.niveles = [{campo: array('d') for campo in self.campos} for _ in range(niveles)]
+
+    def memoria(self):
+        """Bytes ocupados por los buffers"""
+        return sum(a.itemsize * len(a) for arreglos in self.niveles for a in arreglos.values())
+
+    def _tramo(self, nivel, vela):
+        inicio = (vela % self.capacidad) * self.n_series
+        return slice(inicio, inicio + self.n_series)
+
+    def crecer(self, valores):
+        """Añade series al final; valores: {campo: valores de TODAS las series}
+
+        Las series nuevas arrancan con velas planas al valor dado en la vela
+        abierta de cada nivel.
+        """
+        anterior, total = self.n_series, len(valores['cierre'])
+        if total == anterior:
+            return
+        for arreglos in self.niveles:
+            for campo, viejo in arreglos.items():
+                nuevo = array('d', [0.0]) * (self.capacidad * total)
+                for posicion in range(self.capacidad if anterior else 0):
+                    nuevo[posicion * total:posicion * total + anterior] = viejo[posicion * anterior:(posicion + 1) * anterior]
+                arreglos[campo] = nuevo
+        self.n_series = total
+        for nivel, arreglos in enumerate(self.niveles):
+            inicio = self._tramo(nivel, self.turno // self.factor ** nivel).start
+            for campo in self.campos:
+                origen = valores['cierre'] if campo in self.PRECIO else valores[campo]
+                arreglos[campo][inicio + anterior:inicio + total] = array('d', origen[anterior:total])
+
+    def _cerrar(self, nivel, vela):
+        """Agrega la vela cerrada (nivel, vela) a la suya del nivel siguiente"""
+        if nivel + 1 == len(self.niveles):
+            return
+        hija, madre = self.niveles[nivel], self.niveles[nivel + 1]
+        origen, destino = self._tramo(nivel, vela), self._tramo(nivel + 1, vela // self.factor)
+        if vela % self.factor == 0:
+            for campo in self.campos:
+                madre[campo][destino] = hija[campo][origen]
+        else:
+            madre['maximo'][destino] = array('d', map(max, madre['maximo'][destino], hija['maximo'][origen]))
+            madre['minimo'][destino] = array('d', map(min, madre['minimo'][destino], hija['minimo'][origen]))
+            for campo in ('cierre',) + self.ultimos:
+                madre[campo][destino] = hija[campo][origen]
+        if (vela + 1) % self.factor == 0:
+            self._cerrar(nivel + 1, vela // self.factor)
+
+    def avanzar(self, valores=None):
+        """Cierra el turno actual y abre el siguiente, plano al cierre anterior
+
+        Con valores ({campo: valores de todas las series}) se registran en la
+        vela nueva; sin ellos queda plana (turnos saltados).
+        """
+        turno = self.turno
+        self._cerrar(0, turno)
+        self.turno = turno + 1
+        arreglos = self.niveles[0]
+        origen, destino = self._tramo(0, turno), self._tramo(0, turno + 1)
+        cierre = arreglos['cierre'][origen]
+        for campo in self.PRECIO:
+            arreglos[campo][destino] = cierre
+        for campo in self.ultimos:
+            arreglos[campo][destino] = arreglos[campo][origen]
+        if valores is not None:
+            self.actualizar_todas(valores)
+
+    def saltar(self, n_turnos):
+        """Avanza n turnos sin datos: sus velas quedan planas al último cierre"""
+        if n_turnos < self.capacidad * self.factor ** (len(self.niveles) - 1):
+            for _ in range(n_turnos):
+                self.avanzar()
+            return
+        # El salto tapa todo lo que cubren los buffers: todas las velas quedan planas
+        arreglos = self.niveles[0]
+        tramo = self._tramo(0, self.turno)
+        valores = {campo: arreglos['cierre' if campo in self.PRECIO else campo][tramo] for campo in self.campos}
+        for arreglos in self.niveles:
+            for campo, arreglo in arreglos.items():
+                arreglo[:] = valores[campo] * self.capacidad
+        self.turno += n_turnos
+
+    def actualizar_todas(self, valores):
+        """Registra los valores actuales de todas las series en la vela abierta"""
+        arreglos = self.niveles[0]
+        tramo = self._tramo(0, self.turno)
+        precios = array('d', valores['cierre'])
+        arreglos['maximo'][tramo] = array('d', map(max, arreglos['maximo'][tramo], precios))
+        arreglos['minimo'][tramo] = array('d', map(min, arreglos['minimo'][tramo], precios))
+        arreglos['cierre'][tramo] = precios
+        for campo in self.ultimos:
+            arreglos[campo][tramo] = array('d', valores[campo])
+
+    def actualizar(self, serie, precio, **ultimos):
+        """Registra un valor puntual de una serie en la vela abierta"""
+        arreglos = self.niveles[0]
+        celda = self._tramo(0, self.turno).start + serie
+        if precio > arreglos['maximo'][celda]:
+            arreglos['maximo'][celda] = precio
+        if precio < arreglos['minimo'][celda]:
+            arreglos['minimo'][celda] = precio
+        arreglos['cierre'][celda] = precio
+        for campo, valor in ultimos.items():
+            arreglos[campo][celda] = valor
+
+    def vela(self, nivel, serie, vela):
+        """{campo: valor} de una vela; la abierta de un nivel > 0 se completa con la sub-vela abierta"""
+        tamano = self.factor ** nivel
+        if nivel > 0 and vela == self.turno // tamano:
+            sub = self.turno // (tamano // self.factor)
+            abierta = self.vela(nivel - 1, serie, sub)
+            if sub == vela * self.factor:
+                return abierta  # Aún no se cerró ninguna sub-vela
+            celda = self._tramo(nivel, vela).start + serie
+            arreglos = self.niveles[nivel]
+            resultado = dict(abierta, apertura=arreglos['apertura'][celda])
+            resultado['maximo'] = max(arreglos['maximo'][celda], abierta['maximo'])
+            resultado['minimo'] = min(arreglos['minimo'][celda], abierta['minimo'])
+            return resultado
+        celda = self._tramo(nivel, vela).start + serie
+        return {campo: arreglos[celda] for campo, arreglos in self.niveles[nivel].items()}
+
+    def ventana(self, turnos, puntos):
+        """(nivel, primera vela, última vela) para los últimos `turnos` turnos en `puntos` velas o menos"""
+        turnos = max(1, min(turnos, self.turno + 1))
+        puntos = max(1, puntos)
+        # Nivel más fino cuyas velas cubren la ventana con `puntos` velas o menos
+        nivel = 0
+        while nivel < len(self.niveles) - 1 and (
+                -(-turnos // self.factor ** nivel) > min(puntos, self.capacidad)):
+            nivel += 1
+        tamano = self.factor ** nivel
+        ultima = self.turno // tamano
+        primera = max(0, (self.turno - turnos + 1) // tamano, ultima - self.capacidad + 1, ultima - puntos + 1)
+        return nivel, primera, ultima
+
+
+class HistorialPrecios:
+    """Historial OHLC de precios, con demanda y oferta, a varias resoluciones
+
+    Siempre hay una serie global por recurso (con su demanda y oferta). Las
+    series por región son opcionales (activar_regional): son S = recursos x
+    regiones, así que usan buffers más cortos y guardan solo el precio; la
+    demanda y la oferta se leen de la serie global del recurso.
+
+    Memoria por serie: NIVELES * CAPACIDAD * 6 * 8 bytes (~72 KB) las globales,
+    NIVELES_REGIONAL * CAPACIDAD_REGIONAL * 4 * 8 bytes (~8 KB) las regionales.
+    """
+
+    FACTOR = 4
+    NIVELES = 6
+    CAPACIDAD = 256  # Velas por serie y nivel
+    NIVELES_REGIONAL = 4
+    CAPACIDAD_REGIONAL = 64
+
+    def __init__(self, estado, regional=False):
+        self.estado = estado
+        self.lock = threading.Lock()
+        self.globales = TablaVelas(self.FACTOR, self.NIVELES, self.CAPACIDAD, ('demanda', 'oferta'))
+        self.regionales = None
+        if regional:
+            self.activar_regional()
+        self.ajustar()
+
+    @property
+    def turno(self):
+        return self.globales.turno
+
+    def memoria(self):
+        """Bytes ocupados por todas las series"""
+        self.ajustar()
+        return self.globales.memoria() + (self.regionales.memoria() if self.regionales is not None else 0)
+
+    def activar_regional(self):
+        """Empieza a guardar también el precio de cada recurso en cada región"""
+        with self.lock:
+            if self.regionales is None:
+                self.regionales = TablaVelas(self.FACTOR, self.NIVELES_REGIONAL, self.CAPACIDAD_REGIONAL)
+                self.regionales.turno = self.globales.turno
+                self._ajustar()
+
+    def _valores_globales(self):
+        e = self.estado
+        return {'cierre': e.precio_actual, 'demanda': e.demanda, 'oferta': e.oferta}
+
+    def _valores_regionales(self, foto=None):
+        return {'cierre': (foto if foto is not None else self.estado).precios_regionales}
+
+    def ajustar(self):
+        """Crea las series de los recursos añadidos al estado, abiertas a sus valores actuales"""
+        with self.lock:
+            self._ajustar()
+
+    def _ajustar(self):
+        if self.globales.n_series != len(self.estado):
+            self.globales.crecer(self._valores_globales())
+        if self.regionales is not None and self.regionales.n_series != len(self.estado.precios_regionales):
+            self.regionales.crecer(self._valores_regionales())
+
+    def _avanzar(self, tabla, n_turnos, valores):
+        tabla.saltar(n_turnos - 1)
+        tabla.avanzar(valores)
+
+    def registrar_turno(self, n_turnos=1):
+        """Avanza n turnos las series globales y registra el estado actual
+
+        Cuesta O(recursos); se llama con los locks del turno tomados.
+        """
+        with self.lock:
+            self._ajustar()
+            self._avanzar(self.globales, n_turnos, self._valores_globales())
+
+    def registrar_turno_regional(self, n_turnos, foto):
+        """Avanza n turnos las series regionales (si están activas) con los precios de una foto
+
+        Cuesta O(recursos x regiones), pero como lee de la foto se llama sin locks.
+        """
+        if self.regionales is None:
+            return
+        with self.lock:
+            self._ajustar()
+            self._avanzar(self.regionales, n_turnos, self._valores_regionales(foto))
+
+    def registrar_todos(self):
+        """Registra el estado actual de todas las series globales en la vela abierta
+
+        Para cambios que no pasan por registrar_recurso, como los comercios de
+        otro proceso que llegan por memoria compartida. Cuesta O(recursos).
+        """
+        with self.lock:
+            self._ajustar()
+            self.globales.actualizar_todas(self._valores_globales())
+
+    def registrar_recurso(self, indice):
+        """Registra un cambio puntual (compra/venta) en la serie global de un recurso"""
+        e = self.estado
+        with self.lock:
+            self._ajustar()
+            self.globales.actualizar(indice, e.precio_actual[indice], demanda=e.demanda[indice], oferta=e.oferta[indice])
+
+    def consultar(self, indice, columna=None, turnos=100, puntos=50):
+        """Velas OHLC de los últimos `turnos` turnos, con a lo sumo `puntos` velas
+
+        Con columna se leen las series regionales; devuelve None si no están activas.
+        """
+        with self.lock:
+            self._ajustar()
+            if columna is None:
+                tabla, serie = self.globales, indice
+            elif self.regionales is None:
+                return None
+            else:
+                tabla, serie = self.regionales, indice * self.estado.n_regiones + columna
+            nivel, primera, ultima = tabla.ventana(turnos, puntos)
+            tamano = self.FACTOR ** nivel
+            velas = []
+            for vela in range(primera, ultima + 1):
+                datos = tabla.vela(nivel, serie, vela)
+                if tabla is not self.globales:
+                    # Demanda y oferta son del recurso: las de la vela global que cubre el mismo tramo
+                    globales = self.globales.vela(nivel, indice, vela)
+                    datos['demanda'], datos['oferta'] = globales['demanda'], globales['oferta']
+                velas.append({
+                    'turno': vela * tamano,
+                    'apertura': datos['apertura'],
+                    'maximo': datos['maximo'],
+                    'minimo': datos['minimo'],
+                    'cierre': datos['cierre'],
+                    'demanda': datos['demanda'],
+                    'oferta': datos['oferta']
+                })
+            return velas
+
+
+class VistaRegional(Mapping):
+    """Vista tipo dict {ubicacion: valor} sobre la fila de un recurso en una matriz regional"""
+    __slots__ = ('estado', 'indice', 'campo')
+
+    def __init__(self, estado, indice, campo):
+        self.estado = estado
+        self.indice = indice
+        self.campo = campo
+
+    def _matriz(self):
+        return self.estado.precios_regionales if self.campo == 'precios' else self.estado.stocks_regionales
+
+    def __getitem__(self, ubicacion):
+        columna = self.estado.id_ubicacion[ubicacion]
+        return self._matriz()[self.indice * self.estado.n_regiones + columna]
+
+    def __setitem__(self, ubicacion, valor):
+        columna = self.estado.id_ubicacion[ubicacion]
+        self.estado.fijar_regional(self.campo, self.indice * self.estado.n_regiones + columna, valor)
+
+    def __contains__(self, ubicacion):
+        return ubicacion in self.estado.id_ubicacion
+
+    def __iter__(self):
+        return iter(self.estado.ubicaciones)
+
+    def __len__(self):
+        return self.estado.n_regiones
+
+    def values(self):
+        return self.estado.fila_regional(self.campo, self.indice)
+
 
 class Recurso:    
-    def __init__(self, nombre, precio_base, rareza, peso):
+    __slots__ = ('nombre', 'rareza', 'peso', 'ubicacion', 'estado', 'indice')
+
+    def __init__(self, nombre, precio_base, rareza, peso, estado=None):
         self.nombre = nombre
-        self.precio_base = precio_base
-        self.precio_actual = precio_base
         self.rareza = rareza  # 1-5, afecta disponibilidad
         self.peso = peso
-        self.demanda = 50  # 0-100
-        self.oferta = 50   # 0-100
         self.ubicacion = "Torre Keio"
-        self.stock = 100
 
-        self.precios_regionales = {}
-        self.stocks_regionales = {}  
+        # Valores numéricos: vista sobre una fila de EstadoMercado
+        self.estado = estado if estado is not None else EstadoMercado()
+        self.indice = self.estado.agregar(precio_base, precio_base, 50, 50, 100)
+
+    def vincular(self, estado):
+        """Mueve los valores del recurso a un estado compartido"""
+        indice = estado.agregar(self.precio_base, self.precio_actual,
+                                self.demanda, self.oferta, self.stock)
+        precios, stocks = self.precios_regionales, self.stocks_regionales
+        nuevos_precios = VistaRegional(estado, indice, 'precios')
+        nuevos_stocks = VistaRegional(estado, indice, 'stocks')
+        for ubicacion in precios:
+            if ubicacion in nuevos_precios:
+                nuevos_precios[ubicacion] = precios[ubicacion]
+                nuevos_stocks[ubicacion] = stocks[ubicacion]
+        self.estado = estado
+        self.indice = indice
+
+    @property
+    def precios_regionales(self):
+        return VistaRegional(self.estado, self.indice, 'precios')
+
+    @property
+    def stocks_regionales(self):
+        return VistaRegional(self.estado, self.indice, 'stocks')
+
+    @property
+    def precio_base(self):
+        return self.estado.precio_base[self.indice]
+
+    @precio_base.setter
+    def precio_base(self, valor):
+        self.estado.precio_base[self.indice] = valor
+
+    @property
+    def precio_actual(self):
+        return self.estado.precio_actual[self.indice]
+
+    @precio_actual.setter
+    def precio_actual(self, valor):
+        self.estado.fijar_precio(self.indice, valor)
+
+    @property
+    def demanda(self):
+        return self.estado.demanda[self.indice]  # 0-100
+
+    @demanda.setter
+    def demanda(self, valor):
+        self.estado.fijar_demanda(self.indice, valor)
+
+    @property
+    def oferta(self):
+        return self.estado.oferta[self.indice]  # 0-100
+
+    @oferta.setter
+    def oferta(self, valor):
+        self.estado.fijar_oferta(self.indice, valor)
+
+    @property
+    def stock(self):
+        return self.estado.stock[self.indice]
+
+    @stock.setter
+    def stock(self, valor):
+        self.estado.stock[self.indice] = valor
     
     def actualizar_precio(self):
-        # Fórmula: precio = precio_base * (demanda/oferta)
-        ratio = self.demanda / max(self.oferta, 1)
-        self.precio_actual = round(self.precio_base * ratio * random.uniform(0.9, 1.1), 2)
-        
-        # Limitar fluctuaciones extremas
-        self.precio_actual = max(self.precio_base * 0.3, 
-                                 min(self.precio_actual, self.precio_base * 3))
+        # Fórmula: precio = precio_base * (demanda/oferta), limitada a [0.3x, 3x]
+        self.estado.actualizar_precios((self.indice,))
+
+    def __copy__(self):
+        # La copia queda desvinculada: modificarla no toca el estado compartido
+        copia = Recurso(self.nombre, self.precio_base, self.rareza, self.peso,
+                        EstadoMercado(self.estado.ubicaciones))
+        copia.precio_actual = self.precio_actual
+        copia.demanda = self.demanda
+        copia.oferta = self.oferta
+        copia.stock = self.stock
+        copia.ubicacion = self.ubicacion
+        copia.estado.precios_regionales[:] = self.estado.fila_regional('precios', self.indice)
+        copia.estado.stocks_regionales[:] = self.estado.fila_regional('stocks', self.indice)
+        copia.estado.estadisticas.reconstruir()
+        return copia
     
     def __repr__(self):
         return f"{self.nombre}: ${self.precio_actual:.2f} (D:{self.demanda} O:{self.oferta})"
 
 
+class RecursoRegional:
+    """Recurso visto desde una región: precio y stock regionales, el resto del recurso base"""
+    __slots__ = ('recurso', 'precio_actual', 'stock', 'demanda', 'oferta')
+
+    def __init__(self, recurso, precio_actual, stock, demanda=None, oferta=None):
+        self.recurso = recurso
+        self.precio_actual = precio_actual
+        self.stock = stock
+        self.demanda = recurso.demanda if demanda is None else demanda
+        self.oferta = recurso.oferta if oferta is None else oferta
+
+    def __getattr__(self, nombre):
+        return getattr(self.recurso, nombre)
+
+
+class FotoMercado:
+    """Copia inmutable del estado del mercado en una versión; se lee sin locks
+
+    Los escritores publican una foto nueva al terminar cada operación. Las filas
+    que no cambiaron se comparten con la foto anterior, así que un comercio copia
+    O(recursos) y no toca las matrices regionales.
+    """
+    __slots__ = ('version', 'precio_actual', 'demanda', 'oferta', 'stock',
+                 'precios_regionales', 'stocks_regionales', 'n_regiones')
+
+    def __init__(self, version, precio_actual, demanda, oferta, stock,
+                 precios_regionales, stocks_regionales, n_regiones):
+        self.version = version
+        self.precio_actual = precio_actual
+        self.demanda = demanda
+        self.oferta = oferta
+        self.stock = stock
+        self.precios_regionales = precios_regionales
+        self.stocks_regionales = stocks_regionales
+        self.n_regiones = n_regiones
+
+
+class DifusionRegional:
+    """Etapa del turno que mueve precios y stocks regionales por las rutas
+
+    En cada región, precio y stock se acercan una fracción DIFUSION a la media
+    de las regiones vecinas, ponderada por 1/costo de la ruta, y una fracción
+    ANCLA a su equilibrio: el precio global del recurso (el que mueven compras
+    y ventas) con el recargo de la región, y el stock de origen o de tránsito.
+    Los precios que fijan los casamientos de órdenes se propagan así a las
+    regiones vecinas en los turnos siguientes.
+
+    Cada paso es una matriz dispersa región x región (CSR) por la matriz
+    región x recurso, operada por columnas: cada región es un vector con todos
+    los recursos y cada ruta suma una columna escalada.
+
+    El cálculo parte de una foto y no toma locks; Mercado.simular_mercado solo
+    copia el resultado al estado bajo los locks.
+    """
+
+    DIFUSION = 0.1
+    ANCLA = 0.1
+    # Equilibrio: el centro de los repartos iniciales de inicializar_recursos
+    FACTOR_ORIGEN = 0.8
+    STOCK_ORIGEN = 200
+    STOCK_TRANSITO = 50
+
+    def __init__(self, mercado, grafo):
+        self.mercado = mercado
+        self.grafo = grafo
+        self._csr = None
+        self._n_recursos = None
+
+    def _preparar(self):
+        """Pesos por columna y equilibrios por recurso; se rehacen si cambia el mapa o los recursos"""
+        csr = self.grafo.csr
+        e = self.mercado.estado
+        if csr is self._csr and len(e) == self._n_recursos:
+            return
+        n = e.n_regiones
+        columnas = [e.id_ubicacion.get(ciudad) for ciudad in csr.ciudades]
+        pesos = [[] for _ in range(n)]
+        for i, columna in enumerate(columnas):
+            if columna is None:
+                continue
+            for k in range(csr.inicio[i], csr.inicio[i + 1]):
+                vecina = columnas[csr.destinos[k]]
+                if vecina is not None:
+                    pesos[columna].append((vecina, 1 / max(csr.costos[k], 1)))
+
+        # Por columna: coeficiente propio y [(columna vecina, coeficiente)]
+        self.propio = []
+        self.vecinos = []
+        for lista in pesos:
+            total = sum(peso for _, peso in lista)
+            if total:
+                self.propio.append(1 - self.DIFUSION - self.ANCLA)
+                self.vecinos.append([(vecina, self.DIFUSION * peso / total) for vecina, peso in lista])
+            else:
+                # Región aislada: solo vuelve a su equilibrio
+                self.propio.append(1 - self.ANCLA)
+                self.vecinos.append([])
+
+        recursos = self.mercado.por_indice
+        self.recargo = [1.35 + 0.15 * recurso.rareza for recurso in recursos]
+        self.origenes = [[] for _ in range(n)]  # {columna: índices de los recursos que nacen allí}
+        for recurso in recursos:
+            columna = e.id_ubicacion.get(recurso.ubicacion)
+            if columna is not None:
+                self.origenes[columna].append(recurso.indice)
+        self._csr, self._n_recursos = csr, len(e)
+
+    def _fijos(self, general, origen):
+        """Término constante de cada columna: general, salvo en los recursos que nacen en ella"""
+        fijos = []
+        for indices in self.origenes:
+            if indices:
+                columna = list(general)
+                for i in indices:
+                    columna[i] = origen[i]
+                fijos.append(columna)
+            else:
+                fijos.append(general)
+        return fijos
+
+    def _paso(self, columnas, fijos):
+        nuevas = []
+        for propio, vecinos, columna, fijo in zip(self.propio, self.vecinos, columnas, fijos):
+            acumulada = [propio * x + f for x, f in zip(columna, fijo)]
+            # Una pasada por ruta: la columna vecina escalada se suma a la acumulada
+            for vecina, coef in vecinos:
+                acumulada = [a + coef * x for a, x in zip(acumulada, columnas[vecina])]
+            nuevas.append(acumulada)
+        return nuevas
+
+    def calcular(self, foto, n_turnos=1):
+        """Matrices regionales tras n turnos de difusión partiendo de una foto, sin locks
+
+        Devuelve (precios, stocks, sumas): las matrices aplanadas como en
+        EstadoMercado y las sumas por región de cada una, o None si no hay
+        regiones o recursos.
+        """
+        n = foto.n_regiones
+        n_recursos = len(foto.precio_actual)
+        if not n or not n_recursos:
+            return None
+        self._preparar()
+        ancla = self.ANCLA
+        fijos_precio = self._fijos([ancla * p * k for p, k in zip(foto.precio_actual, self.recargo)],
+                                   [ancla * p * self.FACTOR_ORIGEN for p in foto.precio_actual])
+        fijos_stock = self._fijos([ancla * self.STOCK_TRANSITO] * n_recursos, [ancla * self.STOCK_ORIGEN] * n_recursos)
+
+        precios = [foto.precios_regionales[c::n] for c in range(n)]
+        stocks = [foto.stocks_regionales[c::n] for c in range(n)]
+        for _ in range(n_turnos):
+            precios = self._paso(precios, fijos_precio)
+            stocks = self._paso(stocks, fijos_stock)
+        stocks = [list(map(round, columna)) for columna in stocks]
+
+        matriz_precios = array('d', [0.0]) * (n * n_recursos)
+        matriz_stocks = array('l', [0]) * (n * n_recursos)
+        for c in range(n):
+            matriz_precios[c::n] = array('d', precios[c])
+            matriz_stocks[c::n] = array('l', stocks[c])
+        sumas = ([sum(columna) for columna in precios], [sum(columna) for columna in stocks])
+        return matriz_precios, matriz_stocks, sumas
+
+
 class Mercado:
-    def __init__(self):
+    def __init__(self, ubicaciones=None, historial=True):
+        """Sin ubicaciones se crea el mercado estándar; con ellas, uno vacío para llenar"""
         self.recursos = {}
-        self.inicializar_recursos()
+        self.por_indice = []  # Recursos en el orden de sus filas en el estado
+        self.por_nombre = {}  # {nombre en minúsculas: recurso}
+        self.estado = EstadoMercado(UBICACIONES if ubicaciones is None else ubicaciones)
+        # Se incrementa con cada cambio del mercado (compras, ventas, turnos)
+        self.version = 0
+        self.lock_version = threading.Lock()
+        # Un lock por recurso; se toman siempre en orden de índice
+        self.locks = []
+        self._foto = None
+        self.lock_foto = threading.Lock()
+        # Serializa los turnos, que sueltan los locks de recursos entre sus fases,
+        # con las escrituras de las matrices regionales (bloquear(regional=True))
+        self.lock_turno = threading.Lock()
+        # Etapa regional del turno; la conecta SimuladorComercio, que tiene el mapa
+        self.difusion = None
+        # Registro de operaciones (Persistencia): turnos, órdenes y casamientos se
+        # registran bajo los locks de lo que cambian, en el mismo orden en que ocurren
+        self.diario = None
+        self.optimizador = OptimizadorMochila(self)
+        if ubicaciones is None:
+            self.inicializar_recursos()
+        self.historial = HistorialPrecios(self.estado) if historial else None
+        self.ordenes = MercadoOrdenes(self)
     
     def inicializar_recursos(self):
         recursos_base = [
-            Recurso("CPU Shards", 500, 3, 5),
-            Recurso("RAM Blocks", 350, 2, 8),
-            Recurso("Data Packets", 600, 3, 6),
-            Recurso("Quantum Keys", 2000, 5, 2),
-            Recurso("Bug Residue", 80, 1, 4),
-            Recurso("Neural Chips", 1200, 4, 3),
-            Recurso("Energy Cores", 900, 4, 7),
-            Recurso("Crypto Keys", 1500, 5, 2),
+            Recurso("CPU Shards", 500, 3, 5, self.estado),
+            Recurso("RAM Blocks", 350, 2, 8, self.estado),
+            Recurso("Data Packets", 600, 3, 6, self.estado),
+            Recurso("Quantum Keys", 2000, 5, 2, self.estado),
+            Recurso("Bug Residue", 80, 1, 4, self.estado),
+            Recurso("Neural Chips", 1200, 4, 3, self.estado),
+            Recurso("Energy Cores", 900, 4, 7, self.estado),
+            Recurso("Crypto Keys", 1500, 5, 2, self.estado),
         ]
         
         # Asignar ubicaciones a los recursos
@@ -108,17 +1184,7 @@ class Mercado:
             "Crypto Keys": "Refinería de Códigos"
         }
 
-        todas_ubicaciones = [
-            "Torre Keio",
-            "Anillos de Datos",
-            "Bosque del Firmware",
-            "Minas de Silicio",
-            "Montaña",
-            "Refinería de Códigos",
-            "Puerto Cache",
-            "Valle Binario",
-            "Nodo Central"
-        ]
+        todas_ubicaciones = self.estado.ubicaciones
         
         # ESTO ES LO QUE FALTABA - ASIGNAR RECURSOS Y PRECIOS
         for recurso in recursos_base:
@@ -141,34 +1207,316 @@ class Mercado:
             recurso.oferta = random.randint(30, 70)
             
             # AGREGAR AL DICCIONARIO DE RECURSOS
-            self.recursos[recurso.nombre] = recurso
+            self.agregar_recurso(recurso)
 
-    def simular_mercado(self):
-        """Simula cambios aleatorios en oferta y demanda"""
-        for recurso in self.recursos.values():
-            recurso.demanda = max(10, min(100, recurso.demanda + random.randint(-15, 15)))
-            recurso.oferta = max(10, min(100, recurso.oferta + random.randint(-15, 15)))
-            recurso.actualizar_precio()
+    def agregar_recurso(self, recurso):
+        """Registra un recurso ya creado sobre self.estado"""
+        self.recursos[recurso.nombre] = recurso
+        self.por_indice.append(recurso)
+        self.por_nombre[recurso.nombre.lower()] = recurso
+        self.locks.append(threading.Lock())
+        self._foto = None
+
+    def buscar_recurso(self, nombre):
+        """Busca un recurso por nombre sin distinguir mayúsculas"""
+        return self.por_nombre.get(nombre.lower())
+
+    @cronometrado('simular_mercado')
+    def simular_mercado(self, n_turnos=1, semilla=None):
+        """Simula cambios aleatorios en oferta y demanda durante n turnos
+
+        Con semilla el turno es reproducible, que es lo que permite rehacerlo
+        desde el registro de persistencia; con diario y sin semilla se sortea una.
+        """
+        if semilla is None and self.diario is not None:
+            semilla = random.getrandbits(64)
+        # Los sorteos y la difusión se calculan aparte; bajo los locks solo se
+        # aplican. Entre las dos fases los comercios ven los precios globales
+        # del turno nuevo con las matrices regionales del anterior
+        with self.lock_turno:
+            sorteo = self.estado.sortear_turno(n_turnos, random if semilla is None else random.Random(semilla))
+            with self.bloquear(publicar=False):
+                self.estado.avanzar(n_turnos, sorteo=sorteo)
+                if self.historial is not None:
+                    self.historial.registrar_turno(n_turnos)
+                self.registrar_cambio()
+                if self.diario is not None:
+                    self.diario.registrar_turno(semilla, n_turnos)
+                # La difusión parte de la foto de este turno, tomada aún bajo los
+                # locks: un comercio posterior no la cambia, igual que al rehacer
+                # el turno desde el registro
+                self.publicar_foto()
+                base = self._foto
+            if self.difusion is not None:
+                difusion = self.difusion.calcular(base, n_turnos)
+                if difusion is not None:
+                    regionales = tuple(difusion[0]), tuple(difusion[1])
+                    with self.bloquear(publicar=False):
+                        self._fijar_regionales(*difusion, regionales)
+            if self.historial is not None:
+                # Las series regionales (opcionales) se registran de la foto recién publicada, sin locks
+                self.historial.registrar_turno_regional(n_turnos, self.foto)
+
+    def _fijar_regionales(self, precios, stocks, sumas, regionales):
+        """Copia al estado las matrices calculadas fuera de los locks; con todos los locks
+
+        Nadie más cambia las matrices regionales entre las fases del turno:
+        bloquear(regional=True) espera a lock_turno.
+        """
+        e = self.estado
+        e.precios_regionales[:] = precios
+        e.stocks_regionales[:] = stocks
+        e.estadisticas.reconstruir_regional(sumas)
+        self.registrar_cambio()
+        self.publicar_foto(regional=True, regionales=regionales)
+
+    def registrar_cambio(self, recurso=None):
+        """Marca el mercado como modificado para invalidar vistas cacheadas"""
+        with self.lock_version:
+            self.version += 1
+        if recurso is not None and self.historial is not None:
+            self.historial.registrar_recurso(recurso.indice)
+
+    @contextmanager
+    def bloquear(self, recursos=None, regional=False, publicar=True):
+        """Locks de los recursos dados (todos si None) y publicación de la foto al salir
+
+        Los locks se toman en orden de índice, así dos operaciones sobre varios
+        recursos no pueden bloquearse entre sí. regional indica que la operación
+        cambia también las matrices regionales de esos recursos; entonces se
+        toma antes lock_turno, porque un turno calcula la difusión sobre las
+        matrices sin los locks de recursos. Con publicar=False la foto la
+        publica quien llama.
+        """
+        indices = range(len(self.locks)) if recursos is None else sorted({r.indice for r in recursos})
+        locks = [self.locks[i] for i in indices]
+        if regional:
+            locks.insert(0, self.lock_turno)
+        for lock in locks:
+            lock.acquire()
+        try:
+            version = self.version
+            yield
+            if publicar and self.version != version:
+                self.publicar_foto(None if recursos is None else indices, regional)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def publicar_foto(self, indices=None, regional=False, regionales=None):
+        """Publica una foto nueva con las filas dadas (todas si None) releídas del estado
+
+        Se llama con los locks de esas filas tomados, así cada fila se copia entera.
+        regionales, si se da, son las tuplas (precios, stocks) de las matrices
+        regionales completas, ya construidas fuera de los locks.
+        """
+        e = self.estado
+        n = e.n_regiones
+        with self.lock_foto:
+            previa = self._foto
+            if previa is None:
+                campos = [tuple(e.precio_actual), tuple(e.demanda), tuple(e.oferta), tuple(e.stock),
+                          tuple(e.precios_regionales), tuple(e.stocks_regionales)]
+            elif indices is None:
+                # Todas las filas; las matrices regionales solo si cambiaron
+                campos = [tuple(e.precio_actual), tuple(e.demanda), tuple(e.oferta), tuple(e.stock)]
+                if regionales is not None:
+                    campos += list(regionales)
+                elif regional:
+                    campos += [tuple(e.precios_regionales), tuple(e.stocks_regionales)]
+                else:
+                    campos += [previa.precios_regionales, previa.stocks_regionales]
+            else:
+                campos = [list(previa.precio_actual), list(previa.demanda), list(previa.oferta), list(previa.stock),
+                          previa.precios_regionales, previa.stocks_regionales]
+                for i in indices:
+                    campos[0][i] = e.precio_actual[i]
+                    campos[1][i] = e.demanda[i]
+                    campos[2][i] = e.oferta[i]
+                    campos[3][i] = e.stock[i]
+                if regional:
+                    campos[4], campos[5] = list(campos[4]), list(campos[5])
+                    for i in indices:
+                        campos[4][i * n:(i + 1) * n] = e.precios_regionales[i * n:(i + 1) * n]
+                        campos[5][i * n:(i + 1) * n] = e.stocks_regionales[i * n:(i + 1) * n]
+                campos = [tuple(campo) for campo in campos]
+            # Versión propia y estrictamente creciente: dos fotos distintas nunca la comparten
+            version = self.version if previa is None else max(self.version, previa.version + 1)
+            self._foto = FotoMercado(version, *campos, n)
+
+    @property
+    def foto(self):
+        """Última foto publicada; la primera se construye bajo todos los locks"""
+        foto = self._foto
+        if foto is None:
+            with self.bloquear():
+                self.publicar_foto(regional=True)
+            foto = self._foto
+        return foto
+
+    def instantanea(self):
+        """Copia de los arreglos numéricos para comparar después de un cambio"""
+        e = self.estado
+        return (array('d', e.precio_actual), array('l', e.demanda), array('l', e.oferta),
+                array('l', e.stock), array('d', e.precios_regionales), array('l', e.stocks_regionales))
+
+    def cambios_desde(self, previa):
+        """Recursos y celdas regionales que cambiaron desde una instantánea"""
+        e = self.estado
+        por_indice = self.por_indice
+        precios, demandas, ofertas, stocks, precios_reg, stocks_reg = previa
+        
+        recursos = [
+            self.delta_recurso(por_indice[i])
+            for i in range(len(e))
+            if (precios[i] != e.precio_actual[i] or demandas[i] != e.demanda[i]
+                or ofertas[i] != e.oferta[i] or stocks[i] != e.stock[i])
+        ]
+        
+        regiones = []
+        n = e.n_regiones
+        for celda in range(len(e.precios_regionales)):
+            if precios_reg[celda] != e.precios_regionales[celda] or stocks_reg[celda] != e.stocks_regionales[celda]:
+                regiones.append({
+                    'nombre': por_indice[celda // n].nombre,
+                    'ubicacion': e.ubicaciones[celda % n],
+                    'precio': e.precios_regionales[celda],
+                    'stock': e.stocks_regionales[celda]
+                })
+        
+        return {'recursos': recursos, 'regiones': regiones}
+
+    def delta_recurso(self, recurso):
+        """Campos variables de un recurso, para publicar cambios"""
+        return {
+            'nombre': recurso.nombre,
+            'precio': recurso.precio_actual,
+            'demanda': recurso.demanda,
+            'oferta': recurso.oferta,
+            'stock': recurso.stock
+        }
+        
+    def obtener_estadisticas(self, k=5, ubicacion=None):
+        """Promedios y top-K por precio y demanda, en O(K) gracias a los índices mantenidos
+
+        Sin recursos los promedios son 0 y las listas quedan vacías.
+        """
+        e = self.estado
+        est = e.estadisticas
+        n = max(len(e), 1)  # Con 0 recursos las sumas son 0
+        
+        columna = e.id_ubicacion.get(ubicacion) if ubicacion else None
+        with est.lock:
+            if columna is not None:
+                precio_promedio = est.suma_precio_regional[columna] / n
+                mas_valiosos = est.orden_de_region(columna)[:k]
+            else:
+                precio_promedio = est.suma_precio / n
+                mas_valiosos = est.orden_precio[:k]
+            mayor_demanda = est.orden_demanda[:k]
+            demanda_promedio = est.suma_demanda / n
+            oferta_promedio = est.suma_oferta / n
+            stock_total = est.suma_stock_regional[columna] if columna is not None else None
+        
+        estadisticas = {
+            'precio_promedio': precio_promedio,
+            'demanda_promedio': demanda_promedio,
+            'oferta_promedio': oferta_promedio,
+            'mas_valiosos': [(self.por_indice[i], -precio) for precio, i in mas_valiosos],
+            'mayor_demanda': [(self.por_indice[i], -demanda) for demanda, i in mayor_demanda]
+        }
+        if columna is not None:
+            estadisticas['stock_total'] = stock_total
+        return estadisticas
+
+    def escanear_arbitraje(self, grafo, capacidad, dinero, k=10):
+        """Mejores oportunidades (compra en A, venta en B, recurso) en una pasada
+
+        ganancia = (precio_B * 0.9 - precio_A) * cantidad - costo_viaje(A, B), donde
+        la cantidad está limitada por el stock en A, la capacidad y el dinero.
+        """
+        e = self.estado
+        n = e.n_regiones
+        costos = grafo.matriz_costos(e.ubicaciones)
+        candidatos = []
         
-    def obtener_recursos_por_ubicacion(self, ubicacion):
-        """Obtiene recursos con precios y stocks específicos de una ubicación"""
+        for recurso in self.por_indice:
+            inicio = recurso.indice * n
+            precios = e.precios_regionales[inicio:inicio + n]
+            stocks = e.stocks_regionales[inicio:inicio + n]
+            por_peso = capacidad // recurso.peso if recurso.peso > 0 else capacidad
+            venta = [p * 0.9 for p in precios]  # 10% de comisión
+            mejor_venta = max(venta)
+            for a, (compra, stock) in enumerate(zip(precios, stocks)):
+                if mejor_venta <= compra or compra <= 0:
+                    continue  # Ninguna región paga más de lo que cuesta aquí
+                cantidad = int(min(stock, por_peso, dinero // compra))
+                if cantidad <= 0:
+                    continue
+                fila_costos = costos[a]
+                candidatos.extend(
+                    ((v - compra) * cantidad - fila_costos[b], recurso.indice, a, b, cantidad)
+                    for b, v in enumerate(venta)
+                    if v > compra and b != a and fila_costos[b] != float('inf')
+                )
+        
+        oportunidades = []
+        for ganancia, indice, a, b, cantidad in heapq.nlargest(k, candidatos):
+            recurso = self.por_indice[indice]
+            oportunidades.append({
+                'recurso': recurso.nombre,
+                'comprar_en': e.ubicaciones[a],
+                'vender_en': e.ubicaciones[b],
+                'precio_compra': e.precios_regionales[indice * n + a],
+                'precio_venta': e.precios_regionales[indice * n + b] * 0.9,
+                'cantidad': cantidad,
+                'costo_viaje': costos[a][b],
+                'ganancia_neta': ganancia
+            })
+        return oportunidades
+
+    def obtener_recursos_por_ubicacion(self, ubicacion, foto=None):
+        """Obtiene recursos con precios y stocks específicos de una ubicación
+
+        Se lee de una foto (la última si no se da), sin locks y sin ver
+        operaciones a medias.
+        """
+        foto = foto or self.foto
+        columna = self.estado.id_ubicacion.get(ubicacion)
         recursos_ubicacion = []
         
         for recurso in self.recursos.values():
-            import copy
-            recurso_regional = copy.copy(recurso)
-            
-            if ubicacion in recurso.precios_regionales:
-                recurso_regional.precio_actual = recurso.precios_regionales[ubicacion]
-                recurso_regional.stock = recurso.stocks_regionales[ubicacion]
+            i = recurso.indice
+            if columna is not None:
+                celda = i * foto.n_regiones + columna
+                recursos_ubicacion.append(RecursoRegional(
+                    recurso, foto.precios_regionales[celda], foto.stocks_regionales[celda],
+                    foto.demanda[i], foto.oferta[i]))
             else:
-                recurso_regional.precio_actual = recurso.precio_base * 1.5
-                recurso_regional.stock = 50
-            
-            recursos_ubicacion.append(recurso_regional)
+                recursos_ubicacion.append(RecursoRegional(
+                    recurso, recurso.precio_base * 1.5, 50, foto.demanda[i], foto.oferta[i]))
         
         return recursos_ubicacion
 
+    def obtener_recursos_promedio(self, foto=None):
+        """Obtiene recursos con el precio y stock promedio de todas las regiones"""
+        foto = foto or self.foto
+        n = foto.n_regiones
+        recursos_promedio = []
+        
+        for recurso in self.recursos.values():
+            i = recurso.indice
+            if n:
+                inicio = i * n
+                precio = sum(foto.precios_regionales[inicio:inicio + n]) / n
+                stock = int(sum(foto.stocks_regionales[inicio:inicio + n]) / n)
+                recursos_promedio.append(RecursoRegional(recurso, precio, stock, foto.demanda[i], foto.oferta[i]))
+            else:
+                recursos_promedio.append(RecursoRegional(
+                    recurso, recurso.precio_base, 100, foto.demanda[i], foto.oferta[i]))
+        
+        return recursos_promedio
+
     def ordenar_por_precio(self, descendente=True):
         """Ordena recursos por precio"""
         return sorted(self.recursos.values(), 
@@ -193,6 +1541,206 @@ class Mercado:
             recursos = list(self.recursos.values())
         return sorted(recursos, key=lambda r: r.oferta, reverse=True)
 
+class OptimizadorMochila:
+    """Mochila acotada por peso, dinero y stock, con resultados memorizados por versión"""
+
+    ESCALA_PRESUPUESTO = 100  # Celdas de dinero en la DP
+    MAX_CELDAS_DP = 300_000  # Por encima se usa solo ramificación y poda
+    MAX_NODOS = 20_000
+    MAX_RESULTADOS = 256  # Por versión; se descartan los más viejos
+
+    def __init__(self, mercado):
+        self.mercado = mercado
+        self.cache = {}  # {(version, capacidad, dinero, ubicacion): (resultado, exacta)}
+        # Varias peticiones optimizan a la vez: la búsqueda va fuera del lock, la cache no
+        self.lock_cache = threading.Lock()
+
+    @cronometrado('mochila')
+    def optimizar(self, capacidad, dinero, ubicacion=None):
+        """Devuelve ([(recurso, cantidad)], exacta) con lo que maximiza el valor comprado
+
+        exacta es False cuando la búsqueda agotó su presupuesto de nodos: la
+        solución es la mejor encontrada, no necesariamente la óptima.
+        """
+        clave = (self.mercado.version, capacidad, round(dinero, 2), ubicacion)
+        resultado = self.cache.get(clave)
+        if resultado is not None:
+            return resultado
+        
+        if ubicacion:
+            recursos = self.mercado.obtener_recursos_por_ubicacion(ubicacion)
+        else:
+            recursos = list(self.mercado.recursos.values())
+        
+        # (recurso, peso, valor, costo, cantidad_max)
+        items = []
+        for recurso in recursos:
+            peso = max(int(recurso.peso), 1)
+            costo = recurso.precio_actual
+            cantidad_max = min(int(recurso.stock), capacidad // peso, int(dinero // costo) if costo > 0 else capacidad)
+            if cantidad_max > 0:
+                items.append((recurso, peso, int(costo), costo, cantidad_max))
+        
+        piezas = sum(cantidad.bit_length() for _, _, _, _, cantidad in items)
+        inicial = None
+        if (capacidad + 1) * (self.ESCALA_PRESUPUESTO + 1) * piezas <= self.MAX_CELDAS_DP:
+            # La DP da una solución casi óptima que la poda usa como punto de partida
+            inicial = self._dp(items, capacidad, dinero)
+        cantidades, exacta = self._ramificacion_y_poda(items, capacidad, dinero, inicial)
+        
+        resultado = ([(items[i][0], cantidad) for i, cantidad in enumerate(cantidades) if cantidad > 0], exacta)
+        with self.lock_cache:
+            version = next(iter(self.cache))[0] if self.cache else clave[0]
+            # Un resultado de una versión anterior no borra los de la nueva
+            if version < clave[0]:
+                self.cache.clear()
+            if version <= clave[0]:
+                while len(self.cache) >= self.MAX_RESULTADOS:
+                    del self.cache[next(iter(self.cache))]
+                self.cache[clave] = resultado
+        return resultado
+
+    def _dp(self, items, capacidad, dinero):
+        """DP 0/1 sobre (peso, dinero escalado) con división binaria de las cantidades"""
+        B = self.ESCALA_PRESUPUESTO
+        unidad = dinero / B
+        columnas = B + 1
+        
+        # Cada item se parte en piezas de 1, 2, 4, ... unidades hasta su cantidad máxima.
+        # Redondeo hacia arriba: lo que la DP acepta siempre cabe en el presupuesto real
+        piezas = []
+        for i, (_, peso, valor, costo, cantidad_max) in enumerate(items):
+            k = 1
+            while cantidad_max > 0:
+                tomar = min(k, cantidad_max)
+                costo_escalado = int(-(-(costo * tomar) // unidad)) if unidad > 0 else 0
+                piezas.append((i, tomar, peso * tomar, valor * tomar, costo_escalado))
+                cantidad_max -= tomar
+                k *= 2
+        
+        dp = [0] * ((capacidad + 1) * columnas)
+        elecciones = []
+        for _, _, peso, valor, costo in piezas:
+            tomada = bytearray(len(dp))
+            if peso <= capacidad and costo <= B:
+                for w in range(capacidad, peso - 1, -1):
+                    fila, fila_previa = w * columnas, (w - peso) * columnas
+                    for b in range(B, costo - 1, -1):
+                        candidato = dp[fila_previa + b - costo] + valor
+                        if candidato > dp[fila + b]:
+                            dp[fila + b] = candidato
+                            tomada[fila + b] = 1
+            elecciones.append(tomada)
+        
+        # Reconstruir de la última pieza a la primera
+        cantidades = [0] * len(items)
+        w, b = capacidad, B
+        for p in range(len(piezas) - 1, -1, -1):
+            if elecciones[p][w * columnas + b]:
+                i, tomar, peso, _, costo = piezas[p]
+                cantidades[i] += tomar
+                w -= peso
+                b -= costo
+        
+        # El redondeo del dinero puede dejar hueco: completarlo por valor/peso
+        peso_libre = capacidad - sum(c * item[1] for c, item in zip(cantidades, items))
+        dinero_libre = dinero - sum(c * item[3] for c, item in zip(cantidades, items))
+        for i in sorted(range(len(items)), key=lambda i: items[i][2] / items[i][1], reverse=True):
+            _, peso, _, costo, cantidad_max = items[i]
+            extra = min(cantidad_max - cantidades[i], peso_libre // peso,
+                        int(dinero_libre // costo) if costo > 0 else peso_libre // peso)
+            if extra > 0:
+                cantidades[i] += extra
+                peso_libre -= extra * peso
+                dinero_libre -= extra * costo
+        return cantidades
+
+    def _ramificacion_y_poda(self, items, capacidad, dinero, inicial=None):
+        """Búsqueda por valor/peso con cota fraccional: (cantidades, exacta)
+
+        exacta es False si se agotó MAX_NODOS antes de probar que la mejor
+        solución encontrada es la óptima.
+        """
+        orden = sorted(range(len(items)), key=lambda i: items[i][2] / items[i][1], reverse=True)
+        n = len(orden)
+        # Mejor valor/costo de los items restantes, para acotar por dinero
+        ratio_costo = [0.0] * (n + 1)
+        for pos in range(n - 1, -1, -1):
+            _, _, valor, costo, _ = items[orden[pos]]
+            ratio_costo[pos] = max(ratio_costo[pos + 1], valor / costo if costo > 0 else float('inf'))
+        # Peso y valor acumulados tomando todo lo disponible, en orden de valor/peso
+        pesos_acum, valores_acum = [0], [0]
+        for i in orden:
+            _, peso, valor, _, cantidad_max = items[i]
+            pesos_acum.append(pesos_acum[-1] + peso * cantidad_max)
+            valores_acum.append(valores_acum[-1] + valor * cantidad_max)
+        
+        if inicial is None:
+            # Solución voraz como punto de partida
+            inicial = [0] * len(items)
+            peso_libre, dinero_libre = capacidad, dinero
+            for i in orden:
+                _, peso, _, costo, cantidad_max = items[i]
+                tomar = min(cantidad_max, peso_libre // peso, int(dinero_libre // costo) if costo > 0 else cantidad_max)
+                inicial[i] = tomar
+                peso_libre -= tomar * peso
+                dinero_libre -= tomar * costo
+        mejor_valor = sum(c * item[2] for c, item in zip(inicial, items))
+        mejor = list(inicial)
+        
+        def cota(pos, peso_libre, dinero_libre, valor):
+            # Mochila fraccional por peso (búsqueda binaria en los acumulados),
+            # limitada además por el dinero restante
+            objetivo = pesos_acum[pos] + peso_libre
+            k = bisect_right(pesos_acum, objetivo, pos) - 1
+            fraccional = valor + valores_acum[k] - valores_acum[pos]
+            if k < n:
+                _, peso, v, _, _ = items[orden[k]]
+                fraccional += (objetivo - pesos_acum[k]) / peso * v
+            # Los valores son enteros: basta con superar la parte entera
+            return int(min(fraccional, valor + dinero_libre * ratio_costo[pos]))
+        
+        # DFS iterativa: [pos, peso_libre, dinero_libre, valor, siguiente cantidad a probar]
+        actual = [0] * len(items)
+        pila = [[0, capacidad, dinero, 0, None]]
+        nodos = 0
+        techo = cota(0, capacidad, dinero, 0)
+        while pila and mejor_valor < techo:
+            marco = pila[-1]
+            pos, peso_libre, dinero_libre, valor, siguiente = marco
+            if siguiente is None:
+                nodos += 1
+                if valor > mejor_valor:
+                    mejor_valor, mejor = valor, list(actual)
+                if nodos > self.MAX_NODOS:
+                    break  # Presupuesto agotado: queda la mejor encontrada
+                if pos == n or cota(pos, peso_libre, dinero_libre, valor) <= mejor_valor:
+                    pila.pop()
+                    continue
+                _, peso, _, costo, cantidad_max = items[orden[pos]]
+                siguiente = min(cantidad_max, peso_libre // peso,
+                                int(dinero_libre // costo) if costo > 0 else cantidad_max)
+            
+            i = orden[pos]
+            if siguiente < 0:
+                actual[i] = 0
+                pila.pop()
+                continue
+            _, peso, v, costo, _ = items[i]
+            actual[i] = siguiente
+            marco[4] = siguiente - 1
+            pila.append([pos + 1, peso_libre - siguiente * peso, dinero_libre - siguiente * costo,
+                         valor + siguiente * v, None])
+        
+        # Exacta si se exploró todo o si se alcanzó la cota de la raíz
+        return mejor, not pila or mejor_valor >= techo
+
+
+def cantidad_valida(cantidad):
+    """Las cantidades de comercio son enteros positivos (bool no cuenta)"""
+    return isinstance(cantidad, int) and not isinstance(cantidad, bool) and cantidad > 0
+
+
 class Jugador:
     def __init__(self, nombre, dinero=50000, capacidad_max=50):
         self.nombre = nombre
@@ -200,35 +1748,89 @@ class Jugador:
         self.inventario = {}  # {nombre_recurso: cantidad}
         self.capacidad_max = capacidad_max
         self.capacidad_usada = 0
+        # Garantías de las órdenes limitadas abiertas: siguen siendo del jugador
+        self.dinero_retenido = 0.0  # De las compras
+        self.retenido = {}          # {nombre_recurso: cantidad} de las ventas
+        # Se incrementa con cada cambio de dinero o inventario
+        self.version = 0
+        # Recibe al jugador tras cada cambio (el ranking); lo fija RegistroJugadores
+        self.observador = None
+
+    def marcar_cambio(self):
+        """Nueva versión tras cambiar dinero o inventario; se llama al final del cambio"""
+        self.version += 1
+        if self.observador is not None:
+            self.observador(self)
+
+    def retener(self, nombre_recurso, cantidad):
+        """Suma (o resta, si es negativa) unidades a las retenidas por órdenes de venta"""
+        restante = self.retenido.get(nombre_recurso, 0) + cantidad
+        if restante:
+            self.retenido[nombre_recurso] = restante
+        else:
+            self.retenido.pop(nombre_recurso, None)
+    
+    # Las operaciones de comercio se llaman con el lock de la sesión del jugador
+    # tomado; el lock del recurso hace atómicos la comprobación y el cambio de stock.
+    # al_confirmar, si se da, se llama tras un comercio con éxito y aún con los
+    # locks de los recursos tomados (para registrarlo en orden con los turnos)
+    
+    def comprar_recurso(self, recurso, cantidad, mercado, al_confirmar=None):
+        with mercado.bloquear([recurso]):
+            exito = self._comprar(recurso, cantidad, mercado)
+            if exito and al_confirmar is not None:
+                al_confirmar()
+            return exito
     
-    def comprar_recurso(self, recurso, cantidad, mercado):
+    def _comprar(self, recurso, cantidad, mercado):
+        if not cantidad_valida(cantidad):
+            log.debug("Cantidad inválida: %r", cantidad)
+            return False
+        
         costo_total = recurso.precio_actual * cantidad
         peso_total = recurso.peso * cantidad
         
+        if recurso.stock < cantidad:
+            log.debug("Stock insuficiente de %s: quedan %s", recurso.nombre, recurso.stock)
+            return False
+        
         if self.dinero < costo_total:
-            print(f"Dinero insuficiente. Necesitas ${costo_total:.2f}")
+            log.debug("Dinero insuficiente. Necesitas $%.2f", costo_total)
             return False
         
         if self.capacidad_usada + peso_total > self.capacidad_max:
-            print(f"Capacidad insuficiente. Necesitas {peso_total}kg de espacio")
+            log.debug("Capacidad insuficiente. Necesitas %skg de espacio", peso_total)
             return False
         
         self.dinero -= costo_total
         self.capacidad_usada += peso_total
         self.inventario[recurso.nombre] = self.inventario.get(recurso.nombre, 0) + cantidad
+        self.marcar_cambio()
         
         # Afectar mercado
-        recurso.stock = max(0, recurso.stock - cantidad)
+        recurso.stock -= cantidad
         recurso.oferta = max(10, recurso.oferta - cantidad * 2)
         recurso.demanda = min(100, recurso.demanda + cantidad)
         recurso.actualizar_precio()
+        mercado.registrar_cambio(recurso)
         
-        print(f"Compraste {cantidad}x {recurso.nombre} por ${costo_total:.2f}")
+        log.info("Compra jugador=%s recurso=%s cantidad=%s total=%.2f", self.nombre, recurso.nombre, cantidad, costo_total)
         return True
     
-    def vender_recurso(self, nombre_recurso, cantidad, mercado):
+    def vender_recurso(self, nombre_recurso, cantidad, mercado, al_confirmar=None):
+        with mercado.bloquear([mercado.recursos[nombre_recurso]]):
+            exito = self._vender(nombre_recurso, cantidad, mercado)
+            if exito and al_confirmar is not None:
+                al_confirmar()
+            return exito
+    
+    def _vender(self, nombre_recurso, cantidad, mercado):
+        if not cantidad_valida(cantidad):
+            log.debug("Cantidad inválida: %r", cantidad)
+            return False
+        
         if nombre_recurso not in self.inventario or self.inventario[nombre_recurso] < cantidad:
-            print(f"No tienes suficiente {nombre_recurso}")
+            log.debug("No tienes suficiente %s", nombre_recurso)
             return False
         
         recurso = mercado.recursos[nombre_recurso]
@@ -241,105 +1843,862 @@ class Jugador:
         
         if self.inventario[nombre_recurso] == 0:
             del self.inventario[nombre_recurso]
+        self.marcar_cambio()
         
         # Afectar mercado
         recurso.oferta = min(100, recurso.oferta + cantidad * 2)
         recurso.demanda = max(10, recurso.demanda - cantidad)
+        mercado.registrar_cambio(recurso)
         
-        print(f"Vendiste {cantidad}x {nombre_recurso} por ${ganancia:.2f}")
+        log.info("Venta jugador=%s recurso=%s cantidad=%s total=%.2f", self.nombre, nombre_recurso, cantidad, ganancia)
         return True
+
+    def ejecutar_ordenes(self, ordenes, mercado, al_confirmar=None):
+        """Aplica una cesta de órdenes [(tipo, recurso, cantidad)] todo o nada
+
+        Todas se valoran al precio actual previo a la cesta; se valida el estado
+        final (dinero, capacidad, inventario y stock) y cada recurso se reajusta
+        una vez. Devuelve (exito, mensaje, detalles).
+        """
+        with mercado.bloquear([recurso for _, recurso, _ in ordenes]):
+            resultado = self._ejecutar_ordenes(ordenes, mercado)
+            if resultado[0] and al_confirmar is not None:
+                al_confirmar()
+            return resultado
     
-    def optimizar_inventario_mochila(self, mercado):
-        recursos_disponibles = list(mercado.recursos.values())
+    def _ejecutar_ordenes(self, ordenes, mercado):
+        invalidas = [recurso.nombre for _, recurso, cantidad in ordenes if not cantidad_valida(cantidad)]
+        if invalidas:
+            return False, f"Cantidad inválida para {', '.join(invalidas)}", []
+        dinero = self.dinero
+        peso = self.capacidad_usada
+        inventario = dict(self.inventario)
+        compradas = defaultdict(int)
+        detalles = []
+        
+        for tipo, recurso, cantidad in ordenes:
+            if tipo == 'comprar':
+                importe = recurso.precio_actual * cantidad
+                compradas[recurso] += cantidad
+                dinero -= importe
+                peso += recurso.peso * cantidad
+                inventario[recurso.nombre] = inventario.get(recurso.nombre, 0) + cantidad
+            else:
+                importe = recurso.precio_actual * cantidad * 0.9  # 10% de comisión
+                dinero += importe
+                peso -= recurso.peso * cantidad
+                inventario[recurso.nombre] = inventario.get(recurso.nombre, 0) - cantidad
+            detalles.append({
+                'tipo': tipo,
+                'recurso': recurso.nombre,
+                'cantidad': cantidad,
+                'precio_unitario': recurso.precio_actual,
+                'importe': round(importe, 2)
+            })
+        
+        faltantes = [nombre for nombre, cantidad in inventario.items() if cantidad < 0]
+        if faltantes:
+            return False, f"No tienes suficiente {', '.join(faltantes)}", detalles
+        agotados = [recurso.nombre for recurso, cantidad in compradas.items() if cantidad > recurso.stock]
+        if agotados:
+            return False, f"Stock insuficiente de {', '.join(agotados)}", detalles
+        if dinero < 0:
+            return False, f"Dinero insuficiente. Te faltan ${-dinero:.2f}", detalles
+        if peso > self.capacidad_max:
+            return False, f"Capacidad insuficiente. Te faltan {peso - self.capacidad_max}kg de espacio", detalles
+        
+        self.dinero = dinero
+        self.capacidad_usada = peso
+        self.inventario = {nombre: cantidad for nombre, cantidad in inventario.items() if cantidad > 0}
+        self.marcar_cambio()
+        
+        # Afectar mercado: mismos empujes que las órdenes sueltas, un solo reajuste por recurso
+        afectados = {}
+        for tipo, recurso, cantidad in ordenes:
+            if tipo == 'comprar':
+                recurso.stock -= cantidad
+                recurso.oferta = max(10, recurso.oferta - cantidad * 2)
+                recurso.demanda = min(100, recurso.demanda + cantidad)
+            else:
+                recurso.oferta = min(100, recurso.oferta + cantidad * 2)
+                recurso.demanda = max(10, recurso.demanda - cantidad)
+            afectados[recurso.nombre] = recurso
+        for recurso in afectados.values():
+            recurso.actualizar_precio()
+            mercado.registrar_cambio(recurso)
+        
+        return True, f"{len(ordenes)} órdenes ejecutadas", detalles
+    
+    def optimizar_inventario_mochila(self, mercado, ubicacion=None):
         W = int(self.capacidad_max - self.capacidad_usada)
         
         if W <= 0:
-            print("No hay capacidad disponible")
-            return []
-        
-        dp = [0 for _ in range(W + 1)]
-        parent = [-1 for _ in range(W + 1)]
-        
-        for w in range(1, W + 1):
-            for i, recurso in enumerate(recursos_disponibles):
-                peso = int(recurso.peso)
-                valor = int(recurso.precio_actual)
-                
-                if peso <= w and self.dinero >= recurso.precio_actual:
-                    if dp[w - peso] + valor > dp[w]:
-                        dp[w] = dp[w - peso] + valor
-                        parent[w] = i
-        
-        recomendaciones = {}
-        w = W
-        dinero_gastado = 0
-        
-        while w > 0 and parent[w] != -1:
-            recurso_idx = parent[w]
-            recurso = recursos_disponibles[recurso_idx]
-            
-            if dinero_gastado + recurso.precio_actual > self.dinero:
+            log.debug("No hay capacidad disponible")
+            return [], True
+        
+        return mercado.optimizador.optimizar(W, self.dinero, ubicacion)
+
+class Orden:
+    """Orden limitada en reposo"""
+    __slots__ = ('id', 'sesion', 'lado', 'recurso', 'columna', 'precio', 'cantidad', 'secuencia')
+
+    def __init__(self, id, sesion, lado, recurso, columna, precio, cantidad, secuencia):
+        self.id = id
+        self.sesion = sesion
+        self.lado = lado  # 'compra' o 'venta'
+        self.recurso = recurso
+        self.columna = columna
+        self.precio = precio
+        self.cantidad = cantidad
+        self.secuencia = secuencia
+
+
+class LibroOrdenes:
+    """Órdenes limitadas de un recurso en una región, con prioridad precio-tiempo
+
+    Las cancelaciones son perezosas: la orden sale de `activas` y su entrada en el
+    heap se descarta cuando llega a la cima.
+    """
+
+    def __init__(self):
+        self.compras = []  # (-precio, secuencia, orden)
+        self.ventas = []   # (precio, secuencia, orden)
+        self.activas = {}  # {id: orden}
+
+    def agregar(self, orden):
+        self.activas[orden.id] = orden
+        if orden.lado == 'compra':
+            heapq.heappush(self.compras, (-orden.precio, orden.secuencia, orden))
+        else:
+            heapq.heappush(self.ventas, (orden.precio, orden.secuencia, orden))
+
+    def cancelar(self, orden_id):
+        return self.activas.pop(orden_id, None)
+
+    def _cima(self, heap):
+        while heap and heap[0][2].id not in self.activas:
+            heapq.heappop(heap)
+        return heap[0][2] if heap else None
+
+    def casar(self):
+        """Cruza compras y ventas mientras los precios se solapen
+
+        Devuelve [(compra, venta, precio, cantidad)]; el precio es el de la orden
+        más antigua de las dos.
+        """
+        ejecuciones = []
+        while True:
+            compra = self._cima(self.compras)
+            venta = self._cima(self.ventas)
+            if compra is None or venta is None or compra.precio < venta.precio:
                 break
+            precio = compra.precio if compra.secuencia < venta.secuencia else venta.precio
+            cantidad = min(compra.cantidad, venta.cantidad)
+            compra.cantidad -= cantidad
+            venta.cantidad -= cantidad
+            ejecuciones.append((compra, venta, precio, cantidad))
+            for orden, heap in ((compra, self.compras), (venta, self.ventas)):
+                if orden.cantidad == 0:
+                    heapq.heappop(heap)
+                    del self.activas[orden.id]
+        return ejecuciones
+
+    def profundidad(self, niveles=5):
+        """Cantidad agregada por precio en los mejores niveles de cada lado"""
+        compras, ventas = defaultdict(int), defaultdict(int)
+        for orden in self.activas.values():
+            (compras if orden.lado == 'compra' else ventas)[orden.precio] += orden.cantidad
+        return {
+            'compras': [(p, compras[p]) for p in heapq.nlargest(niveles, compras)],
+            'ventas': [(p, ventas[p]) for p in heapq.nsmallest(niveles, ventas)]
+        }
+
+
+class MercadoOrdenes:
+    """Libros de órdenes limitadas por (recurso, región), con depósito de garantías
+
+    Al colocar una orden se retiene lo comprometido (dinero y capacidad para
+    compras, unidades del inventario para ventas); las ejecuciones y cancelaciones
+    liquidan o devuelven esa garantía.
+    """
+
+    def __init__(self, mercado):
+        self.mercado = mercado
+        self.libros = {}   # {(indice_recurso, columna): LibroOrdenes}
+        self.ordenes = {}  # {id: orden}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def libro(self, recurso, columna):
+        clave = (recurso.indice, columna)
+        libro = self.libros.get(clave)
+        if libro is None:
+            libro = self.libros[clave] = LibroOrdenes()
+        return libro
+
+    def colocar(self, sesion, recurso, columna, lado, precio, cantidad):
+        """Coloca una orden; se llama con el lock de la sesión tomado"""
+        jugador = sesion.jugador
+        if sesion.desalojada:
+            return False, "Sesión caducada", None
+        if lado == 'compra':
+            if jugador.dinero < precio * cantidad:
+                return False, f"Dinero insuficiente. Necesitas ${precio * cantidad:.2f}", None
+            if jugador.capacidad_usada + recurso.peso * cantidad > jugador.capacidad_max:
+                return False, f"Capacidad insuficiente. Necesitas {recurso.peso * cantidad}kg de espacio", None
+            jugador.dinero -= precio * cantidad
+            jugador.dinero_retenido += precio * cantidad
+            jugador.capacidad_usada += recurso.peso * cantidad
+        else:
+            if jugador.inventario.get(recurso.nombre, 0) < cantidad:
+                return False, f"No tienes suficiente {recurso.nombre}", None
+            jugador.inventario[recurso.nombre] -= cantidad
+            if jugador.inventario[recurso.nombre] == 0:
+                del jugador.inventario[recurso.nombre]
+            jugador.retener(recurso.nombre, cantidad)
+        jugador.marcar_cambio()
+        
+        diario = self.mercado.diario
+        with self.lock:
+            orden_id = next(self.ids)
+            orden = Orden(orden_id, sesion, lado, recurso, columna, precio, cantidad, orden_id)
+            self.ordenes[orden_id] = orden
+            self.libro(recurso, columna).agregar(orden)
+            # Bajo el lock de los libros: queda antes o después del casamiento, como ocurrió
+            if diario is not None:
+                diario.registrar_orden(orden)
+        return True, f"Orden {orden_id} colocada", orden
+
+    def cancelar(self, sesion, orden_id):
+        """Cancela una orden propia y devuelve la garantía pendiente; con el lock de la sesión"""
+        diario = self.mercado.diario
+        with self.lock:
+            orden = self.ordenes.get(orden_id)
+            if orden is None or orden.sesion is not sesion:
+                return False
+            del self.ordenes[orden_id]
+            self.libro(orden.recurso, orden.columna).cancelar(orden_id)
+            self._devolver(orden)
+            if diario is not None:
+                diario.registrar_cancelacion(sesion, orden_id)
+        return True
+
+    def cancelar_sesion(self, sesion):
+        """Cancela todas las órdenes de una sesión y devuelve sus garantías; con el lock de la sesión"""
+        with self.lock:
+            propias = [orden.id for orden in self.ordenes.values() if orden.sesion is sesion]
+        for orden_id in propias:
+            self.cancelar(sesion, orden_id)
+        return len(propias)
+
+    def _devolver(self, orden):
+        jugador = orden.sesion.jugador
+        if orden.lado == 'compra':
+            jugador.dinero += orden.precio * orden.cantidad
+            jugador.dinero_retenido -= orden.precio * orden.cantidad
+            jugador.capacidad_usada -= orden.recurso.peso * orden.cantidad
+        else:
+            nombre = orden.recurso.nombre
+            jugador.inventario[nombre] = jugador.inventario.get(nombre, 0) + orden.cantidad
+            jugador.retener(nombre, -orden.cantidad)
+        jugador.marcar_cambio()
+
+    def casar_libros(self):
+        """Casa todos los libros sin liquidar; devuelve las ejecuciones
+
+        Es la parte del casamiento que se rehace desde el registro: depende solo
+        de los libros. La liquidación se registra como estados absolutos.
+        """
+        diario = self.mercado.diario
+        with self.lock:
+            ejecuciones = []
+            for libro in self.libros.values():
+                ejecuciones.extend(libro.casar())
+            for compra, venta, _, _ in ejecuciones:
+                for orden in (compra, venta):
+                    if orden.cantidad == 0:
+                        self.ordenes.pop(orden.id, None)
+            if diario is not None:
+                diario.registrar_casamiento()
+        return ejecuciones
+
+    def casar(self):
+        """Casa todos los libros (una vez por turno) y liquida las ejecuciones"""
+        diario = self.mercado.diario
+        ejecuciones = self.casar_libros()
+        
+        # Liquidación fuera del lock de los libros: las garantías ya están retenidas
+        ultimos = {}
+        for compra, venta, precio, cantidad in ejecuciones:
+            recurso = compra.recurso
+            with compra.sesion.lock:
+                comprador = compra.sesion.jugador
+                comprador.inventario[recurso.nombre] = comprador.inventario.get(recurso.nombre, 0) + cantidad
+                comprador.dinero += (compra.precio - precio) * cantidad
+                comprador.dinero_retenido -= compra.precio * cantidad
+                comprador.marcar_cambio()
+                if diario is not None:
+                    diario.registrar_jugador(compra.sesion)
+            with venta.sesion.lock:
+                vendedor = venta.sesion.jugador
+                vendedor.dinero += precio * cantidad * 0.9  # 10% de comisión
+                vendedor.capacidad_usada -= recurso.peso * cantidad
+                vendedor.retener(recurso.nombre, -cantidad)
+                vendedor.marcar_cambio()
+                if diario is not None:
+                    diario.registrar_jugador(venta.sesion)
+            ultimos[(recurso.indice, compra.columna)] = (recurso, compra.columna, precio)
+        
+        # El último precio ejecutado pasa a ser la cotización de esa región
+        with self.mercado.bloquear([recurso for recurso, _, _ in ultimos.values()], regional=True):
+            for recurso, columna, precio in ultimos.values():
+                recurso.precios_regionales[self.mercado.estado.ubicaciones[columna]] = precio
+                self.mercado.registrar_cambio(recurso)
+            if diario is not None and ultimos:
+                diario.registrar_regiones([[recurso.indice, columna, precio] for recurso, columna, precio in ultimos.values()])
+        return ejecuciones
+
+
+class SesionJugador:
+    """Entrada del registro: jugador, su lock y el último acceso"""
+
+    def __init__(self, sesion_id, jugador):
+        self.sesion_id = sesion_id
+        self.jugador = jugador
+        self.lock = threading.RLock()
+        self.ultimo_acceso = time.monotonic()
+        # Fuera del registro: una petición que aún la tenga ya no puede dejar órdenes
+        self.desalojada = False
+
+
+class PatrimonioJugador:
+    """Entrada del ranking: patrimonio calculado y tenencias con las que se calculó"""
+    __slots__ = ('sesion_id', 'jugador', 'patrimonio', 'tenencias')
+
+    def __init__(self, sesion_id, jugador):
+        self.sesion_id = sesion_id
+        self.jugador = jugador
+        self.patrimonio = 0.0
+        self.tenencias = {}  # {indice del recurso: cantidad}
+
+
+class RankingPatrimonio:
+    """Patrimonio de todos los jugadores, ordenado
+
+    El patrimonio es el dinero más el inventario a precio actual, contando las
+    garantías de las órdenes abiertas: el dinero retenido por las compras y
+    las unidades retenidas por las ventas.
+
+    Se mantiene por diferencias: un cambio de precio solo toca a quienes tienen
+    ese recurso (índice de tenedores por recurso) y un cambio de un jugador solo
+    a ese jugador. Los cambios se acumulan y se aplican al consultar, con los
+    precios de la foto del mercado.
+
+    El orden es una lista ordenada de (-patrimonio, sesion_id), como los índices
+    de EstadisticasMercado: el k-ésimo es orden[k] y la posición de un jugador
+    sale de una búsqueda binaria.
+    """
+
+    def __init__(self, mercado):
+        self.mercado = mercado
+        self.entradas = {}                    # {sesion_id: PatrimonioJugador}
+        self.tenedores = defaultdict(dict)    # {indice del recurso: {sesion_id: cantidad}}
+        self.orden = []
+        self.precios = ()                     # Precios con los que están calculados los patrimonios
+        self.pendientes = {}                  # {sesion_id: jugador} cambiados desde la última consulta
+        self.lock = threading.Lock()
+
+    def agregar(self, sesion_id, jugador):
+        with self.lock:
+            self.entradas[sesion_id] = PatrimonioJugador(sesion_id, jugador)
+            insort(self.orden, (-0.0, sesion_id))
+            self.pendientes[sesion_id] = jugador
+        jugador.observador = functools.partial(self.marcar, sesion_id)
+
+    def quitar(self, sesion_id):
+        with self.lock:
+            entrada = self.entradas.pop(sesion_id, None)
+            if entrada is None:
+                return
+            del self.orden[bisect_left(self.orden, (-entrada.patrimonio, sesion_id))]
+            for indice in entrada.tenencias:
+                del self.tenedores[indice][sesion_id]
+            self.pendientes.pop(sesion_id, None)
+        entrada.jugador.observador = None
+
+    def marcar(self, sesion_id, jugador):
+        """Observador del jugador: su patrimonio se recalcula en la próxima consulta"""
+        with self.lock:
+            if sesion_id in self.entradas:
+                self.pendientes[sesion_id] = jugador
+
+    def _mover(self, entrada, patrimonio):
+        del self.orden[bisect_left(self.orden, (-entrada.patrimonio, entrada.sesion_id))]
+        entrada.patrimonio = patrimonio
+        insort(self.orden, (-patrimonio, entrada.sesion_id))
+
+    def _sincronizar(self, precios):
+        """Aplica precios nuevos y jugadores pendientes; con self.lock tomado"""
+        pendientes = self.pendientes
+        self.pendientes = {}
+
+        # Precios: cada tenedor (no pendiente) suma cantidad * diferencia
+        anteriores = self.precios
+        deltas = defaultdict(float)
+        for i, precio in enumerate(precios):
+            anterior = anteriores[i] if i < len(anteriores) else 0.0
+            if precio != anterior:
+                for sesion_id, cantidad in self.tenedores[i].items():
+                    if sesion_id not in pendientes:
+                        deltas[sesion_id] += cantidad * (precio - anterior)
+        self.precios = precios
+        for sesion_id, delta in deltas.items():
+            entrada = self.entradas[sesion_id]
+            self._mover(entrada, entrada.patrimonio + delta)
+
+        # Jugadores cambiados: patrimonio completo y tenedores por diferencia.
+        # Se leen sin su lock; si estaban a mitad de un cambio, marcar_cambio
+        # los vuelve a dejar pendientes al terminarlo
+        recursos = self.mercado.recursos
+        for sesion_id, jugador in pendientes.items():
+            entrada = self.entradas.get(sesion_id)
+            if entrada is None:
+                continue
+            tenencias = {}
+            for nombre, cantidad in itertools.chain(dict(jugador.inventario).items(), dict(jugador.retenido).items()):
+                recurso = recursos.get(nombre)
+                if recurso is not None and recurso.indice < len(precios):
+                    tenencias[recurso.indice] = tenencias.get(recurso.indice, 0) + cantidad
+            for indice in entrada.tenencias.keys() - tenencias.keys():
+                del self.tenedores[indice][sesion_id]
+            for indice, cantidad in tenencias.items():
+                self.tenedores[indice][sesion_id] = cantidad
+            entrada.tenencias = tenencias
+            dinero = jugador.dinero + jugador.dinero_retenido
+            self._mover(entrada, dinero + sum(precios[i] * c for i, c in tenencias.items()))
+
+    def consultar(self, n=10, sesion_id=None):
+        """(los n primeros [(posición, entrada)], (posición, entrada) de sesion_id o None)"""
+        precios = self.mercado.foto.precio_actual
+        with self.lock:
+            self._sincronizar(precios)
+            primeros = [(k + 1, self.entradas[clave]) for k, (_, clave) in enumerate(self.orden[:n])]
+            propia = None
+            entrada = self.entradas.get(sesion_id)
+            if entrada is not None:
+                propia = (bisect_left(self.orden, (-entrada.patrimonio, sesion_id)) + 1, entrada)
+            return primeros, propia
+
+    def __len__(self):
+        return len(self.entradas)
+
+
+class RegistroJugadores:
+    """Jugadores por sesión, creados bajo demanda y desalojados por inactividad"""
+
+    def __init__(self, max_jugadores=10000, tiempo_inactivo=3600, ranking=None, ordenes=None):
+        self.max_jugadores = max_jugadores
+        self.tiempo_inactivo = tiempo_inactivo
+        self.ranking = ranking
+        # Libros de órdenes (MercadoOrdenes): al desalojar se cancelan las órdenes abiertas
+        self.ordenes = ordenes
+        # Orden LRU: el primero es el menos usado, así desalojar es O(1)
+        self.sesiones = OrderedDict()
+        self.lock = threading.Lock()
+
+    def nuevo_id(self):
+        return uuid.uuid4().hex
+
+    def buscar(self, sesion_id):
+        """La SesionJugador de la sesión si existe (y la marca como usada); no crea ninguna"""
+        with self.lock:
+            sesion = self.sesiones.get(sesion_id)
+            if sesion is not None:
+                self.sesiones.move_to_end(sesion_id)
+                sesion.ultimo_acceso = time.monotonic()
+        return sesion
+
+    def obtener(self, sesion_id):
+        """Devuelve la SesionJugador de la sesión, creándola si no existe"""
+        ahora = time.monotonic()
+        with self.lock:
+            sesion = self.sesiones.get(sesion_id)
+            if sesion is None:
+                # El nombre se ve en el ranking: sale de otro id, no de la cookie de sesión
+                sesion = SesionJugador(sesion_id, Jugador(f"Jugador-{uuid.uuid4().hex[:6]}"))
+                self.sesiones[sesion_id] = sesion
+                if self.ranking is not None:
+                    self.ranking.agregar(sesion_id, sesion.jugador)
+            else:
+                self.sesiones.move_to_end(sesion_id)
+            sesion.ultimo_acceso = ahora
+            desalojadas = self._desalojar(ahora)
+        # Fuera del lock del registro: cancelar toma los locks de la sesión y de los libros
+        for desalojada in desalojadas:
+            self._liquidar(desalojada)
+        return sesion
+
+    def quitar(self, sesion_id):
+        """Quita una sesión sin liquidarla (al rehacer un desalojo ya registrado)"""
+        with self.lock:
+            sesion = self.sesiones.pop(sesion_id, None)
+            if sesion is not None and self.ranking is not None:
+                self.ranking.quitar(sesion_id)
+        return sesion
+
+    def _desalojar(self, ahora):
+        # Solo mira el frente de la cola: coste amortizado constante por petición
+        desalojadas = []
+        while self.sesiones:
+            sesion_id, sesion = next(iter(self.sesiones.items()))
+            inactiva = ahora - sesion.ultimo_acceso > self.tiempo_inactivo
+            if not inactiva and len(self.sesiones) <= self.max_jugadores:
+                break
+            del self.sesiones[sesion_id]
+            if self.ranking is not None:
+                self.ranking.quitar(sesion_id)
+            desalojadas.append(sesion)
+        return desalojadas
+
+    def _liquidar(self, sesion):
+        """Cancela las órdenes abiertas de una sesión desalojada (con devolución) y lo registra"""
+        with sesion.lock:
+            sesion.desalojada = True
+            if self.ordenes is None:
+                return
+            self.ordenes.cancelar_sesion(sesion)
+            diario = self.ordenes.mercado.diario
+            if diario is not None:
+                diario.registrar_desalojo(sesion.sesion_id)
+
+    def __len__(self):
+        return len(self.sesiones)
+
+
+class Suscriptor:
+    """Cola acotada de eventos de un cliente conectado al stream"""
+
+    def __init__(self, sesion_id, max_eventos):
+        self.sesion_id = sesion_id
+        self.cola = queue.Queue(maxsize=max_eventos)
+        self.descartado = False
+
+
+class CanalEventos:
+    """Publica cambios del mercado a los suscriptores del stream (SSE)"""
+
+    def __init__(self, max_eventos=100):
+        self.max_eventos = max_eventos
+        self.suscriptores = set()
+        self.lock = threading.Lock()
+
+    def suscribir(self, sesion_id=None):
+        suscriptor = Suscriptor(sesion_id, self.max_eventos)
+        with self.lock:
+            self.suscriptores.add(suscriptor)
+        return suscriptor
+
+    def desuscribir(self, suscriptor):
+        with self.lock:
+            self.suscriptores.discard(suscriptor)
+
+    def publicar(self, tipo, datos, sesion_id=None, datos_jugador=None):
+        """Envía un evento; datos_jugador solo llega a los suscriptores de esa sesión"""
+        if not self.suscriptores:
+            return
+        mensaje = f"event: {tipo}\ndata: {json.dumps(datos)}\n\n"
+        mensaje_jugador = mensaje
+        if datos_jugador is not None:
+            mensaje_jugador = f"event: {tipo}\ndata: {json.dumps(dict(datos, jugador=datos_jugador))}\n\n"
+        
+        with self.lock:
+            suscriptores = list(self.suscriptores)
+        for suscriptor in suscriptores:
+            propio = sesion_id is not None and suscriptor.sesion_id == sesion_id
+            try:
+                suscriptor.cola.put_nowait(mensaje_jugador if propio else mensaje)
+            except queue.Full:
+                # Cliente lento: se le desconecta en vez de acumular eventos
+                suscriptor.descartado = True
+                self.desuscribir(suscriptor)
+
+
+class RelojMercado:
+    """Hilo que ejecuta los turnos a ritmo fijo, fuera de las peticiones
+
+    Las peticiones manuales no ejecutan nada: se apuntan al siguiente turno, así
+    que muchas seguidas cuentan como una. Con periodo 0 no hay turnos
+    automáticos y una petición despierta al hilo, respetando intervalo_minimo
+    entre turnos.
+    """
+
+    def __init__(self, ejecutar_turno, periodo=30.0, intervalo_minimo=1.0):
+        self.ejecutar_turno = ejecutar_turno
+        self.periodo = periodo
+        self.intervalo_minimo = intervalo_minimo
+        self.condicion = threading.Condition()
+        self.solicitado = False
+        self.completados = 0     # Turnos ejecutados por este reloj
+        self.resultado = None    # Lo que devolvió el último turno
+        self.hilo = None
+        self.activo = False
+
+    def iniciar(self):
+        """Arranca el hilo si no está en marcha (se puede llamar en cada petición)"""
+        if self.hilo is not None:
+            return
+        with self.condicion:
+            if self.hilo is None:
+                self.activo = True
+                self.hilo = threading.Thread(target=self._bucle, name='reloj-mercado', daemon=True)
+                self.hilo.start()
+
+    def detener(self):
+        with self.condicion:
+            self.activo = False
+            self.condicion.notify_all()
+        if self.hilo is not None:
+            self.hilo.join()
+            self.hilo = None
+
+    def solicitar(self, esperar=False, timeout=None):
+        """Pide un turno; devuelve el número (de este reloj) del turno que lo atenderá"""
+        with self.condicion:
+            objetivo = self.completados + 1
+            if not self.periodo:
+                self.solicitado = True
+                self.condicion.notify_all()
+            if esperar:
+                self.condicion.wait_for(lambda: self.completados >= objetivo or not self.activo, timeout)
+        return objetivo
+
+    def _bucle(self):
+        # El primer turno automático llega tras un periodo completo
+        ultimo = time.monotonic() if self.periodo else float('-inf')
+        while True:
+            with self.condicion:
+                while self.activo:
+                    ahora = time.monotonic()
+                    if self.periodo:
+                        espera = ultimo + self.periodo - ahora
+                    elif self.solicitado:
+                        espera = ultimo + self.intervalo_minimo - ahora
+                    else:
+                        espera = None
+                    if espera is not None and espera <= 0:
+                        break
+                    self.condicion.wait(espera)
+                if not self.activo:
+                    return
+                # Lo que se pida desde aquí ya es para el turno siguiente
+                self.solicitado = False
+
+            ultimo = time.monotonic()
+            try:
+                resultado = self.ejecutar_turno()
+            except Exception:
+                log.exception("Fallo al ejecutar el turno")
+                resultado = None
+            with self.condicion:
+                self.completados += 1
+                self.resultado = resultado
+                self.condicion.notify_all()
+
+
+class PlanificadorItinerarios:
+    """Itinerarios de varias paradas: en cada ciudad se vende la carga y se compra la del siguiente tramo
+
+    Busca por capas de ciudades visitadas guardando, por (visitadas, ciudad actual),
+    el máximo dinero alcanzado. Como la ganancia de un tramo no disminuye con más
+    dinero, eso es un Held-Karp exacto para mapas pequeños; en mapas grandes cada
+    capa se poda a las mejores `ancho_haz` (búsqueda en haz).
+    """
+
+    MAX_CIUDADES_EXACTO = 12
+
+    def __init__(self, mercado, grafo):
+        self.mercado = mercado
+        self.grafo = grafo
+        self.cache_tramos = {}  # {(version, capacidad): candidatos por par de ciudades}
+
+    def _tramos(self, capacidad):
+        """Para cada (a, b): [(margen, precio_compra, cantidad_max, indice)] con margen > 0"""
+        clave = (self.mercado.version, capacidad)
+        tramos = self.cache_tramos.get(clave)
+        if tramos is not None:
+            return tramos
+        
+        e = self.mercado.estado
+        n = e.n_regiones
+        tramos = [[[] for _ in range(n)] for _ in range(n)]
+        for recurso in self.mercado.por_indice:
+            inicio = recurso.indice * n
+            precios = e.precios_regionales[inicio:inicio + n]
+            stocks = e.stocks_regionales[inicio:inicio + n]
+            por_peso = capacidad // recurso.peso if recurso.peso > 0 else capacidad
+            for a in range(n):
+                cantidad_max = min(stocks[a], por_peso)
+                if cantidad_max <= 0 or precios[a] <= 0:
+                    continue
+                for b in range(n):
+                    margen = precios[b] * 0.9 - precios[a]  # 10% de comisión
+                    if margen > 0 and b != a:
+                        tramos[a][b].append((margen, precios[a], cantidad_max, recurso.indice))
+        
+        self.cache_tramos = {clave: tramos}
+        return tramos
+
+    def _mejor_carga(self, candidatos, dinero):
+        mejor = (0, None, 0)
+        for margen, precio, cantidad_max, indice in candidatos:
+            cantidad = min(cantidad_max, int(dinero // precio))
+            if margen * cantidad > mejor[0]:
+                mejor = (margen * cantidad, indice, cantidad)
+        return mejor
+
+    def planificar(self, origen, capacidad, dinero, max_paradas=4, tiempo_ms=50, ancho_haz=64):
+        """Mejor itinerario encontrado dentro del presupuesto de tiempo"""
+        limite = time.perf_counter() + tiempo_ms / 1000
+        e = self.mercado.estado
+        n = e.n_regiones
+        inicio = e.id_ubicacion.get(origen)
+        if inicio is None:
+            return None
+        
+        costos = self.grafo.matriz_costos(e.ubicaciones)
+        tramos = self._tramos(capacidad)
+        exacto = n <= self.MAX_CIUDADES_EXACTO
+        
+        # Estado: (visitadas, ciudad) -> (dinero, estado_previo, tramo)
+        estado_inicial = (1 << inicio, inicio)
+        estados = {estado_inicial: (dinero, None, None)}
+        capa = [estado_inicial]
+        mejor = estado_inicial
+        completo = True
+        
+        for _ in range(max_paradas):
+            siguiente = {}
+            for clave in capa:
+                if time.perf_counter() > limite:
+                    completo = False
+                    break
+                visitadas, a = clave
+                dinero_actual = estados[clave][0]
+                for b in range(n):
+                    if visitadas & (1 << b) or costos[a][b] == float('inf'):
+                        continue
+                    ganancia, indice, cantidad = self._mejor_carga(tramos[a][b], dinero_actual)
+                    dinero_nuevo = dinero_actual + ganancia - costos[a][b]
+                    if dinero_nuevo < 0:
+                        continue
+                    nueva = (visitadas | (1 << b), b)
+                    if nueva not in siguiente or dinero_nuevo > siguiente[nueva][0]:
+                        siguiente[nueva] = (dinero_nuevo, clave, (indice, cantidad, ganancia))
             
-            if recurso.nombre not in recomendaciones:
-                recomendaciones[recurso.nombre] = 0
-            recomendaciones[recurso.nombre] += 1
-            
-            w -= int(recurso.peso)
-            dinero_gastado += recurso.precio_actual
+            if not exacto and len(siguiente) > ancho_haz:
+                siguiente = dict(heapq.nlargest(ancho_haz, siguiente.items(), key=lambda x: x[1][0]))
+            estados.update(siguiente)
+            capa = list(siguiente)
+            for clave in capa:
+                if estados[clave][0] > estados[mejor][0]:
+                    mejor = clave
+            if not completo or not capa:
+                break
         
-        resultado = []
-        for nombre, cantidad in recomendaciones.items():
-            recurso = mercado.recursos[nombre]
-            resultado.append((recurso, cantidad))
+        # Reconstruir el itinerario desde el mejor estado
+        tramos_plan = []
+        clave = mejor
+        while estados[clave][1] is not None:
+            dinero_final, previo, (indice, cantidad, ganancia) = estados[clave]
+            a, b = previo[1], clave[1]
+            recurso = self.mercado.por_indice[indice] if indice is not None else None
+            tramos_plan.append({
+                'origen': e.ubicaciones[a],
+                'destino': e.ubicaciones[b],
+                'recurso': recurso.nombre if recurso else None,
+                'cantidad': cantidad,
+                'precio_compra': e.precios_regionales[indice * n + a] if recurso else 0,
+                'precio_venta': e.precios_regionales[indice * n + b] * 0.9 if recurso else 0,
+                'costo_viaje': costos[a][b],
+                'ganancia_neta': ganancia - costos[a][b]
+            })
+            clave = previo
+        tramos_plan.reverse()
         
-        return resultado
+        return {
+            'tramos': tramos_plan,
+            'ciudades': [origen] + [t['destino'] for t in tramos_plan],
+            'dinero_final': estados[mejor][0],
+            'ganancia_total': estados[mejor][0] - dinero,
+            'exacto': exacto and completo
+        }
+
 
 class SimuladorComercio:
     """Sistema principal que integra todos los componentes"""
     
-    def __init__(self):
-        self.mercado = Mercado()
-        self.grafo = GrafoCiudades()
-        self.jugador = Jugador("Jugador1")
+    def __init__(self, mercado=None, grafo=None):
+        self.mercado = mercado if mercado is not None else Mercado()
+        self.grafo = grafo if grafo is not None else GrafoCiudades()
+        self.ranking = RankingPatrimonio(self.mercado)
+        self.jugadores = RegistroJugadores(ranking=self.ranking, ordenes=self.mercado.ordenes)
+        self.eventos = CanalEventos()
+        self.planificador = PlanificadorItinerarios(self.mercado, self.grafo)
+        self.mercado.difusion = DifusionRegional(self.mercado, self.grafo)
         self.turno = 0
-        self.inicializar_mundo()
+        if grafo is None:
+            self.inicializar_mundo()
+
+    @classmethod
+    def generar(cls, n_ciudades, n_recursos, densidad=2.0, semilla=0, historial=False):
+        """Mundo procedural reproducible: N ciudades conectadas, M recursos
+
+        densidad es el número medio de rutas extra por ciudad, además del árbol
+        que garantiza que todas estén conectadas.
+        """
+        rng = random.Random(semilla)
+        ciudades = [f"Ciudad {i}" for i in range(n_ciudades)]
+        
+        grafo = GrafoCiudades()
+        for i in range(1, n_ciudades):
+            distancia = rng.randint(50, 400)
+            grafo.agregar_ruta(ciudades[i], ciudades[rng.randrange(i)], distancia, round(distancia * rng.uniform(1.0, 1.3)))
+        for _ in range(int(n_ciudades * densidad)):
+            a, b = rng.randrange(n_ciudades), rng.randrange(n_ciudades)
+            if a != b:
+                distancia = rng.randint(50, 400)
+                grafo.agregar_ruta(ciudades[a], ciudades[b], distancia, round(distancia * rng.uniform(1.0, 1.3)))
+        
+        mercado = Mercado(ciudades, historial=historial)
+        e = mercado.estado
+        for j in range(n_recursos):
+            recurso = Recurso(f"Recurso {j}", rng.randint(50, 3000), rng.randint(1, 5), rng.randint(1, 10), e)
+            origen = rng.randrange(n_ciudades)
+            recurso.ubicacion = ciudades[origen]
+            e.demanda[recurso.indice] = rng.randint(30, 70)
+            e.oferta[recurso.indice] = rng.randint(30, 70)
+            
+            # Mismo reparto que inicializar_recursos, escrito directo en las matrices
+            base = recurso.precio_base
+            multiplicador = 1.2 + (recurso.rareza * 0.15)
+            inicio = recurso.indice * n_ciudades
+            for columna in range(n_ciudades):
+                if columna == origen:
+                    e.precios_regionales[inicio + columna] = base * rng.uniform(0.7, 0.9)
+                    e.stocks_regionales[inicio + columna] = rng.randint(150, 250)
+                else:
+                    e.precios_regionales[inicio + columna] = base * rng.uniform(multiplicador, multiplicador + 0.3)
+                    e.stocks_regionales[inicio + columna] = rng.randint(20, 80)
+            mercado.agregar_recurso(recurso)
+        e.estadisticas.reconstruir()
+        if mercado.historial is not None:
+            mercado.historial.ajustar()
+        
+        return cls(mercado, grafo)
     
     def inicializar_mundo(self):
             """Crea el mundo del juego con ciudades y rutas - RED COMPLEJA"""
             
-            # Torre Keio connections
-            self.grafo.agregar_ruta("Torre Keio", "Puerto Cache", 100, 120)
-            self.grafo.agregar_ruta("Torre Keio", "Nodo Central", 95, 100)
-            self.grafo.agregar_ruta("Torre Keio", "Refinería de Códigos", 280, 350)
-            
-            # Puerto Cache connections
-            self.grafo.agregar_ruta("Puerto Cache", "Anillos de Datos", 120, 150)
-            self.grafo.agregar_ruta("Puerto Cache", "Valle Binario", 85, 90)
-            
-            # Nodo Central connections
-            self.grafo.agregar_ruta("Nodo Central", "Bosque del Firmware", 130, 140)
-            self.grafo.agregar_ruta("Nodo Central", "Montaña", 100, 110)
-            
-            # Anillos de Datos connections
-            self.grafo.agregar_ruta("Anillos de Datos", "Valle Binario", 75, 80)
-            self.grafo.agregar_ruta("Anillos de Datos", "Minas de Silicio", 180, 200)
-            self.grafo.agregar_ruta("Anillos de Datos", "Bosque del Firmware", 350, 400)
-            
-            # Valle Binario connections
-            self.grafo.agregar_ruta("Valle Binario", "Refinería de Códigos", 120, 130)
-            self.grafo.agregar_ruta("Valle Binario", "Minas de Silicio", 140, 160)
-            
-            # Montaña connections
-            self.grafo.agregar_ruta("Montaña", "Bosque del Firmware", 90, 95)
-            self.grafo.agregar_ruta("Montaña", "Refinería de Códigos", 160, 180)
-            
-            # Bosque del Firmware connections
-            self.grafo.agregar_ruta("Bosque del Firmware", "Refinería de Códigos", 150, 170)
-            
-            # Minas de Silicio connections
-            self.grafo.agregar_ruta("Minas de Silicio", "Refinería de Códigos", 130, 140)
-            
             # Torre Keio connections
             self.grafo.agregar_ruta("Torre Keio", "Puerto Cache", 100, 120)
             self.grafo.agregar_ruta("Torre Keio", "Nodo Central", 95, 100)
@@ -370,4 +2729,4 @@ class SimuladorComercio:
             self.grafo.agregar_ruta("Bosque del Firmware", "Refinería de Códigos", 150, 170)
             
             # Minas de Silicio connections
-            self.grafo.agregar_ruta("Minas de Silicio", "Refinería de Códigos", 130, 140)
\ No newline at end of file
+            self.grafo.agregar_ruta("Minas de Silicio", "Refinería de Códigos", 130, 140)
@@ -0,0 +1,155 @@
+"""Instrumentación: logging no bloqueante, contadores e histogramas de latencia
+
+Los registros de log se encolan en el hilo que los emite y un QueueListener
+los escribe en segundo plano, así las peticiones no esperan a stdout.
+Las métricas se exponen en formato de texto de Prometheus.
+"""
+import atexit
+import functools
+import logging
+import logging.handlers
+import math
+import queue
+import threading
+import time
+from bisect import bisect_left
+
+# Límites superiores de los buckets, en segundos
+BUCKETS_LATENCIA = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_listener = None
+
+
+def configurar_logging(nivel=logging.INFO):
+    """Envía los logs de 'keyo' a una cola que vacía un hilo aparte (idempotente)"""
+    global _listener
+    logger = logging.getLogger('keyo')
+    logger.setLevel(nivel)
+    if _listener is not None:
+        return logger
+
+    cola = queue.SimpleQueue()
+    salida = logging.StreamHandler()
+    salida.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+    _listener = logging.handlers.QueueListener(cola, salida, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    logger.addHandler(logging.handlers.QueueHandler(cola))
+    logger.propagate = False
+    return logger
+
+
+def percentil(ordenados, p):
+    """Percentil por rango más cercano de una lista ya ordenada (0.0 si está vacía)
+
+    Rango ceil(p/100 * N), contado desde 1. Se multiplica antes de dividir:
+    con p entero, p * N / 100 es exacto cuando el rango es entero.
+    """
+    if not ordenados:
+        return 0.0
+    k = max(0, min(len(ordenados) - 1, math.ceil(p * len(ordenados) / 100) - 1))
+    return ordenados[k]
+
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _etiquetas(etiquetas):
+    if not etiquetas:
+        return ''
+    return '{' + ','.join(f'{k}="{_escapar(v)}"' for k, v in etiquetas) + '}'
+
+
+class Histograma:
+    """Histograma de buckets fijos; guarda recuentos por bucket y los acumula al exponer"""
+
+    def __init__(self, buckets=BUCKETS_LATENCIA):
+        self.buckets = buckets
+        self.recuentos = [0] * (len(buckets) + 1)  # El último es +Inf
+        self.suma = 0.0
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def observar(self, valor):
+        i = bisect_left(self.buckets, valor)
+        with self.lock:
+            self.recuentos[i] += 1
+            self.suma += valor
+            self.total += 1
+
+    def lineas(self, nombre, etiquetas):
+        with self.lock:
+            recuentos, suma, total = list(self.recuentos), self.suma, self.total
+        acumulado = 0
+        for limite, recuento in zip(self.buckets + ('+Inf',), recuentos):
+            acumulado += recuento
+            yield f'{nombre}_bucket{_etiquetas(etiquetas + (("le", limite),))} {acumulado}'
+        yield f'{nombre}_sum{_etiquetas(etiquetas)} {suma}'
+        yield f'{nombre}_count{_etiquetas(etiquetas)} {total}'
+
+
+class RegistroMetricas:
+    """Contadores e histogramas con etiquetas: {nombre: {(etiqueta, valor)...: métrica}}"""
+
+    def __init__(self):
+        self.contadores = {}
+        self.histogramas = {}
+        self.ayuda = {}
+        self.lock = threading.Lock()
+
+    def incrementar(self, nombre, valor=1, ayuda='', **etiquetas):
+        clave = tuple(sorted(etiquetas.items()))
+        with self.lock:
+            serie = self.contadores.setdefault(nombre, {})
+            serie[clave] = serie.get(clave, 0) + valor
+            self.ayuda.setdefault(nombre, ayuda)
+
+    def observar(self, nombre, valor, ayuda='', **etiquetas):
+        clave = tuple(sorted(etiquetas.items()))
+        histograma = self.histogramas.get(nombre, {}).get(clave)
+        if histograma is None:
+            with self.lock:
+                serie = self.histogramas.setdefault(nombre, {})
+                histograma = serie.setdefault(clave, Histograma())
+                self.ayuda.setdefault(nombre, ayuda)
+        histograma.observar(valor)
+
+    def exponer(self):
+        """Texto en el formato de exposición de Prometheus (0.0.4)"""
+        with self.lock:
+            contadores = {n: dict(s) for n, s in self.contadores.items()}
+            histogramas = {n: dict(s) for n, s in self.histogramas.items()}
+        lineas = []
+        for nombre in sorted(contadores):
+            if self.ayuda.get(nombre):
+                lineas.append(f'# HELP {nombre} {self.ayuda[nombre]}')
+            lineas.append(f'# TYPE {nombre} counter')
+            for clave, valor in sorted(contadores[nombre].items()):
+                lineas.append(f'{nombre}{_etiquetas(clave)} {valor}')
+        for nombre in sorted(histogramas):
+            if self.ayuda.get(nombre):
+                lineas.append(f'# HELP {nombre} {self.ayuda[nombre]}')
+            lineas.append(f'# TYPE {nombre} histogram')
+            for clave, histograma in sorted(histogramas[nombre].items()):
+                lineas.extend(histograma.lineas(nombre, clave))
+        return '\n'.join(lineas) + '\n'
+
+
+registro = RegistroMetricas()
+
+
+def cronometrado(funcion_medida):
+    """Decorador: cuenta llamadas y mide la latencia en keyo_funcion_segundos{funcion=...}"""
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            inicio = time.perf_counter()
+            try:
+                return funcion(*args, **kwargs)
+            finally:
+                registro.observar('keyo_funcion_segundos', time.perf_counter() - inicio,
+                                  'Latencia de las funciones del núcleo', funcion=funcion_medida)
+        return envoltura
+    return decorador
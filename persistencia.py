@@ -0,0 +1,356 @@
+"""Persistencia del simulador: instantánea binaria + registro de operaciones
+
+La instantánea guarda el mundo completo (mapa, recursos, matrices regionales,
+jugadores y órdenes abiertas) y el registro añade, en JSON por líneas, lo
+ocurrido desde entonces. Al arrancar se mapea la instantánea en memoria y se
+rehace solo la cola del registro, así que recuperar cuesta lo que mida el
+registro, no el mundo.
+
+Los comercios se registran como valores absolutos (estado del jugador y fila
+del recurso tras la operación), de modo que aplicarlos dos veces no cambia
+nada. Los turnos se registran por su semilla y se rehacen simulándolos, y el
+casamiento de los libros se rehace casándolos; su liquidación se registra
+como estados absolutos de los jugadores y precios de las regiones.
+
+Cada registro se escribe con los locks de lo que cambia aún tomados (los del
+recurso en un comercio, todos en un turno, el de los libros en órdenes y
+casamientos), así su orden en el fichero es el orden en que ocurrieron. El
+Mercado llama a este objeto como su diario; los comercios, a través de
+al_confirmar.
+
+Formato de la instantánea:
+    cabecera  struct '<4sHQ'  (MAGIA, VERSION, bytes de metadatos)
+    metadatos JSON UTF-8
+    arreglos  bytes crudos en el orden de ARREGLOS
+"""
+import itertools
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+from array import array
+
+from juego import GrafoCiudades, Mercado, Orden, Recurso, SimuladorComercio
+
+log = logging.getLogger('keyo.persistencia')
+
+MAGIA = b'KEYO'
+VERSION = 2  # 2: garantías de los jugadores; turnos y casamientos registrados por separado
+CABECERA = struct.Struct('<4sHQ')
+# (atributo de EstadoMercado, tipo del array)
+ARREGLOS = (
+    ('precio_base', 'd'), ('precio_actual', 'd'), ('demanda', 'l'), ('oferta', 'l'),
+    ('stock', 'l'), ('precios_regionales', 'd'), ('stocks_regionales', 'l'),
+)
+
+
+class Persistencia:
+    """Instantánea y registro en un directorio; sin directorio no hace nada"""
+
+    def __init__(self, directorio=None, sincronizar=False):
+        self.directorio = directorio
+        self.sincronizar = sincronizar  # fsync en cada registro
+        self.lock = threading.RLock()
+        self.secuencia = 0
+        self.registro = None
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+            self.ruta_instantanea = os.path.join(directorio, 'instantanea.bin')
+            self.ruta_registro = os.path.join(directorio, 'registro.jsonl')
+
+    @property
+    def activa(self):
+        return bool(self.directorio)
+
+    # ------------------------------------------------------------------
+    # Registro de operaciones
+    # ------------------------------------------------------------------
+
+    def _escribir(self, registro):
+        if not self.activa:
+            return
+        with self.lock:
+            if self.registro is None:
+                self.registro = open(self.ruta_registro, 'a', encoding='utf-8')
+            self.secuencia += 1
+            registro['n'] = self.secuencia
+            self.registro.write(json.dumps(registro, ensure_ascii=False, separators=(',', ':')) + '\n')
+            self.registro.flush()
+            if self.sincronizar:
+                os.fsync(self.registro.fileno())
+
+    def registrar_comercio(self, sesion, recursos):
+        """Estado del jugador y de los recursos tocados; con el lock de la sesión y los de los recursos"""
+        if not self.activa:
+            return
+        registro = {'tipo': 'comercio', 'jugador': _jugador(sesion), 'recursos': [
+            [r.indice, r.precio_actual, r.demanda, r.oferta, r.stock] for r in recursos
+        ]}
+        self._escribir(registro)
+
+    def registrar_orden(self, orden):
+        if not self.activa:
+            return
+        self._escribir({'tipo': 'orden', 'orden': _orden(orden), 'jugador': _jugador(orden.sesion)})
+
+    def registrar_cancelacion(self, sesion, orden_id):
+        if not self.activa:
+            return
+        self._escribir({'tipo': 'cancelacion', 'id': orden_id, 'jugador': _jugador(sesion)})
+
+    def registrar_turno(self, semilla, n_turnos):
+        if not self.activa:
+            return
+        self._escribir({'tipo': 'turno', 'semilla': semilla, 'n_turnos': n_turnos})
+
+    def registrar_casamiento(self):
+        if not self.activa:
+            return
+        self._escribir({'tipo': 'casamiento'})
+
+    def registrar_jugador(self, sesion):
+        if not self.activa:
+            return
+        self._escribir({'tipo': 'jugador', 'jugador': _jugador(sesion)})
+
+    def registrar_desalojo(self, sesion_id):
+        """Sesión desalojada, tras registrar la cancelación de sus órdenes"""
+        if not self.activa:
+            return
+        self._escribir({'tipo': 'desalojo', 'sesion': sesion_id})
+
+    def registrar_regiones(self, celdas):
+        """Precios regionales fijados: [[indice del recurso, columna, precio]]"""
+        if not self.activa:
+            return
+        self._escribir({'tipo': 'regiones', 'celdas': celdas})
+
+    # ------------------------------------------------------------------
+    # Instantánea
+    # ------------------------------------------------------------------
+
+    def guardar(self, simulador):
+        """Escribe la instantánea de forma atómica y vacía el registro
+
+        Se llama entre turnos. Con los locks de todos los recursos y el de los
+        libros nada de lo que se registra bajo ellos cambia a mitad; los
+        jugadores se leen después de fijar la secuencia, así un cambio a medias
+        queda también en un registro posterior, que lo rehace entero.
+        """
+        if not self.activa:
+            return
+        mercado = simulador.mercado
+        estado = mercado.estado
+        ordenes = mercado.ordenes
+        with simulador.jugadores.lock:
+            sesiones = list(simulador.jugadores.sesiones.values())
+        with mercado.bloquear(), ordenes.lock, self.lock:
+            abiertas = [_orden(orden) for orden in ordenes.ordenes.values()]
+            siguiente_id = next(ordenes.ids)
+            ordenes.ids = itertools.count(siguiente_id)
+
+            metadatos = {
+                'secuencia': self.secuencia,
+                'turno': simulador.turno,
+                'version_mercado': mercado.version,
+                'tamano_entero': array('l').itemsize,
+                'ubicaciones': estado.ubicaciones,
+                'rutas': [
+                    [origen, destino, distancia, costo]
+                    for origen, vecinos in simulador.grafo.grafo.items()
+                    for destino, distancia, costo in vecinos if origen < destino
+                ],
+                'recursos': [[r.nombre, r.rareza, r.peso, r.ubicacion] for r in mercado.por_indice],
+                'jugadores': [_jugador(sesion) for sesion in sesiones],
+                'ordenes': abiertas,
+                'siguiente_orden': siguiente_id,
+            }
+            cabecera_json = json.dumps(metadatos, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+            temporal = self.ruta_instantanea + '.tmp'
+            with open(temporal, 'wb') as f:
+                f.write(CABECERA.pack(MAGIA, VERSION, len(cabecera_json)))
+                f.write(cabecera_json)
+                for nombre, _ in ARREGLOS:
+                    getattr(estado, nombre).tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporal, self.ruta_instantanea)
+
+            # Lo anterior ya está en la instantánea
+            if self.registro is not None:
+                self.registro.close()
+            self.registro = open(self.ruta_registro, 'w', encoding='utf-8')
+            log.info("Instantánea guardada: turno=%s secuencia=%s", simulador.turno, self.secuencia)
+
+    def restaurar(self):
+        """Reconstruye el simulador desde disco; None si no hay instantánea"""
+        if not self.activa or not os.path.exists(self.ruta_instantanea):
+            return None
+        with open(self.ruta_instantanea, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as datos:
+            magia, version, n_meta = CABECERA.unpack_from(datos, 0)
+            if magia != MAGIA or version != VERSION:
+                raise ValueError(f"Instantánea no reconocida: {self.ruta_instantanea}")
+            inicio = CABECERA.size
+            metadatos = json.loads(datos[inicio:inicio + n_meta].decode('utf-8'))
+            if metadatos['tamano_entero'] != array('l').itemsize:
+                raise ValueError("La instantánea se escribió en una plataforma con otro tamaño de entero")
+            with memoryview(datos) as vista, vista[inicio + n_meta:] as arreglos:
+                simulador = self._construir(metadatos, arreglos)
+
+        self.secuencia = metadatos['secuencia']
+        aplicados = self._rehacer(simulador)
+        log.info("Restaurado turno=%s con %d operaciones del registro", simulador.turno, aplicados)
+        return simulador
+
+    def _construir(self, metadatos, arreglos):
+        grafo = GrafoCiudades()
+        for origen, destino, distancia, costo in metadatos['rutas']:
+            grafo.agregar_ruta(origen, destino, distancia, costo)
+
+        mercado = Mercado(metadatos['ubicaciones'])
+        estado = mercado.estado
+        for nombre, rareza, peso, ubicacion in metadatos['recursos']:
+            recurso = Recurso(nombre, 0.0, rareza, peso, estado)
+            recurso.ubicacion = ubicacion
+            mercado.agregar_recurso(recurso)
+
+        # Las filas ya existen: se sobrescriben con los bytes de la instantánea
+        posicion = 0
+        for nombre, tipo in ARREGLOS:
+            destino = getattr(estado, nombre)
+            n_bytes = len(destino) * destino.itemsize
+            valores = array(tipo)
+            valores.frombytes(arreglos[posicion:posicion + n_bytes])
+            destino[:] = valores
+            posicion += n_bytes
+        estado.estadisticas.reconstruir()
+        if mercado.historial is not None:
+            mercado.historial.ajustar()  # El historial no se guarda: arranca en el estado restaurado
+        # Las vistas cacheadas por los clientes ya no valen
+        mercado.version = metadatos['version_mercado'] + 1
+
+        simulador = SimuladorComercio(mercado, grafo)
+        simulador.turno = metadatos['turno']
+        for datos in metadatos['jugadores']:
+            _aplicar_jugador(simulador, datos)
+        for datos in metadatos['ordenes']:
+            _aplicar_orden(simulador, datos)
+        mercado.ordenes.ids = itertools.count(metadatos['siguiente_orden'])
+        return simulador
+
+    def _rehacer(self, simulador):
+        """Aplica los registros posteriores a la instantánea
+
+        Una línea cortada (caída a mitad de escritura) y lo que la siga se
+        recortan del fichero, para que los registros nuevos no queden detrás.
+        """
+        if not os.path.exists(self.ruta_registro):
+            return 0
+        mercado = simulador.mercado
+        aplicados = 0
+        with open(self.ruta_registro, 'r+b') as f:
+            while True:
+                posicion = f.tell()
+                linea = f.readline()
+                if not linea:
+                    break
+                try:
+                    if not linea.endswith(b'\n'):
+                        raise ValueError("línea sin terminar")
+                    registro = json.loads(linea)
+                except ValueError:
+                    log.warning("Registro cortado tras la secuencia %s; se descarta el resto", self.secuencia)
+                    f.truncate(posicion)
+                    break
+                if registro['n'] <= self.secuencia:
+                    continue
+                tipo = registro['tipo']
+                if tipo == 'comercio':
+                    _aplicar_jugador(simulador, registro['jugador'])
+                    filas = registro['recursos']
+                    with mercado.bloquear([mercado.por_indice[fila[0]] for fila in filas]):
+                        for indice, precio, demanda, oferta, stock in filas:
+                            recurso = mercado.por_indice[indice]
+                            recurso.precio_actual = precio
+                            recurso.demanda = demanda
+                            recurso.oferta = oferta
+                            recurso.stock = stock
+                            mercado.registrar_cambio(recurso)
+                elif tipo == 'orden':
+                    _aplicar_jugador(simulador, registro['jugador'])
+                    _aplicar_orden(simulador, registro['orden'])
+                elif tipo == 'cancelacion':
+                    ordenes = mercado.ordenes
+                    orden = ordenes.ordenes.pop(registro['id'], None)
+                    if orden is not None:
+                        ordenes.libro(orden.recurso, orden.columna).cancelar(orden.id)
+                    _aplicar_jugador(simulador, registro['jugador'])
+                elif tipo == 'turno':
+                    mercado.simular_mercado(registro['n_turnos'], registro['semilla'])
+                    simulador.turno += registro['n_turnos']
+                elif tipo == 'casamiento':
+                    mercado.ordenes.casar_libros()
+                elif tipo == 'jugador':
+                    _aplicar_jugador(simulador, registro['jugador'])
+                elif tipo == 'desalojo':
+                    simulador.jugadores.quitar(registro['sesion'])
+                elif tipo == 'regiones':
+                    celdas = registro['celdas']
+                    with mercado.bloquear([mercado.por_indice[celda[0]] for celda in celdas], regional=True):
+                        for indice, columna, precio in celdas:
+                            recurso = mercado.por_indice[indice]
+                            recurso.precios_regionales[mercado.estado.ubicaciones[columna]] = precio
+                            mercado.registrar_cambio(recurso)
+                self.secuencia = registro['n']
+                aplicados += 1
+        return aplicados
+
+
+def _jugador(sesion):
+    jugador = sesion.jugador
+    return {
+        'sesion': sesion.sesion_id,
+        'nombre': jugador.nombre,
+        'dinero': jugador.dinero,
+        'capacidad_max': jugador.capacidad_max,
+        'capacidad_usada': jugador.capacidad_usada,
+        'inventario': dict(jugador.inventario),  # Copia: otro hilo puede estar cambiándolo
+        'dinero_retenido': jugador.dinero_retenido,
+        'retenido': dict(jugador.retenido),
+        'version': jugador.version,
+    }
+
+
+def _aplicar_jugador(simulador, datos):
+    jugador = simulador.jugadores.obtener(datos['sesion']).jugador
+    jugador.nombre = datos['nombre']
+    jugador.dinero = datos['dinero']
+    jugador.capacidad_max = datos['capacidad_max']
+    jugador.capacidad_usada = datos['capacidad_usada']
+    jugador.inventario = dict(datos['inventario'])
+    jugador.dinero_retenido = datos['dinero_retenido']
+    jugador.retenido = dict(datos['retenido'])
+    jugador.version = datos['version']
+    simulador.ranking.marcar(datos['sesion'], jugador)
+
+
+def _orden(orden):
+    return [orden.id, orden.sesion.sesion_id, orden.lado, orden.recurso.indice,
+            orden.columna, orden.precio, orden.cantidad, orden.secuencia]
+
+
+def _aplicar_orden(simulador, datos):
+    orden_id, sesion_id, lado, indice, columna, precio, cantidad, secuencia = datos
+    ordenes = simulador.mercado.ordenes
+    if orden_id in ordenes.ordenes:
+        return  # Ya estaba en la instantánea
+    recurso = simulador.mercado.por_indice[indice]
+    orden = Orden(orden_id, simulador.jugadores.obtener(sesion_id), lado, recurso, columna, precio, cantidad, secuencia)
+    ordenes.ordenes[orden_id] = orden
+    ordenes.libro(recurso, columna).agregar(orden)
+    siguiente = next(ordenes.ids)
+    ordenes.ids = itertools.count(max(siguiente, orden_id + 1))
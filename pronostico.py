@@ -0,0 +1,103 @@
+"""Pronóstico de precios por Monte Carlo en un pool de procesos
+
+Se parte de la foto del mercado (inmutable, se lee sin locks) y se copian solo
+las cuatro columnas que mueve un turno: precio base, precio actual, demanda y
+oferta. Un lote de k trayectorias es un EstadoMercado sin regiones con esas
+columnas repetidas k veces (una copia por trayectoria, hecha multiplicando
+los arrays), así que cada turno del lote es una sola llamada a
+EstadoMercado.avanzar, la misma dinámica que simular_mercado.
+
+Los lotes tienen tamaño fijo y cada uno su propia semilla, derivada de la
+del pronóstico: el resultado es el mismo con uno o con N procesos, y los
+lotes no comparten nada, así que el rendimiento crece con los núcleos.
+"""
+import multiprocessing
+import os
+import random
+import threading
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from juego import EstadoMercado
+from metricas import cronometrado, percentil
+
+PERCENTILES = (5, 25, 50, 75, 95)
+TRAYECTORIAS_POR_LOTE = 100  # Unidad de reparto; pequeña para repartir bien entre procesos
+
+
+def _simular_lote(columnas, n_turnos, n_trayectorias, semilla):
+    """Precios de n trayectorias: array plano [turno][trayectoria][recurso]"""
+    # Sin estadísticas: nadie las consulta y rehacerlas costaría un orden por turno
+    estado = EstadoMercado(estadisticas=False)
+    for nombre, tipo, valores in zip(('precio_base', 'precio_actual', 'demanda', 'oferta'), 'ddll', columnas):
+        setattr(estado, nombre, array(tipo, valores) * n_trayectorias)
+    estado.stock = array('l', [0]) * len(estado.precio_base)
+
+    rng = random.Random(semilla)
+    precios = array('d')
+    for _ in range(n_turnos):
+        estado.avanzar(1, rng)
+        precios.extend(estado.precio_actual)
+    return precios
+
+
+class Pronosticador:
+    """Reparte las trayectorias en lotes sobre un ProcessPoolExecutor
+
+    Con procesos=0 los lotes se simulan en el propio proceso, en el mismo orden.
+    """
+
+    def __init__(self, procesos=None):
+        self.procesos = (os.cpu_count() or 1) if procesos is None else procesos
+        self._pool = None
+        self.lock = threading.Lock()
+
+    def _ejecutor(self):
+        with self.lock:
+            if self._pool is None:
+                # Nunca fork: se llama desde un servidor con hilos, y un hijo
+                # podría heredar locks tomados. Con forkserver los hijos salen
+                # de un proceso sin hilos que importa el módulo principal una
+                # sola vez (como __mp_main__, ver app.py)
+                metodos = multiprocessing.get_all_start_methods()
+                contexto = multiprocessing.get_context('forkserver' if 'forkserver' in metodos else 'spawn')
+                self._pool = ProcessPoolExecutor(self.procesos, mp_context=contexto)
+            return self._pool
+
+    @cronometrado('pronostico')
+    def pronosticar(self, mercado, n_turnos=10, n_trayectorias=1000, semilla=0,
+                    percentiles=PERCENTILES, foto=None):
+        """Bandas de precio por recurso: [{percentil: [precio en cada turno]}] por índice"""
+        foto = foto if foto is not None else mercado.foto
+        n_recursos = len(foto.precio_actual)
+        columnas = (tuple(mercado.estado.precio_base[:n_recursos]), foto.precio_actual, foto.demanda, foto.oferta)
+
+        tamanos = [TRAYECTORIAS_POR_LOTE] * (n_trayectorias // TRAYECTORIAS_POR_LOTE)
+        if n_trayectorias % TRAYECTORIAS_POR_LOTE:
+            tamanos.append(n_trayectorias % TRAYECTORIAS_POR_LOTE)
+        semillas = random.Random(semilla)
+        lotes = [(columnas, n_turnos, tamano, semillas.getrandbits(64)) for tamano in tamanos]
+
+        if self.procesos:
+            resultados = list(self._ejecutor().map(_simular_lote, *zip(*lotes)))
+        else:
+            resultados = [_simular_lote(*lote) for lote in lotes]
+
+        bandas = [{p: [] for p in percentiles} for _ in range(n_recursos)]
+        for turno in range(n_turnos):
+            for i in range(n_recursos):
+                # En cada lote, las muestras de (turno, recurso) van cada n_recursos posiciones
+                muestras = []
+                for tamano, precios in zip(tamanos, resultados):
+                    inicio = turno * tamano * n_recursos
+                    muestras.extend(precios[inicio + i:inicio + tamano * n_recursos:n_recursos])
+                muestras.sort()
+                for p in percentiles:
+                    bandas[i][p].append(percentil(muestras, p))
+        return bandas
+
+    def cerrar(self):
+        with self.lock:
+            if self._pool is not None:
+                self._pool.shutdown(cancel_futures=True)
+                self._pool = None
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Los módulos del juego están en la raíz del repositorio
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Sin reloj periódico: los turnos solo corren cuando un test los pide
+os.environ.setdefault('KEYO_TURNO_SEGUNDOS', '0')
@@ -0,0 +1,44 @@
+import pytest
+
+from juego import SimuladorComercio
+
+
+def todas(simulador, capacidad, dinero):
+    """Todas las oportunidades con margen, calculadas una a una con dijkstra"""
+    mercado, grafo = simulador.mercado, simulador.grafo
+    e = mercado.estado
+    oportunidades = []
+    for recurso in mercado.por_indice:
+        for a, origen in enumerate(e.ubicaciones):
+            compra = recurso.precios_regionales[origen]
+            stock = recurso.stocks_regionales[origen]
+            cantidad = int(min(stock, capacidad // recurso.peso, dinero // compra)) if compra > 0 else 0
+            if cantidad <= 0:
+                continue
+            for b, destino in enumerate(e.ubicaciones):
+                venta = recurso.precios_regionales[destino] * 0.9
+                if b == a or venta <= compra:
+                    continue
+                _, costo, _ = grafo.dijkstra(origen, destino)
+                if costo is not None:
+                    oportunidades.append(((venta - compra) * cantidad - costo, recurso.nombre, origen, destino, cantidad))
+    return sorted(oportunidades, reverse=True)
+
+
+@pytest.mark.parametrize('semilla, capacidad, dinero', [(1, 50, 50000), (2, 10, 3000), (3, 500, 10 ** 7)])
+def test_el_escaneo_devuelve_las_k_mejores(semilla, capacidad, dinero):
+    simulador = SimuladorComercio.generar(9, 6, semilla=semilla)
+    referencia = todas(simulador, capacidad, dinero)
+    for k in (1, 5, len(referencia) + 10):
+        oportunidades = simulador.mercado.escanear_arbitraje(simulador.grafo, capacidad, dinero, k)
+        assert len(oportunidades) == min(k, len(referencia))
+        ganancias = [o['ganancia_neta'] for o in oportunidades]
+        assert ganancias == sorted(ganancias, reverse=True)
+        assert ganancias == pytest.approx([r[0] for r in referencia[:k]])
+        # Cada oportunidad es una de la referencia con esa ganancia
+        validas = {r[1:]: r[0] for r in referencia}
+        for o in oportunidades:
+            clave = (o['recurso'], o['comprar_en'], o['vender_en'], o['cantidad'])
+            assert validas[clave] == pytest.approx(o['ganancia_neta'])
+            assert o['ganancia_neta'] == pytest.approx(
+                (o['precio_venta'] - o['precio_compra']) * o['cantidad'] - o['costo_viaje'])
@@ -0,0 +1,235 @@
+import random
+import sys
+import threading
+
+import pytest
+
+from juego import Jugador, SimuladorComercio
+
+
+@pytest.fixture
+def mercado():
+    return SimuladorComercio.generar(5, 4, semilla=1).mercado
+
+
+@pytest.fixture
+def cambio_frecuente():
+    # Cambios de hilo muy frecuentes para que los comercios se entrelacen
+    previo = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(previo)
+
+
+@pytest.mark.parametrize('cantidad', [0, -3, 2.5, True, '2'])
+def test_cantidades_invalidas_no_mueven_nada(mercado, cantidad):
+    recurso = mercado.por_indice[0]
+    jugador = Jugador('prueba')
+    assert jugador.comprar_recurso(recurso, 1, mercado)
+    dinero, inventario, stock = jugador.dinero, dict(jugador.inventario), recurso.stock
+
+    assert not jugador.vender_recurso(recurso.nombre, cantidad, mercado)
+    assert not jugador.comprar_recurso(recurso, cantidad, mercado)
+    exito, _, _ = jugador.ejecutar_ordenes([('vender', recurso, cantidad)], mercado)
+    assert not exito
+    assert (jugador.dinero, jugador.inventario, recurso.stock) == (dinero, inventario, stock)
+
+
+def test_api_rechaza_cantidad_negativa():
+    from app import app, simulador
+    cliente = app.test_client()
+    recurso = simulador.mercado.por_indice[0].nombre
+    for ruta in ('/api/comprar', '/api/vender'):
+        respuesta = cliente.post(ruta, json={'recurso': recurso, 'cantidad': -5})
+        assert respuesta.status_code == 400
+        assert not respuesta.get_json()['exito']
+
+
+def test_el_patrimonio_cuenta_las_garantias_de_las_ordenes():
+    simulador = SimuladorComercio.generar(5, 4, semilla=1)
+    mercado = simulador.mercado
+    recurso = mercado.por_indice[0]
+    comprador = simulador.jugadores.obtener('comprador')
+    vendedor = simulador.jugadores.obtener('vendedor')
+    vendedor.jugador.inventario[recurso.nombre] = 4
+    vendedor.jugador.marcar_cambio()
+
+    def patrimonios():
+        primeros, _ = simulador.ranking.consultar(10)
+        return {entrada.sesion_id: round(entrada.patrimonio, 6) for _, entrada in primeros}
+
+    antes = patrimonios()
+    with comprador.lock:
+        mercado.ordenes.colocar(comprador, recurso, 0, 'compra', 100.0, 3)
+    with vendedor.lock:
+        mercado.ordenes.colocar(vendedor, recurso, 0, 'venta', 10 ** 6, 4)
+    # Retener la garantía no cambia el patrimonio
+    assert patrimonios() == antes
+    assert comprador.jugador.dinero_retenido == 300.0 and vendedor.jugador.retenido == {recurso.nombre: 4}
+
+    with vendedor.lock:
+        mercado.ordenes.cancelar_sesion(vendedor)
+    assert patrimonios() == antes and vendedor.jugador.retenido == {}
+
+    # Al casarse, la garantía se liquida: no queda nada retenido
+    with vendedor.lock:
+        mercado.ordenes.colocar(vendedor, recurso, 0, 'venta', 50.0, 3)
+    assert len(mercado.ordenes.casar()) == 1
+    assert comprador.jugador.dinero_retenido == 0 and vendedor.jugador.retenido == {}
+    assert comprador.jugador.inventario[recurso.nombre] == 3
+
+
+def test_compras_y_ventas_concurrentes_no_sobrevenden(mercado, cambio_frecuente):
+    recursos = mercado.por_indice[:2]
+    for recurso in recursos:
+        recurso.stock = 40
+    # Dinero para unas pocas compras: también se agota
+    jugadores = [Jugador(f'j{i}', dinero=recursos[0].precio_actual * 15, capacidad_max=10 ** 6) for i in range(6)]
+    compradas = [{r.nombre: 0 for r in recursos} for _ in jugadores]
+    vendidas = [{r.nombre: 0 for r in recursos} for _ in jugadores]
+    negativos = []
+
+    def comerciar(i):
+        rng = random.Random(i)
+        jugador = jugadores[i]
+        for _ in range(300):
+            recurso = rng.choice(recursos)
+            cantidad = rng.randint(1, 3)
+            accion = rng.random()
+            if accion < 0.5:
+                if jugador.comprar_recurso(recurso, cantidad, mercado):
+                    compradas[i][recurso.nombre] += cantidad
+            elif accion < 0.8:
+                if jugador.vender_recurso(recurso.nombre, cantidad, mercado):
+                    vendidas[i][recurso.nombre] += cantidad
+            else:
+                otro = recursos[0] if recurso is recursos[1] else recursos[1]
+                exito, _, _ = jugador.ejecutar_ordenes([('comprar', recurso, cantidad), ('vender', otro, 1)], mercado)
+                if exito:
+                    compradas[i][recurso.nombre] += cantidad
+                    vendidas[i][otro.nombre] += 1
+            if jugador.dinero < 0:
+                negativos.append(jugador.dinero)
+
+    def vigilar():
+        # Con los locks de los recursos el stock se ve siempre entero, y nunca negativo
+        while any(hilo.is_alive() for hilo in hilos):
+            with mercado.bloquear(recursos, publicar=False):
+                if any(r.stock < 0 for r in recursos):
+                    negativos.append([r.stock for r in recursos])
+
+    hilos = [threading.Thread(target=comerciar, args=(i,)) for i in range(len(jugadores))]
+    vigia = threading.Thread(target=vigilar)
+    for hilo in hilos:
+        hilo.start()
+    vigia.start()
+    for hilo in hilos:
+        hilo.join()
+    vigia.join()
+
+    assert not negativos
+    for recurso in recursos:
+        total = sum(c[recurso.nombre] for c in compradas)
+        assert total == 40 - recurso.stock and recurso.stock >= 0
+    for jugador, compras, ventas in zip(jugadores, compradas, vendidas):
+        assert jugador.dinero >= 0
+        for recurso in recursos:
+            assert jugador.inventario.get(recurso.nombre, 0) == compras[recurso.nombre] - ventas[recurso.nombre]
+        peso = sum(r.peso * jugador.inventario.get(r.nombre, 0) for r in recursos)
+        assert jugador.capacidad_usada == pytest.approx(peso)
+
+
+def test_api_compras_y_ventas_concurrentes_no_sobrevenden(cambio_frecuente):
+    from app import SESION_COOKIE, app, simulador
+    mercado = simulador.mercado
+    recurso = mercado.por_indice[0]
+    def fijar_stock(stock):
+        with mercado.bloquear([recurso]):
+            recurso.stock = stock
+            mercado.registrar_cambio(recurso)
+
+    # El mercado es el del servidor: se deja el stock como estaba
+    stock_previo = recurso.stock
+    fijar_stock(30)
+    clientes = [app.test_client() for _ in range(5)]
+    respuestas = [[] for _ in clientes]
+
+    def comerciar(i):
+        rng = random.Random(i)
+        cliente = clientes[i]
+        for _ in range(60):
+            ruta = '/api/comprar' if rng.random() < 0.6 else '/api/vender'
+            cantidad = rng.randint(1, 4)
+            respuesta = cliente.post(ruta, json={'recurso': recurso.nombre, 'cantidad': cantidad})
+            assert respuesta.status_code == 200
+            datos = respuesta.get_json()
+            # Las compras rechazadas antes de intentarlo no devuelven el dinero
+            assert datos.get('dinero', 0) >= 0
+            if datos['exito']:
+                respuestas[i].append(cantidad if ruta == '/api/comprar' else -cantidad)
+
+    # Una primera operación por cliente crea su sesión (y su cookie) antes de empezar
+    for cliente in clientes:
+        assert cliente.post('/api/vender', json={'recurso': recurso.nombre, 'cantidad': 1}).status_code == 200
+    hilos = [threading.Thread(target=comerciar, args=(i,)) for i in range(len(clientes))]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    for cliente, cambios in zip(clientes, respuestas):
+        jugador = simulador.jugadores.buscar(cliente.get_cookie(SESION_COOKIE).value).jugador
+        assert jugador.dinero >= 0
+        assert jugador.inventario.get(recurso.nombre, 0) == sum(cambios)
+    compradas = sum(c for cambios in respuestas for c in cambios if c > 0)
+    stock = recurso.stock
+    fijar_stock(stock_previo)
+    assert compradas > 0 and stock == 30 - compradas >= 0
+
+
+@pytest.mark.parametrize('cuerpo', [[1], {'ordenes': ['x']}, {'ordenes': {'tipo': 'comprar'}}, {'ordenes': [None]}, 'x'])
+def test_api_ordenes_con_formato_invalido_responde_400(cuerpo):
+    from app import app
+    respuesta = app.test_client().post('/api/ordenes', json=cuerpo)
+    assert respuesta.status_code == 400
+    assert not respuesta.get_json()['exito']
+
+
+def test_api_cesta_todo_o_nada():
+    from app import app, simulador
+    cliente = app.test_client()
+    compra, venta = simulador.mercado.por_indice[:2]
+    assert cliente.post('/api/comprar', json={'recurso': compra.nombre, 'cantidad': 1}).get_json()['exito']
+    jugador = cliente.get('/api/jugador').get_json()
+    stocks = (compra.stock, venta.stock)
+
+    # La compra sola saldría bien, pero la venta de algo que no se tiene tumba la cesta entera
+    respuesta = cliente.post('/api/ordenes', json={'ordenes': [
+        {'tipo': 'comprar', 'recurso': compra.nombre, 'cantidad': 1},
+        {'tipo': 'vender', 'recurso': venta.nombre, 'cantidad': 1},
+    ]})
+    assert respuesta.status_code == 200 and not respuesta.get_json()['exito']
+    despues = cliente.get('/api/jugador').get_json()
+    assert (despues['dinero'], despues['inventario']) == (jugador['dinero'], jugador['inventario'])
+    assert (compra.stock, venta.stock) == stocks
+
+    respuesta = cliente.post('/api/ordenes', json={'ordenes': [
+        {'tipo': 'comprar', 'recurso': venta.nombre, 'cantidad': 1},
+        {'tipo': 'vender', 'recurso': compra.nombre, 'cantidad': 1},
+    ]})
+    assert respuesta.get_json()['exito']
+    assert respuesta.get_json()['inventario'] == {venta.nombre: 1}
+    assert (compra.stock, venta.stock) == (stocks[0], stocks[1] - 1)
+
+
+def test_api_estadisticas_sin_recursos(monkeypatch):
+    import app as servidor
+    from juego import GrafoCiudades, Mercado
+    monkeypatch.setattr(servidor, 'simulador', SimuladorComercio(Mercado(['A', 'B']), GrafoCiudades()))
+    cliente = servidor.app.test_client()
+    for ruta in ('/api/estadisticas', '/api/estadisticas?ubicacion=A'):
+        respuesta = cliente.get(ruta)
+        assert respuesta.status_code == 200
+        datos = respuesta.get_json()
+        assert datos['precio_promedio'] == 0 and datos['recursos_mas_valiosos'] == datos['recursos_mayor_demanda'] == []
+    assert datos['stock_total'] == 0
@@ -0,0 +1,77 @@
+import uuid
+from multiprocessing import resource_tracker, shared_memory
+
+import pytest
+
+from compartido import MemoriaMercado, fcntl
+from juego import Jugador, SimuladorComercio
+
+pytestmark = pytest.mark.skipif(fcntl is None, reason="flock solo en POSIX")
+
+
+def existe(nombre):
+    try:
+        bloque = shared_memory.SharedMemory(nombre)
+    except FileNotFoundError:
+        return False
+    # Solo se mira: que el resource tracker no lo borre al terminar
+    resource_tracker.unregister(bloque._name, 'shared_memory')
+    bloque.close()
+    return True
+
+
+def test_el_bloque_vive_hasta_el_ultimo_y_la_propiedad_pasa_a_otro():
+    # Cada MemoriaMercado abre sus propios ficheros: dos en un proceso se
+    # comportan ante los flock como dos procesos
+    nombre = f'keyo_prueba_{uuid.uuid4().hex[:8]}'
+    primera = MemoriaMercado(nombre, SimuladorComercio.generar(3, 2, semilla=1))
+    segunda = MemoriaMercado(nombre, SimuladorComercio.generar(3, 2, semilla=1))
+    assert primera.propietario and not segunda.reclamar()
+
+    primera.cerrar()
+    assert existe(nombre)
+    assert segunda.reclamar()
+
+    segunda.cerrar()
+    assert not existe(nombre)
+
+
+def test_la_epoca_es_del_bloque():
+    nombre = f'keyo_prueba_{uuid.uuid4().hex[:8]}'
+    primera = MemoriaMercado(nombre, SimuladorComercio.generar(3, 2, semilla=1))
+    segunda = MemoriaMercado(nombre, SimuladorComercio.generar(3, 2, semilla=1))
+    assert primera.epoca == segunda.epoca
+    primera.cerrar()
+    segunda.cerrar()
+
+    # Un bloque nuevo empieza otra vez las versiones, con otra época
+    nueva = MemoriaMercado(nombre, SimuladorComercio.generar(3, 2, semilla=1))
+    assert nueva.epoca != primera.epoca
+    nueva.cerrar()
+
+
+def test_el_historial_de_otro_proceso_sigue_los_turnos_y_comercios_del_bloque():
+    nombre = f'keyo_prueba_{uuid.uuid4().hex[:8]}'
+    propietario = SimuladorComercio.generar(3, 2, semilla=1, historial=True)
+    otro = SimuladorComercio.generar(3, 2, semilla=1, historial=True)
+    primera = MemoriaMercado(nombre, propietario)
+    segunda = MemoriaMercado(nombre, otro)
+    try:
+        recurso = propietario.mercado.por_indice[0]
+        jugador = Jugador('prueba', dinero=10 ** 9, capacidad_max=10 ** 6)
+        for semilla in range(6):
+            with primera.escritura(regional=True):
+                propietario.mercado.simular_mercado(semilla=semilla)
+                propietario.turno += 1
+            assert segunda.leer()
+            with primera.escritura():
+                assert jugador.comprar_recurso(recurso, 5, propietario.mercado)
+            # Lee cada publicación: ve las mismas velas que el propietario
+            assert segunda.leer()
+
+        assert otro.mercado.historial.turno == propietario.mercado.historial.turno == 6
+        assert otro.mercado.historial.consultar(0, turnos=6, puntos=6) == \
+            propietario.mercado.historial.consultar(0, turnos=6, puntos=6)
+    finally:
+        primera.cerrar()
+        segunda.cerrar()
@@ -0,0 +1,44 @@
+import threading
+
+import pytest
+
+from juego import Jugador, SimuladorComercio
+
+
+def test_difusion_se_calcula_sin_locks_de_recursos_y_sin_escrituras_regionales():
+    simulador = SimuladorComercio.generar(12, 5, semilla=3)
+    mercado = simulador.mercado
+    e = mercado.estado
+    recurso = mercado.por_indice[2]
+    ubicacion = e.ubicaciones[1]
+    celda = recurso.indice * e.n_regiones + 1
+    jugador = Jugador('prueba', dinero=10 ** 9, capacidad_max=10 ** 6)
+    calcular = mercado.difusion.calcular
+    resultado = {}
+
+    def casar():
+        # Un casamiento fija la cotización regional
+        with mercado.bloquear([recurso], regional=True):
+            recurso.precios_regionales[ubicacion] = 12345.0
+            mercado.registrar_cambio(recurso)
+
+    def calcular_con_operaciones(foto, n_turnos=1):
+        # Los comercios no esperan a la difusión...
+        resultado['comercio'] = jugador.comprar_recurso(recurso, 1, mercado)
+        # ...pero las escrituras regionales sí, hasta que el turno termina
+        hilo = threading.Thread(target=casar)
+        hilo.start()
+        hilo.join(0.2)
+        resultado['esperando'] = hilo.is_alive()
+        resultado['hilo'] = hilo
+        return calcular(foto, n_turnos)
+
+    mercado.difusion.calcular = calcular_con_operaciones
+    mercado.simular_mercado(semilla=1)
+    resultado['hilo'].join()
+
+    assert resultado['comercio'] and resultado['esperando']
+    assert e.precios_regionales[celda] == 12345.0
+    assert mercado.foto.precios_regionales[celda] == 12345.0
+    n = e.n_regiones
+    assert e.estadisticas.suma_precio_regional[1] == pytest.approx(sum(e.precios_regionales[1::n]))
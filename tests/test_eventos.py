@@ -0,0 +1,81 @@
+import json
+
+from juego import CanalEventos, Jugador, SimuladorComercio
+
+
+def leer(suscriptor):
+    """(tipo, datos) de los mensajes SSE en la cola de un suscriptor"""
+    mensajes = []
+    while not suscriptor.cola.empty():
+        evento, datos, vacia, fin = suscriptor.cola.get_nowait().split('\n')
+        assert evento.startswith('event: ') and datos.startswith('data: ') and vacia == fin == ''
+        mensajes.append((evento[len('event: '):], json.loads(datos[len('data: '):])))
+    return mensajes
+
+
+def test_los_datos_del_jugador_solo_llegan_a_su_sesion():
+    canal = CanalEventos()
+    propio, ajeno, anonimo = canal.suscribir('a'), canal.suscribir('b'), canal.suscribir()
+    canal.publicar('comercio', {'version': 3}, 'a', {'dinero': 10})
+    assert leer(propio) == [('comercio', {'version': 3, 'jugador': {'dinero': 10}})]
+    assert leer(ajeno) == leer(anonimo) == [('comercio', {'version': 3})]
+
+
+def test_un_suscriptor_lento_se_descarta_sin_frenar_a_los_demas():
+    canal = CanalEventos(max_eventos=2)
+    lento, rapido = canal.suscribir('lento'), canal.suscribir('rapido')
+    for version in range(5):
+        canal.publicar('turno', {'version': version})
+        if version % 2:
+            leer(rapido)
+    assert lento.descartado and lento not in canal.suscriptores
+    assert not rapido.descartado and rapido in canal.suscriptores
+    # Lo que ya tenía en la cola sigue ahí; lo posterior no le llega
+    assert [datos['version'] for _, datos in leer(lento)] == [0, 1]
+    assert [datos['version'] for _, datos in leer(rapido)] == [4]
+
+
+def test_los_deltas_son_los_campos_que_cambiaron():
+    mercado = SimuladorComercio.generar(5, 4, semilla=2).mercado
+    recurso = mercado.por_indice[1]
+    previa = mercado.instantanea()
+    assert mercado.cambios_desde(previa) == {'recursos': [], 'regiones': []}
+
+    assert Jugador('prueba', dinero=10 ** 9).comprar_recurso(recurso, 2, mercado)
+    cambios = mercado.cambios_desde(previa)
+    assert cambios['regiones'] == []
+    assert cambios['recursos'] == [mercado.delta_recurso(recurso)]
+    assert cambios['recursos'][0]['stock'] == previa[3][recurso.indice] - 2
+
+    previa = mercado.instantanea()
+    mercado.simular_mercado(semilla=1)
+    cambios = mercado.cambios_desde(previa)
+    e = mercado.estado
+    celdas = {(r['nombre'], r['ubicacion']): (r['precio'], r['stock']) for r in cambios['regiones']}
+    for celda in range(len(e.precios_regionales)):
+        clave = (mercado.por_indice[celda // e.n_regiones].nombre, e.ubicaciones[celda % e.n_regiones])
+        cambio = (previa[4][celda], previa[5][celda]) != (e.precios_regionales[celda], e.stocks_regionales[celda])
+        assert (clave in celdas) == cambio
+        if cambio:
+            assert celdas[clave] == (e.precios_regionales[celda], e.stocks_regionales[celda])
+
+
+def test_api_una_compra_publica_su_delta():
+    from app import SESION_COOKIE, app, simulador
+    cliente = app.test_client()
+    recurso = simulador.mercado.por_indice[2]
+    assert cliente.post('/api/comprar', json={'recurso': recurso.nombre, 'cantidad': 1}).get_json()['exito']
+    sesion_id = cliente.get_cookie(SESION_COOKIE).value
+    propio, ajeno = simulador.eventos.suscribir(sesion_id), simulador.eventos.suscribir('otra')
+    try:
+        datos = cliente.post('/api/comprar', json={'recurso': recurso.nombre, 'cantidad': 2}).get_json()
+        assert datos['exito']
+        [(tipo, evento)] = leer(propio)
+        assert tipo == 'comercio' and evento['version'] == simulador.mercado.version
+        assert evento['recursos'] == [simulador.mercado.delta_recurso(recurso)]
+        assert evento['jugador'] == {'dinero': datos['dinero'], 'capacidad_usada': datos['capacidad_usada'],
+                                     'inventario': {recurso.nombre: 3}}
+        assert leer(ajeno) == [('comercio', {k: v for k, v in evento.items() if k != 'jugador'})]
+    finally:
+        simulador.eventos.desuscribir(propio)
+        simulador.eventos.desuscribir(ajeno)
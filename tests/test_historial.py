@@ -0,0 +1,63 @@
+import random
+
+import pytest
+
+from juego import HistorialPrecios, Jugador, SimuladorComercio
+
+
+def referencia(observaciones, inicial, tamano, vela):
+    """Vela calculada a mano: abre al cierre anterior y agrega todo lo observado en su tramo"""
+    previas = [precio for turno, precio in observaciones if turno < vela * tamano]
+    apertura = previas[-1] if previas else inicial
+    propias = [precio for turno, precio in observaciones if vela * tamano <= turno < (vela + 1) * tamano]
+    valores = [apertura] + propias
+    return apertura, max(valores), min(valores), valores[-1]
+
+
+@pytest.mark.parametrize('regional', [False, True])
+def test_velas_agregadas_coinciden_con_las_observaciones(regional):
+    simulador = SimuladorComercio.generar(4, 3, semilla=2, historial=True)
+    mercado = simulador.mercado
+    if regional:
+        mercado.historial.activar_regional()
+    recurso = mercado.por_indice[0]
+    jugador = Jugador('prueba', dinero=10 ** 9, capacidad_max=10 ** 6)
+    rng = random.Random(5)
+
+    columna = 1
+    leer = (lambda: recurso.precio_actual) if not regional else (
+        lambda: mercado.estado.precios_regionales[recurso.indice * mercado.estado.n_regiones + columna])
+    inicial = leer()
+    observaciones = []
+    for _ in range(150):
+        for _ in range(rng.randrange(3)):
+            jugador.comprar_recurso(recurso, 1, mercado)
+            if not regional:
+                observaciones.append((mercado.historial.turno, leer()))
+        mercado.simular_mercado(semilla=rng.getrandbits(32))
+        observaciones.append((mercado.historial.turno, leer()))
+
+    for turnos, puntos in ((10, 50), (150, 50), (150, 10), (150, 3)):
+        velas = mercado.historial.consultar(recurso.indice, columna if regional else None, turnos, puntos)
+        tamano = velas[1]['turno'] - velas[0]['turno'] if len(velas) > 1 else 1
+        assert len(velas) <= puntos
+        for vela in velas:
+            esperado = referencia(observaciones, inicial, tamano, vela['turno'] // tamano)
+            obtenido = (vela['apertura'], vela['maximo'], vela['minimo'], vela['cierre'])
+            assert obtenido == pytest.approx(esperado)
+        if not regional:
+            assert velas[-1]['demanda'] == recurso.demanda
+
+
+def test_memoria_acotada_y_regional_opcional():
+    simulador = SimuladorComercio.generar(50, 100, semilla=1, historial=True)
+    historial = simulador.mercado.historial
+    por_serie = HistorialPrecios.NIVELES * HistorialPrecios.CAPACIDAD * 6 * 8
+    # Una serie por recurso, no por recurso y región
+    assert historial.memoria() == 100 * por_serie
+    assert historial.consultar(0, 3) is None
+    historial.activar_regional()
+    regional = HistorialPrecios.NIVELES_REGIONAL * HistorialPrecios.CAPACIDAD_REGIONAL * 4 * 8
+    assert historial.memoria() == 100 * por_serie + 100 * 50 * regional
+    simulador.mercado.simular_mercado()
+    assert historial.consultar(0, 3)[-1]['turno'] == 1
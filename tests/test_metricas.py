@@ -0,0 +1,17 @@
+import pytest
+
+from metricas import percentil
+
+
+@pytest.mark.parametrize('n, p, rango', [
+    (100, 5, 5), (100, 25, 25), (100, 50, 50), (100, 75, 75), (100, 95, 95), (100, 99, 99), (100, 100, 100),
+    (20, 5, 1), (20, 50, 10), (20, 95, 19), (20, 96, 20),
+    (10, 7, 1), (10, 0, 1), (3, 50, 2), (1, 99, 1),
+])
+def test_percentil_por_rango_mas_cercano(n, p, rango):
+    # El valor i-ésimo es su propio rango
+    assert percentil(list(range(1, n + 1)), p) == rango
+
+
+def test_percentil_de_lista_vacia():
+    assert percentil([], 95) == 0.0
@@ -0,0 +1,59 @@
+import itertools
+
+from juego import Jugador, SimuladorComercio
+
+
+def optimo(items, capacidad, dinero):
+    """Valor óptimo por fuerza bruta (solo para instancias pequeñas)"""
+    mejor = 0
+    for cantidades in itertools.product(*(range(item[4] + 1) for item in items)):
+        peso = sum(c * item[1] for c, item in zip(cantidades, items))
+        costo = sum(c * item[3] for c, item in zip(cantidades, items))
+        if peso <= capacidad and costo <= dinero:
+            mejor = max(mejor, sum(c * item[2] for c, item in zip(cantidades, items)))
+    return mejor
+
+
+def valor(items, cantidades):
+    return sum(c * item[2] for c, item in zip(cantidades, items))
+
+
+def test_aproximada_cuando_se_agota_el_presupuesto():
+    optimizador = SimuladorComercio.generar(3, 1, semilla=0).mercado.optimizador
+    # La voraz toma A (mejor valor/peso) y no le cabe B; lo óptimo son dos B
+    items = [('A', 6, 30, 1.0, 1), ('B', 5, 20, 1.0, 2)]
+    cantidades, exacta = optimizador._ramificacion_y_poda(items, 10, 100)
+    assert exacta and valor(items, cantidades) == optimo(items, 10, 100) == 40
+
+    optimizador.MAX_NODOS = 1
+    cantidades, exacta = optimizador._ramificacion_y_poda(items, 10, 100)
+    assert not exacta and valor(items, cantidades) == 30
+
+
+def test_exacta_coincide_con_fuerza_bruta():
+    mercado = SimuladorComercio.generar(3, 6, semilla=4).mercado
+    jugador = Jugador('prueba', dinero=3000, capacidad_max=12)
+    recomendaciones, exacta = jugador.optimizar_inventario_mochila(mercado)
+    assert exacta
+    items = []
+    for r in mercado.por_indice:
+        peso = max(int(r.peso), 1)
+        items.append((r, peso, int(r.precio_actual), r.precio_actual,
+                      min(r.stock, 12 // peso, int(3000 // r.precio_actual))))
+    obtenido = sum(int(r.precio_actual) * c for r, c in recomendaciones)
+    assert obtenido == optimo(items, 12, 3000)
+
+
+def test_cache_acotada_y_sin_retroceder_de_version():
+    mercado = SimuladorComercio.generar(4, 2, semilla=1).mercado
+    optimizador = mercado.optimizador
+    optimizador.MAX_RESULTADOS = 2
+    for dinero in (1000, 2000, 3000):
+        optimizador.optimizar(20, dinero)
+    assert [clave[2] for clave in optimizador.cache] == [2000, 3000]
+
+    # Un resultado calculado con una versión anterior no desplaza los de la actual
+    version = mercado.version
+    optimizador.cache = {(version + 1, 20, 1000, None): ([], True)}
+    optimizador.optimizar(20, 5000)
+    assert list(optimizador.cache) == [(version + 1, 20, 1000, None)]
@@ -0,0 +1,92 @@
+import random
+
+import pytest
+
+from juego import LibroOrdenes, Orden, SimuladorComercio
+
+
+def libro_con(*ordenes):
+    """Libro con órdenes (lado, precio, cantidad) en este orden de llegada"""
+    libro = LibroOrdenes()
+    for secuencia, (lado, precio, cantidad) in enumerate(ordenes, 1):
+        libro.agregar(Orden(secuencia, None, lado, None, 0, precio, cantidad, secuencia))
+    return libro
+
+
+def resumen(ejecuciones):
+    return [(compra.id, venta.id, precio, cantidad) for compra, venta, precio, cantidad in ejecuciones]
+
+
+def test_prioridad_precio_tiempo_en_las_ventas():
+    libro = libro_con(('venta', 10.0, 2), ('venta', 9.0, 2), ('venta', 9.0, 2), ('compra', 12.0, 5))
+    # Primero el mejor precio; a igual precio, la más antigua. Cada cruce al precio de la más antigua
+    assert resumen(libro.casar()) == [(4, 2, 9.0, 2), (4, 3, 9.0, 2), (4, 1, 10.0, 1)]
+    # La venta a 10 queda a medias, con su prioridad
+    assert list(libro.activas) == [1] and libro.activas[1].cantidad == 1
+    assert libro.profundidad() == {'compras': [], 'ventas': [(10.0, 1)]}
+
+
+def test_prioridad_precio_tiempo_en_las_compras():
+    libro = libro_con(('compra', 10.0, 1), ('compra', 11.0, 1), ('compra', 11.0, 1), ('venta', 9.0, 3))
+    assert resumen(libro.casar()) == [(2, 4, 11.0, 1), (3, 4, 11.0, 1), (1, 4, 10.0, 1)]
+    assert not libro.activas
+
+
+def test_sin_solape_no_se_casa_y_las_canceladas_se_saltan():
+    libro = libro_con(('compra', 9.0, 1), ('venta', 10.0, 1))
+    assert libro.casar() == []
+    libro = libro_con(('venta', 8.0, 1), ('venta', 9.0, 1), ('compra', 10.0, 1))
+    assert libro.cancelar(1).id == 1
+    # La cancelada sigue en el heap, pero no cuenta
+    assert resumen(libro.casar()) == [(3, 2, 9.0, 1)]
+
+
+def test_casar_deja_el_libro_sin_cruces_y_conserva_las_cantidades():
+    rng = random.Random(1)
+    for _ in range(50):
+        ordenes = [(rng.choice(('compra', 'venta')), float(rng.randint(5, 15)), rng.randint(1, 5)) for _ in range(30)]
+        libro = libro_con(*ordenes)
+        for orden_id in rng.sample(range(1, 31), 5):
+            libro.cancelar(orden_id)
+        vivas = {i: cantidad for i, (_, _, cantidad) in enumerate(ordenes, 1) if i in libro.activas}
+        ejecutado = {}
+        for compra, venta, precio, cantidad in libro.casar():
+            assert venta.precio <= precio <= compra.precio and cantidad > 0
+            for orden in (compra, venta):
+                ejecutado[orden.id] = ejecutado.get(orden.id, 0) + cantidad
+        for orden_id, cantidad in vivas.items():
+            restante = libro.activas[orden_id].cantidad if orden_id in libro.activas else 0
+            assert restante + ejecutado.get(orden_id, 0) == cantidad
+        compras = [o.precio for o in libro.activas.values() if o.lado == 'compra']
+        ventas = [o.precio for o in libro.activas.values() if o.lado == 'venta']
+        assert not compras or not ventas or max(compras) < min(ventas)
+
+
+def test_un_casamiento_parcial_liquida_lo_ejecutado_y_retiene_el_resto():
+    simulador = SimuladorComercio.generar(4, 2, semilla=3)
+    mercado = simulador.mercado
+    recurso = mercado.por_indice[0]
+    comprador = simulador.jugadores.obtener('comprador')
+    vendedor = simulador.jugadores.obtener('vendedor')
+    vendedor.jugador.inventario[recurso.nombre] = 2
+    with vendedor.lock:
+        mercado.ordenes.colocar(vendedor, recurso, 1, 'venta', 80.0, 2)
+    with comprador.lock:
+        _, _, compra = mercado.ordenes.colocar(comprador, recurso, 1, 'compra', 100.0, 5)
+
+    [(_, _, precio, cantidad)] = mercado.ordenes.casar()
+    assert (precio, cantidad) == (80.0, 2)
+    jugador = comprador.jugador
+    # Paga 80 por las dos ejecutadas; las otras tres siguen retenidas a 100
+    assert jugador.inventario == {recurso.nombre: 2}
+    assert jugador.dinero_retenido == pytest.approx(300.0)
+    assert jugador.dinero == pytest.approx(50000 - 160 - 300)
+    assert jugador.capacidad_usada == recurso.peso * 5
+    assert vendedor.jugador.dinero == pytest.approx(50000 + 160 * 0.9) and vendedor.jugador.retenido == {}
+    assert compra.cantidad == 3 and compra.id in mercado.ordenes.ordenes
+    assert recurso.precios_regionales[mercado.estado.ubicaciones[1]] == 80.0
+
+    with comprador.lock:
+        assert mercado.ordenes.cancelar(comprador, compra.id)
+    assert jugador.dinero_retenido == 0 and jugador.dinero == pytest.approx(50000 - 160)
+    assert jugador.capacidad_usada == recurso.peso * 2
@@ -0,0 +1,122 @@
+import random
+import sys
+import threading
+
+import pytest
+
+from juego import SimuladorComercio
+from persistencia import Persistencia
+
+
+@pytest.fixture
+def cambio_frecuente():
+    # Cambios de hilo muy frecuentes para que comercios y turnos se entrelacen
+    previo = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(previo)
+
+
+def estado(simulador):
+    e = simulador.mercado.estado
+    jugadores = {
+        sesion_id: (sesion.jugador.dinero, sesion.jugador.capacidad_usada, sesion.jugador.inventario)
+        for sesion_id, sesion in simulador.jugadores.sesiones.items()
+    }
+    ordenes = sorted((o.id, o.cantidad) for o in simulador.mercado.ordenes.ordenes.values())
+    return (simulador.turno, list(e.precio_actual), list(e.demanda), list(e.oferta), list(e.stock),
+            list(e.precios_regionales), list(e.stocks_regionales), jugadores, ordenes)
+
+
+def test_restaurar_tras_comercios_ordenes_y_turnos_concurrentes(tmp_path, cambio_frecuente):
+    persistencia = Persistencia(str(tmp_path))
+    simulador = SimuladorComercio.generar(6, 3, semilla=4)
+    persistencia.guardar(simulador)
+    mercado = simulador.mercado
+    mercado.diario = persistencia
+    sesiones = [simulador.jugadores.obtener(f'jugador-{i}') for i in range(4)]
+    columna = 0
+    precio = mercado.estado.precios_regionales[columna]
+
+    def comerciar(semilla):
+        rng = random.Random(semilla)
+        for _ in range(150):
+            sesion = rng.choice(sesiones)
+            recurso = rng.choice(mercado.por_indice)
+            with sesion.lock:
+                registrar = lambda: persistencia.registrar_comercio(sesion, [recurso])
+                if rng.random() < 0.5:
+                    sesion.jugador.comprar_recurso(recurso, 1, mercado, al_confirmar=registrar)
+                else:
+                    sesion.jugador.vender_recurso(recurso.nombre, 1, mercado, al_confirmar=registrar)
+
+    def ordenar(semilla):
+        rng = random.Random(semilla)
+        recurso = mercado.por_indice[0]
+        for _ in range(100):
+            sesion = rng.choice(sesiones)
+            with sesion.lock:
+                lado = rng.choice(('compra', 'venta'))
+                _, _, orden = mercado.ordenes.colocar(sesion, recurso, columna, lado, precio * rng.uniform(0.8, 1.2), 1)
+                if orden is not None and rng.random() < 0.3:
+                    mercado.ordenes.cancelar(sesion, orden.id)
+
+    def turnos():
+        for _ in range(40):
+            mercado.simular_mercado()
+            simulador.turno += 1
+            mercado.ordenes.casar()
+
+    hilos = [threading.Thread(target=comerciar, args=(1,)), threading.Thread(target=comerciar, args=(2,)),
+             threading.Thread(target=ordenar, args=(3,)), threading.Thread(target=turnos)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    restaurado = Persistencia(str(tmp_path)).restaurar()
+    assert estado(restaurado) == estado(simulador)
+
+
+def test_restaurar_con_un_comercio_justo_tras_registrar_el_turno(tmp_path, monkeypatch):
+    persistencia = Persistencia(str(tmp_path))
+    simulador = SimuladorComercio.generar(8, 4, semilla=6)
+    persistencia.guardar(simulador)
+    mercado = simulador.mercado
+    sesion = simulador.jugadores.obtener('jugador')
+    recurso = mercado.por_indice[1]
+    comercios = []
+
+    def comerciar():
+        with sesion.lock:
+            for _ in range(5):
+                assert sesion.jugador.comprar_recurso(
+                    recurso, 1, mercado, al_confirmar=lambda: persistencia.registrar_comercio(sesion, [recurso]))
+
+    class Diario:
+        """Al registrar el turno (con sus locks) lanza un comercio, que espera a que se suelten"""
+        def __getattr__(self, nombre):
+            return getattr(persistencia, nombre)
+
+        def registrar_turno(self, semilla, n_turnos):
+            persistencia.registrar_turno(semilla, n_turnos)
+            hilo = threading.Thread(target=comerciar)
+            hilo.start()
+            comercios.append(hilo)
+
+    # Cualquier lectura de la foto tras soltar los locks ve ya el comercio
+    foto = type(mercado).foto
+    def foto_tras_comercio(self):
+        for hilo in comercios:
+            hilo.join()
+        return foto.fget(self)
+    monkeypatch.setattr(type(mercado), 'foto', property(foto_tras_comercio))
+
+    mercado.diario = Diario()
+    mercado.simular_mercado()
+    simulador.turno += 1
+    for hilo in comercios:
+        hilo.join()
+
+    restaurado = Persistencia(str(tmp_path)).restaurar()
+    assert estado(restaurado) == estado(simulador)
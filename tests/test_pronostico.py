@@ -0,0 +1,47 @@
+import random
+from array import array
+
+import pronostico
+from juego import EstadoMercado, SimuladorComercio
+from pronostico import Pronosticador
+
+
+def test_bandas_por_rango_mas_cercano(monkeypatch):
+    simulador = SimuladorComercio.generar(6, 3, semilla=2)
+    n_recursos = len(simulador.mercado.foto.precio_actual)
+
+    def lote(columnas, n_turnos, n_trayectorias, semilla):
+        # Trayectoria t vale t + 1 en todos los recursos y turnos; dos lotes de 50 dan 1..100
+        desplazamiento = 0 if semilla == primera else 50
+        return array('d', [
+            desplazamiento + t + 1.0
+            for _ in range(n_turnos) for t in range(n_trayectorias) for _ in range(n_recursos)
+        ])
+
+    primera = random.Random(0).getrandbits(64)
+    monkeypatch.setattr(pronostico, 'TRAYECTORIAS_POR_LOTE', 50)
+    monkeypatch.setattr(pronostico, '_simular_lote', lote)
+    bandas = Pronosticador(procesos=0).pronosticar(simulador.mercado, n_turnos=2, n_trayectorias=100, semilla=0)
+
+    assert len(bandas) == n_recursos
+    for banda in bandas:
+        assert banda == {5: [5.0] * 2, 25: [25.0] * 2, 50: [50.0] * 2, 75: [75.0] * 2, 95: [95.0] * 2}
+
+
+def test_lote_sin_estadisticas_avanza_igual():
+    columnas = ((100.0, 50.0, 20.0), (110.0, 45.0, 25.0), (60, 40, 80), (50, 70, 20))
+    precios = pronostico._simular_lote(columnas, 3, 4, semilla=9)
+
+    estado = EstadoMercado()
+    for nombre, tipo, valores in zip(('precio_base', 'precio_actual', 'demanda', 'oferta'), 'ddll', columnas):
+        setattr(estado, nombre, array(tipo, valores) * 4)
+    estado.stock = array('l', [0]) * 12
+    estado.estadisticas.reconstruir_global()
+    rng = random.Random(9)
+    esperado = array('d')
+    for _ in range(3):
+        estado.avanzar(1, rng)
+        esperado.extend(estado.precio_actual)
+
+    assert precios == esperado
+    assert estado.estadisticas.suma_precio == sum(estado.precio_actual)
@@ -0,0 +1,103 @@
+import random
+
+import pytest
+
+from juego import SimuladorComercio
+
+
+def test_ruta_y_matriz_coinciden_con_dijkstra():
+    grafo = SimuladorComercio.generar(60, 1, densidad=1.5, semilla=3).grafo
+    ciudades = sorted(grafo.ciudades)
+    rng = random.Random(0)
+    for _ in range(40):
+        inicio, fin = rng.choice(ciudades), rng.choice(ciudades)
+        distancia, costo, camino = grafo.ruta(inicio, fin)
+        referencia = grafo.dijkstra(inicio, fin)
+        assert (distancia, costo) == referencia[:2]
+        assert camino[0] == inicio and camino[-1] == fin
+
+    muestra = ciudades[:12] + ['Ciudad fantasma']
+    matriz = grafo.matriz_costos(muestra)
+    for i, origen in enumerate(muestra):
+        for j, destino in enumerate(muestra):
+            esperado = grafo.dijkstra(origen, destino)[1]
+            assert matriz[i][j] == (float('inf') if esperado is None else esperado)
+
+
+def test_cache_de_matrices_acotada():
+    grafo = SimuladorComercio.generar(20, 1, semilla=1).grafo
+    ciudades = sorted(grafo.ciudades)
+    for k in range(2, 12):
+        grafo.matriz_costos(ciudades[:k])
+    assert len(grafo.matrices_costos) <= grafo.MAX_MATRICES
+
+
+def test_las_rutas_se_cachean_con_limite_y_se_invalidan_al_cambiar_el_mapa():
+    grafo = SimuladorComercio.generar(30, 1, semilla=5).grafo
+    grafo.MAX_PARES = 3
+    ciudades = sorted(grafo.ciudades)
+    csr = grafo.csr
+    calculos = []
+    a_estrella = csr.a_estrella
+    csr.a_estrella = lambda inicio, fin: calculos.append((inicio, fin)) or a_estrella(inicio, fin)
+
+    primera = grafo.ruta(ciudades[0], ciudades[1])
+    assert grafo.ruta(ciudades[0], ciudades[1]) is primera
+    assert len(calculos) == 1
+    for destino in ciudades[2:5]:
+        grafo.ruta(ciudades[0], destino)
+    assert len(grafo.rutas_pares) == 3 and (ciudades[0], ciudades[1]) not in grafo.rutas_pares
+
+    grafo.dijkstra(ciudades[0], ciudades[1])
+    assert ciudades[0] in grafo.rutas
+    grafo.agregar_ruta(ciudades[0], ciudades[1], 1, 1)
+    assert not grafo.rutas and not grafo.rutas_pares
+    assert grafo.ruta(ciudades[0], ciudades[1])[1] == 1
+
+
+def fuerza_bruta(planificador, origen, capacidad, dinero, max_paradas):
+    """Mejor dinero final recorriendo todos los caminos simples desde el origen"""
+    e = planificador.mercado.estado
+    costos = planificador.grafo.matriz_costos(e.ubicaciones)
+    tramos = planificador._tramos(capacidad)
+
+    def explorar(a, visitadas, dinero_actual, paradas):
+        mejor = dinero_actual
+        if paradas == max_paradas:
+            return mejor
+        for b in range(e.n_regiones):
+            if b in visitadas or costos[a][b] == float('inf'):
+                continue
+            ganancia, _, _ = planificador._mejor_carga(tramos[a][b], dinero_actual)
+            dinero_nuevo = dinero_actual + ganancia - costos[a][b]
+            if dinero_nuevo >= 0:
+                mejor = max(mejor, explorar(b, visitadas | {b}, dinero_nuevo, paradas + 1))
+        return mejor
+
+    inicio = e.id_ubicacion[origen]
+    return explorar(inicio, {inicio}, dinero, 0)
+
+
+def test_el_planificador_coincide_con_la_fuerza_bruta_en_mapas_pequenos():
+    for semilla in range(4):
+        simulador = SimuladorComercio.generar(7, 6, semilla=semilla)
+        planificador = simulador.planificador
+        for origen in simulador.mercado.estado.ubicaciones[:3]:
+            for capacidad, dinero, max_paradas in ((50, 50000, 3), (20, 5000, 4), (200, 10 ** 6, 6)):
+                plan = planificador.planificar(origen, capacidad, dinero, max_paradas, tiempo_ms=10 ** 4)
+                assert plan['exacto']
+                assert plan['dinero_final'] == pytest.approx(
+                    fuerza_bruta(planificador, origen, capacidad, dinero, max_paradas))
+                # El itinerario devuelto da ese dinero
+                assert plan['ciudades'][0] == origen and len(plan['tramos']) <= max_paradas
+                assert dinero + sum(t['ganancia_neta'] for t in plan['tramos']) == pytest.approx(plan['dinero_final'])
+
+
+@pytest.mark.parametrize('cuerpo', [{'max_paradas': 'muchas'}, {'tiempo_ms': [1]}, {'max_paradas': None}, [1]])
+def test_api_planificar_ruta_con_parametros_invalidos_responde_400(cuerpo):
+    from app import app, simulador
+    if isinstance(cuerpo, dict):
+        cuerpo = dict(cuerpo, origen=simulador.mercado.estado.ubicaciones[0])
+    respuesta = app.test_client().post('/api/planificar_ruta', json=cuerpo)
+    assert respuesta.status_code == 400
+    assert not respuesta.get_json()['exito']
@@ -0,0 +1,128 @@
+import random
+
+import pytest
+
+from app import SESION_COOKIE, app, simulador
+from juego import RegistroJugadores, SimuladorComercio
+from persistencia import Persistencia
+
+
+def test_lecturas_sin_cookie_no_crean_jugadores():
+    cliente = app.test_client()
+    antes = len(simulador.jugadores)
+    for ruta in ('/api/jugador', '/api/ranking', '/api/optimizar_inventario', '/api/arbitraje'):
+        respuesta = cliente.get(ruta)
+        assert respuesta.status_code == 200
+        assert respuesta.headers.get('Set-Cookie') is None
+    assert len(simulador.jugadores) == antes
+    assert cliente.get('/api/jugador').get_json()['dinero'] == 50000
+
+
+def test_la_primera_operacion_crea_el_jugador():
+    cliente = app.test_client()
+    antes = len(simulador.jugadores)
+    recurso = simulador.mercado.por_indice[0].nombre
+    respuesta = cliente.post('/api/comprar', json={'recurso': recurso, 'cantidad': 1})
+    assert SESION_COOKIE in respuesta.headers['Set-Cookie']
+    assert len(simulador.jugadores) == antes + 1
+    # La cookie identifica al mismo jugador en las lecturas siguientes
+    assert recurso in cliente.get('/api/jugador').get_json()['inventario']
+    assert len(simulador.jugadores) == antes + 1
+
+
+def test_cors_con_credenciales():
+    respuesta = app.test_client().get('/api/ranking', headers={'Origin': 'http://localhost:5000'})
+    assert respuesta.headers['Access-Control-Allow-Origin'] == 'http://localhost:5000'
+    assert respuesta.headers['Access-Control-Allow-Credentials'] == 'true'
+
+
+def test_un_reinicio_invalida_los_etag(monkeypatch):
+    import app as servidor
+    cliente = app.test_client()
+    etags = {ruta: cliente.get(ruta).headers['ETag'] for ruta in ('/api/mercado', '/api/jugador', '/api/estadisticas')}
+    for ruta, etag in etags.items():
+        assert cliente.get(ruta, headers={'If-None-Match': etag}).status_code == 304
+
+    # Otro arranque con las mismas versiones (que vuelven a empezar) no da un 304
+    monkeypatch.setattr(servidor, 'ARRANQUE', 'otro')
+    monkeypatch.setattr(servidor, 'EPOCA_MERCADO', 'otra')
+    for ruta, etag in etags.items():
+        assert cliente.get(ruta, headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_desalojar_cancela_las_ordenes_y_devuelve_las_garantias(tmp_path):
+    mundo = SimuladorComercio.generar(4, 2, semilla=1)
+    persistencia = Persistencia(str(tmp_path))
+    persistencia.guardar(mundo)
+    mundo.mercado.diario = persistencia
+    mundo.jugadores = RegistroJugadores(max_jugadores=1, ranking=mundo.ranking, ordenes=mundo.mercado.ordenes)
+    recurso = mundo.mercado.por_indice[0]
+    sesion = mundo.jugadores.obtener('a')
+    jugador = sesion.jugador
+    jugador.inventario[recurso.nombre] = 3
+    with sesion.lock:
+        mundo.mercado.ordenes.colocar(sesion, recurso, 0, 'compra', 10.0, 2)
+        mundo.mercado.ordenes.colocar(sesion, recurso, 1, 'venta', 999.0, 3)
+    assert jugador.dinero == 50000 - 20 and recurso.nombre not in jugador.inventario
+
+    mundo.jugadores.obtener('b')  # Con un solo hueco, 'a' sale del registro
+
+    assert not mundo.mercado.ordenes.ordenes
+    assert all(not libro.activas for libro in mundo.mercado.ordenes.libros.values())
+    assert jugador.dinero == 50000 and jugador.inventario[recurso.nombre] == 3 and jugador.capacidad_usada == 0
+    # Una petición que aún tenga la sesión ya no deja órdenes huérfanas
+    with sesion.lock:
+        exito, _, _ = mundo.mercado.ordenes.colocar(sesion, recurso, 0, 'compra', 10.0, 1)
+    assert not exito
+    # Al restaurar, ni la sesión ni sus órdenes vuelven
+    restaurado = Persistencia(str(tmp_path)).restaurar()
+    assert 'a' not in restaurado.jugadores.sesiones and not restaurado.mercado.ordenes.ordenes
+
+
+def test_el_nombre_no_revela_la_sesion():
+    registro = RegistroJugadores()
+    sesion_id = registro.nuevo_id()
+    nombre = registro.obtener(sesion_id).jugador.nombre
+    assert nombre.startswith('Jugador-') and sesion_id[:6] not in nombre
+
+
+def test_el_ranking_incremental_coincide_con_recalcularlo():
+    mundo = SimuladorComercio.generar(5, 4, semilla=7)
+    mercado = mundo.mercado
+    mundo.jugadores = RegistroJugadores(max_jugadores=6, ranking=mundo.ranking, ordenes=mercado.ordenes)
+    rng = random.Random(3)
+
+    def recalculado():
+        precios = mercado.foto.precio_actual
+        filas = []
+        for sesion_id, sesion in mundo.jugadores.sesiones.items():
+            jugador = sesion.jugador
+            patrimonio = jugador.dinero + jugador.dinero_retenido + sum(
+                precios[mercado.recursos[nombre].indice] * cantidad
+                for tenencias in (jugador.inventario, jugador.retenido) for nombre, cantidad in tenencias.items())
+            filas.append((-patrimonio, sesion_id))
+        return [(sesion_id, -menos) for menos, sesion_id in sorted(filas)]
+
+    for paso in range(300):
+        # Sesiones nuevas y viejas: con 6 huecos, las menos usadas salen del registro
+        sesion = mundo.jugadores.obtener(f'sesion-{rng.randrange(10)}')
+        recurso = rng.choice(mercado.por_indice)
+        accion = rng.random()
+        with sesion.lock:
+            if accion < 0.4:
+                sesion.jugador.comprar_recurso(recurso, rng.randint(1, 3), mercado)
+            elif accion < 0.6:
+                sesion.jugador.vender_recurso(recurso.nombre, 1, mercado)
+            elif accion < 0.8 and not sesion.desalojada:
+                lado = rng.choice(('compra', 'venta'))
+                precio = recurso.precio_actual * rng.uniform(0.8, 1.2)
+                mercado.ordenes.colocar(sesion, recurso, rng.randrange(5), lado, precio, 1)
+        if accion >= 0.8:
+            mercado.simular_mercado(semilla=paso)
+            mercado.ordenes.casar()
+        if paso % 10 == 0:
+            primeros, _ = mundo.ranking.consultar(len(mundo.ranking))
+            assert len(primeros) == len(mundo.jugadores)
+            esperado = recalculado()
+            assert [entrada.sesion_id for _, entrada in primeros] == [sesion_id for sesion_id, _ in esperado]
+            assert [entrada.patrimonio for _, entrada in primeros] == pytest.approx([p for _, p in esperado])
@@ -0,0 +1,29 @@
+from contextlib import nullcontext
+from types import SimpleNamespace
+
+import pytest
+
+import app as servidor
+
+
+@pytest.fixture
+def no_propietario(monkeypatch):
+    """Proceso que comparte el mercado pero no lo avanza"""
+    memoria = SimpleNamespace(reclamar=lambda: False, escritura=lambda regional=False: nullcontext(), leer=lambda: False)
+    monkeypatch.setattr(servidor, 'memoria_mercado', memoria)
+    return memoria
+
+
+def test_simular_turno_fuera_del_propietario_responde_409(no_propietario):
+    turno = servidor.simulador.turno
+    respuesta = servidor.app.test_client().post('/api/simular_turno?esperar=1')
+    assert respuesta.status_code == 409
+    assert servidor.simulador.turno == turno
+
+
+def test_sin_turno_nuevo_no_se_guarda_instantanea(no_propietario, monkeypatch):
+    guardadas = []
+    monkeypatch.setattr(servidor.persistencia, 'guardar', guardadas.append)
+    monkeypatch.setattr(servidor.simulador, 'turno', servidor.INSTANTANEA_CADA)
+    servidor.ejecutar_turno()
+    assert servidor.simulador.turno == servidor.INSTANTANEA_CADA and not guardadas